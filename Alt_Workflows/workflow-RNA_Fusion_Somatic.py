@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 # Standard packages
+import os
 import sys
 import argparse
 
@@ -10,8 +11,12 @@ from toil.job import Job
 # Package methods
 from ddb import configuration
 from ddb_ngsflow import pipeline
-from ddb_ngsflow.rna import star
-from ddb_ngsflow.variation.sv import manta
+
+# Local methods
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fusion_junctions
+import star_shared
+import sv_calling
 
 
 if __name__ == "__main__":
@@ -31,25 +36,39 @@ if __name__ == "__main__":
     # Workflow Graph definition. The following workflow definition should create a valid Directed Acyclic Graph (DAG)
     root_job = Job.wrapJobFn(pipeline.spawn_batch_jobs, cores=1)
 
-    # Per sample jobs
-    for sample in samples:
-        # Alignment and Refinement Stages
-        # 1st Pass STAR
+    # STAR runs in node batches sharing one copy of the genome in memory
+    flags = list()
+    flags.append("compressed")
+    flags.append("chimeric")
+    breakpoint_summaries = dict()
+
+    for batch in star_shared.node_batches(samples, int(config['star'].get('samples_per_node', 4))):
+        batch_cores, batch_mem = star_shared.batch_resources(config, len(batch))
+        align_job = Job.wrapJobFn(star_shared.star_node_batch, config, batch, samples, flags,
+                                  cores=batch_cores,
+                                  memory="{}G".format(batch_mem))
+        root_job.addChild(align_job)
 
-        flags = list()
-        flags.append("compressed")
+        # Per sample jobs
+        for sample in batch:
+            manta_job = Job.wrapJobFn(sv_calling.manta_sv, config, sample, samples,
+                                      "{}.star.Aligned.sortedByCoord.out.bam".format(sample), True,
+                                      cores=1,
+                                      memory="2G")
+            align_job.addChild(manta_job)
 
-        align_job = Job.wrapJobFn(star.star_paired, config, sample, samples, flags,
-                                  cores=int(config['star']['num_cores']),
-                                  memory="{}G".format(config['star']['max_mem']))
+            breakpoints_job = Job.wrapJobFn(fusion_junctions.chimeric_breakpoints, config, sample,
+                                            cores=1,
+                                            memory="2G")
+            breakpoint_summaries[sample] = breakpoints_job.rv()
+            align_job.addChild(breakpoints_job)
 
-        manta_job = Job.wrapJobFn(manta.manta, config, sample, samples,
-                                  cores=int(config['manta']['num_cores']),
-                                  memory="{}G".format(config['manta']['max_mem']))
+    # Run level fusion candidates from breakpoints clustered across samples
+    fusion_job = Job.wrapJobFn(fusion_junctions.fusion_candidates, config, samples, breakpoint_summaries,
+                               cores=1,
+                               memory="4G")
 
-        # Create workflow from created jobs
-        root_job.addChild(align_job)
-        align_job.addChild(manta_job)
+    root_job.addFollowOn(fusion_job)
 
     # Start workflow execution
     Job.Runner.startToil(root_job, args)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 # Standard packages
+import os
 import sys
 import argparse
 
@@ -12,10 +13,13 @@ from ddb import configuration
 from ddb_ngsflow import gatk
 from ddb_ngsflow import annotation
 from ddb_ngsflow import pipeline
-from ddb_ngsflow.align import bwa
 from ddb_ngsflow.variation import variation
 from ddb_ngsflow.variation import haplotypecaller
 
+# Local methods
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lane_alignment
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -37,15 +41,15 @@ if __name__ == "__main__":
     # Per sample jobs
     for sample in samples:
         # Alignment and Refinement Stages
-        align_job = Job.wrapJobFn(bwa.run_bwa_mem, config, sample, samples,
+        # Each lane is aligned in parallel with its own read group, then merged
+        align_job = Job.wrapJobFn(lane_alignment.spawn_lane_alignments, config, sample, samples,
+                                  cores=1)
+
+        merge_job = Job.wrapJobFn(lane_alignment.merge_lane_bams, config, sample, samples, align_job.rv(),
                                   cores=int(config['bwa']['num_cores']),
                                   memory="{}G".format(config['bwa']['max_mem']))
 
-        add_job = Job.wrapJobFn(gatk.add_or_replace_readgroups, config, sample, align_job.rv(),
-                                cores=1,
-                                memory="{}G".format(config['picard-add']['max_mem']))
-
-        dedup_job = Job.wrapJobFn(gatk.mark_duplicates, config, sample, add_job.rv(),
+        dedup_job = Job.wrapJobFn(gatk.mark_duplicates, config, sample, merge_job.rv(),
                                   cores=int(config['picard-dedup']['num_cores']),
                                   memory="{}G".format(config['picard-dedup']['max_mem']))
 
@@ -68,8 +72,8 @@ if __name__ == "__main__":
 
         # Create workflow from created jobs
         root_job.addChild(align_job)
-        align_job.addChild(add_job)
-        add_job.addChild(dedup_job)
+        align_job.addFollowOn(merge_job)
+        merge_job.addChild(dedup_job)
         dedup_job.addChild(creator_job)
         creator_job.addChild(realign_job)
         realign_job.addChild(recal_job)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 # Standard packages
+import os
 import sys
 import argparse
 
@@ -12,10 +13,13 @@ from ddb import configuration
 from ddb_ngsflow import gatk
 from ddb_ngsflow import annotation
 from ddb_ngsflow import pipeline
-from ddb_ngsflow.align import bwa
 from ddb_ngsflow.variation import variation
 from ddb_ngsflow.variation import haplotypecaller
 
+# Local methods
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lane_alignment
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -42,16 +46,16 @@ if __name__ == "__main__":
         input_bams = list()
         for library in samples[sample]:
             # Alignment and Refinement Stages
-            align_job = Job.wrapJobFn(bwa.run_bwa_mem, config, library, libraries,
-                                      cores=int(config['bwa']['num_cores']),
-                                      memory="{}G".format(config['bwa']['max_mem']))
-
-            add_job = Job.wrapJobFn(gatk.add_or_replace_readgroups, config, library, align_job.rv(),
-                                    cores=1,
-                                    memory="{}G".format(config['picard-add']['max_mem']))
-            input_bams.append("{}.rg.sorted.bam".format(library))
+            # Each lane is aligned in parallel with its own read group, then merged
+            align_job = Job.wrapJobFn(lane_alignment.spawn_lane_alignments, config, library, libraries,
+                                      cores=1)
+
+            lane_merge_job = Job.wrapJobFn(lane_alignment.merge_lane_bams, config, library, libraries, align_job.rv(),
+                                           cores=int(config['bwa']['num_cores']),
+                                           memory="{}G".format(config['bwa']['max_mem']))
+            input_bams.append("{}.bwa.sorted.bam".format(library))
             sample_root_job.addChild(align_job)
-            align_job.addChild(add_job)
+            align_job.addFollowOn(lane_merge_job)
 
         input_bams_string = " INPUT=".join(input_bams)
         dedup_job = Job.wrapJobFn(gatk.mark_duplicates, config, sample, input_bams_string,
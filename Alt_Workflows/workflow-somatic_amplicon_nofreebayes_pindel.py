@@ -13,7 +13,6 @@ from ddb import configuration
 from ddb_ngsflow import gatk
 from ddb_ngsflow import annotation
 from ddb_ngsflow import pipeline
-from ddb_ngsflow.align import bwa
 from ddb_ngsflow.qc import qc
 from ddb_ngsflow.coverage import sambamba
 from ddb_ngsflow.variation import variation
@@ -22,6 +21,10 @@ from ddb_ngsflow.variation import platypus
 from ddb_ngsflow.variation import vardict
 from ddb_ngsflow.variation import scalpel
 
+# Local methods
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lane_alignment
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -63,22 +66,21 @@ if __name__ == "__main__":
     # Per sample jobs
     for sample in samples:
         # Alignment and Refinement Stages
-        align_job = Job.wrapJobFn(bwa.run_bwa_mem, config, sample, samples,
-                                  cores=int(config['bwa']['num_cores']),
-                                  memory="{}G".format(config['bwa']['max_mem']))
+        # Each lane is aligned in parallel with its own read group, then merged
+        align_job = Job.wrapJobFn(lane_alignment.spawn_lane_alignments, config, sample, samples,
+                                  cores=1)
 
-        add_job = Job.wrapJobFn(gatk.add_or_replace_readgroups, config, sample,
-                                align_job.rv(),
-                                cores=1,
-                                memory="{}G".format(config['picard-add']['max_mem']))
+        lane_merge_job = Job.wrapJobFn(lane_alignment.merge_lane_bams, config, sample, samples, align_job.rv(),
+                                       cores=int(config['bwa']['num_cores']),
+                                       memory="{}G".format(config['bwa']['max_mem']))
 
         creator_job = Job.wrapJobFn(gatk.realign_target_creator, config, sample,
-                                    add_job.rv(),
+                                    lane_merge_job.rv(),
                                     cores=int(config['gatk-realign']['num_cores']),
                                     memory="{}G".format(config['gatk-realign']['max_mem']))
 
         realign_job = Job.wrapJobFn(gatk.realign_indels, config, sample,
-                                    add_job.rv(), creator_job.rv(),
+                                    lane_merge_job.rv(), creator_job.rv(),
                                     cores=1,
                                     memory="{}G".format(config['gatk-realign']['max_mem']))
 
@@ -168,8 +170,8 @@ if __name__ == "__main__":
 
         # Create workflow from created jobs
         root_job.addChild(align_job)
-        align_job.addChild(add_job)
-        add_job.addChild(creator_job)
+        align_job.addFollowOn(lane_merge_job)
+        lane_merge_job.addChild(creator_job)
         creator_job.addChild(realign_job)
         realign_job.addChild(recal_job)
 
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Standard packages
+import os
+import re
+import sys
+import hashlib
+import argparse
+import subprocess
+
+# Package methods
+import intervals
+import shell_commands
+
+
+FILE_RE = re.compile(r'^(\s*file\s*=\s*)"([^"]+)"(.*)$')
+SLICE_PRESETS = (('.vcf.gz', 'vcf'), ('.bed.gz', 'bed'))
+
+
+def slice_preset(source):
+    for suffix, preset in SLICE_PRESETS:
+        if source.endswith(suffix):
+            return suffix, preset
+
+    return None, None
+
+
+def make_dirs(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def source_checksum(source, cache_dir):
+    """Return the SHA1 of an annotation source, memoised in the cache by path, size and mtime so multi-GB
+    sources are only re-read when they change"""
+
+    stat = os.stat(source)
+    memo_dir = os.path.join(cache_dir, "checksums")
+    memo = os.path.join(memo_dir, hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest())
+    stamp = "{} {}".format(stat.st_size, int(stat.st_mtime))
+
+    if os.path.exists(memo):
+        with open(memo, 'r') as memo_file:
+            memo_stamp, _, checksum = memo_file.read().strip().rpartition(' ')
+        if memo_stamp == stamp:
+            return checksum
+
+    checksum = intervals.file_checksum(source)
+    make_dirs(memo_dir)
+    with open("{}.tmp{}".format(memo, os.getpid()), 'w') as memo_file:
+        memo_file.write("{} {}\n".format(stamp, checksum))
+    os.rename("{}.tmp{}".format(memo, os.getpid()), memo)
+
+    return checksum
+
+
+def config_sources(vcfanno_config):
+    """Return the annotation source files referenced by a vcfanno TOML config, in order"""
+
+    sources = list()
+    with open(vcfanno_config, 'r') as config_file:
+        for line in config_file:
+            match = FILE_RE.match(line)
+            if match:
+                sources.append(match.group(2))
+
+    return sources
+
+
+def write_padded_regions(regions, padding, output_bed):
+    """Write the panel regions padded and merged, so each source record overlaps as few query regions as possible"""
+
+    index = intervals.IntervalIndex.from_bed(regions, padding)
+    with open(output_bed, 'w') as bed:
+        for contig in sorted(index.contigs()):
+            for start, end in index.intervals(contig):
+                bed.write("{}\t{}\t{}\n".format(contig, start, end))
+
+
+def slice_source(source, regions_bed, slice_file, preset):
+    """Cut source down to regions_bed. tabix -R queries each region separately, so a record spanning two regions
+    is returned once per region and out of order; the records are re-sorted and exact duplicates dropped"""
+
+    temp_file = "{}.tmp{}".format(slice_file, os.getpid())
+    slice_cmd = "{{ tabix -H {source} && tabix -R {regions} {source} | LC_ALL=C sort -k1,1 -k2,2n | uniq; }} | " \
+                "bgzip -c > {temp}".format(regions=regions_bed, source=source, temp=temp_file)
+    command = "{slice_cmd} && tabix -f -p {preset} {temp} && mv {temp}.tbi {slice}.tbi && " \
+              "mv {temp} {slice}".format(slice_cmd=shell_commands.pipefail(slice_cmd), temp=temp_file,
+                                         preset=preset, slice=slice_file)
+    subprocess.check_call(command, shell=True)
+
+
+def panel_config(vcfanno_config, regions, cache_dir, padding=100):
+    """Return a vcfanno config pointing at panel-restricted slices of its annotation sources.
+
+    Slices of tabix-indexed VCF and BED sources are cut to the padded panel regions, bgzipped and indexed
+    under cache_dir, keyed by the source checksum and the regions checksum. Existing slices are reused, so
+    only the first run for a panel or a changed source pays for extraction. Other sources are left as-is."""
+
+    regions_key = "{}.{}.p{}".format(os.path.splitext(os.path.basename(regions))[0],
+                                     intervals.file_checksum(regions)[:12], padding)
+    config_key = intervals.file_checksum(vcfanno_config)[:12]
+    panel_dir = os.path.join(cache_dir, regions_key)
+    make_dirs(panel_dir)
+
+    sliced_config = os.path.join(panel_dir, "{}.{}.conf".format(
+        os.path.splitext(os.path.basename(vcfanno_config))[0], config_key))
+    padded_bed = os.path.join(panel_dir, "regions.padded.bed")
+    if not os.path.exists(padded_bed):
+        write_padded_regions(regions, padding, "{}.tmp{}".format(padded_bed, os.getpid()))
+        os.rename("{}.tmp{}".format(padded_bed, os.getpid()), padded_bed)
+
+    lines = list()
+    with open(vcfanno_config, 'r') as config_file:
+        for line in config_file:
+            match = FILE_RE.match(line)
+            suffix, preset = slice_preset(match.group(2)) if match else (None, None)
+            if preset and os.path.exists("{}.tbi".format(match.group(2))):
+                source = match.group(2)
+                slice_file = os.path.join(panel_dir, "{}.{}{}".format(
+                    os.path.basename(source)[:-len(suffix)], source_checksum(source, cache_dir)[:12], suffix))
+                if not os.path.exists(slice_file):
+                    sys.stdout.write("Slicing {} to {}\n".format(source, slice_file))
+                    slice_source(source, padded_bed, slice_file, preset)
+                line = '{}"{}"{}\n'.format(match.group(1), slice_file, match.group(3))
+            lines.append(line)
+
+    with open("{}.tmp{}".format(sliced_config, os.getpid()), 'w') as config_file:
+        config_file.writelines(lines)
+    os.rename("{}.tmp{}".format(sliced_config, os.getpid()), sliced_config)
+
+    return sliced_config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute panel-restricted slices of vcfanno annotation sources")
+    parser.add_argument('-v', '--vcfanno_config', help="vcfanno TOML configuration file")
+    parser.add_argument('-r', '--regions', help="Panel regions BED file")
+    parser.add_argument('-d', '--cache_dir', help="Directory for cached slices and sliced configs")
+    parser.add_argument('-p', '--padding', type=int, default=100, help="Padding around panel regions (bp)")
+    args = parser.parse_args()
+
+    sys.stdout.write("Sources in {}:\n{}\n".format(args.vcfanno_config,
+                                                   "\n".join(config_sources(args.vcfanno_config))))
+    sys.stdout.write("Sliced vcfanno config: {}\n".format(panel_config(args.vcfanno_config, args.regions,
+                                                                       args.cache_dir, args.padding)))
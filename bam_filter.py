@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# Standard packages
+import os
+import sys
+import argparse
+
+# Third-party packages
+import pysam
+
+# Package methods
+import intervals
+import shell_commands
+import coverage_engine
+import lane_alignment
+from ddb_ngsflow import pipeline
+
+
+def interval_cache_dir(config):
+    return config.get('interval_cache', os.path.join(os.getcwd(), "Intermediates", "interval_cache"))
+
+
+def filter_on_target(reader, writer, index, accumulator=None):
+    """Write every mapped record of reader overlapping the index to writer, adding kept reads to an optional
+    coverage_engine.DepthAccumulator. Returns (kept, total) counts"""
+
+    sweep = index.sweep()
+    kept = 0
+    total = 0
+    for read in reader:
+        total += 1
+        if read.is_unmapped:
+            continue
+        if sweep.overlaps(read.reference_name, read.reference_start, read.reference_end):
+            writer.write(read)
+            kept += 1
+            if accumulator is not None:
+                accumulator.add(read)
+
+    return kept, total
+
+
+def run_interval_filter(job, config, sample, samples, input_bam, coverage=False):
+    """Keep only reads overlapping the sample's target regions, replacing the bedtools intersect stage
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param input_bam: The coordinate sorted input BAM file.
+    :type input_bam: str.
+    :param coverage: Also compute panel coverage and the base coverage store from the kept reads.
+    :type coverage: bool.
+    :returns:  str -- The output BAM file name.
+    """
+
+    output_bam = "{}.bwa.sorted.filtered.bam".format(sample)
+    index = intervals.load_index(samples[sample]['regions'], interval_cache_dir(config))
+
+    job.fileStore.logToMaster("Filtering {} to on-target reads in {}\n".format(input_bam,
+                                                                              samples[sample]['regions']))
+    region_sets = None
+    depth = None
+    if coverage:
+        region_sets = coverage_engine.load_region_sets({'regions': samples[sample]['regions']})
+        depth = coverage_engine.DepthAccumulator(region_sets)
+
+    reader = pysam.AlignmentFile(input_bam, 'rb')
+    writer = pysam.AlignmentFile(output_bam, 'wb', template=reader)
+    kept, total = filter_on_target(reader, writer, index, depth)
+    contig_lengths = list(zip(reader.references, reader.lengths))
+    writer.close()
+    reader.close()
+
+    if depth is not None:
+        coverage_engine.write_sample_outputs(samples[sample]['library_name'], region_sets, depth.results(),
+                                             coverage_engine.coverage_thresholds(config), contig_lengths)
+
+    pysam.index(output_bam)
+    job.fileStore.logToMaster("Kept {} of {} reads on target for sample {}\n".format(kept, total, sample))
+
+    return output_bam
+
+
+def run_bwa_mem_on_target(job, config, sample, samples):
+    """Run BWA-MEM, with the lane read group, and the on-target filter as a pipe stage before sorting, so no
+    unfiltered BAM is written.
+    Panel coverage is left to coverage_engine.region_coverage on the recalibrated BAM, as in the other workflows.
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :returns:  str -- The output BAM file name.
+    """
+
+    lanes = lane_alignment.lane_pairs(samples[sample])
+    if len(lanes) > 1:
+        raise ValueError("Sample {} has multiple lanes, use lane_alignment.spawn_lane_alignments, merge_lane_bams "
+                         "and run_interval_filter instead".format(sample))
+
+    lane, fastq1, fastq2 = lanes[0]
+    output_bam = "{}.bwa.sorted.filtered.bam".format(sample)
+    temp = "{}.bwa.sort.temp".format(sample)
+    logfile = "{}.bwa-align.log".format(sample)
+
+    # Build the cached index up front so the pipe stage only ever reads it
+    intervals.load_index(samples[sample]['regions'], interval_cache_dir(config))
+    filter_script = "{}.py".format(os.path.splitext(os.path.abspath(__file__))[0])
+
+    bwa_cmd = ["{}".format(config['bwa']['bin']),
+               "mem",
+               "-t", "{}".format(config['bwa']['num_cores']),
+               "-M", "-v", "2",
+               "-R", "'{}'".format(lane_alignment.read_group(config, sample, samples, lane)),
+               "{}".format(config['reference']),
+               "{}".format(fastq1),
+               "{}".format(fastq2)]
+
+    filter_cmd = ["{}".format(sys.executable),
+                  "{}".format(filter_script),
+                  "-r", "{}".format(samples[sample]['regions']),
+                  "-c", "{}".format(interval_cache_dir(config))]
+
+    sort_cmd = ["{}".format(config['samtools']['bin']),
+                "sort",
+                "-@", "{}".format(config['bwa']['num_cores']),
+                "-O", "bam",
+                "-o", "{}".format(output_bam),
+                "-T", "{}".format(temp),
+                "-"]
+
+    index_cmd = ["{}".format(config['samtools']['bin']), "index", "{}".format(output_bam)]
+
+    command = "{} && {}".format(shell_commands.pipefail("{} | {} | {}".format(" ".join(bwa_cmd),
+                                                                           " ".join(filter_cmd),
+                                                                           " ".join(sort_cmd))),
+                                " ".join(index_cmd))
+
+    job.fileStore.logToMaster("BWA Command: {}\n".format(command))
+    pipeline.run_and_log_command(command, logfile)
+
+    return output_bam
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="On-target read filter usable as a pipe stage, "
+                                                 "e.g. bwa mem ... | bam_filter.py -r panel.bed | samtools sort -")
+    parser.add_argument('-r', '--regions', help="Panel regions BED file")
+    parser.add_argument('-i', '--input', default="-", help="Input SAM/BAM file (default: stdin)")
+    parser.add_argument('-o', '--output', default="-", help="Output BAM file (default: uncompressed BAM to stdout)")
+    parser.add_argument('-c', '--cache_dir', default=os.path.join("Intermediates", "interval_cache"),
+                        help="Directory holding cached interval indexes")
+    parser.add_argument('-p', '--coverage_prefix', help="Also compute panel coverage from the stream, writing "
+                                                        "<prefix>.sambamba_coverage.bed, <prefix>.coverage.npz "
+                                                        "and the <prefix>.base_coverage.bcov store")
+    parser.add_argument('-t', '--thresholds', default=",".join(str(t) for t in coverage_engine.DEFAULT_THRESHOLDS),
+                        help="Comma separated coverage thresholds")
+    args = parser.parse_args()
+
+    target_index = intervals.load_index(args.regions, args.cache_dir)
+    region_sets = None
+    depth = None
+    if args.coverage_prefix:
+        region_sets = coverage_engine.load_region_sets({'regions': args.regions})
+        depth = coverage_engine.DepthAccumulator(region_sets)
+
+    in_reads = pysam.AlignmentFile(args.input, 'r')
+    out_reads = pysam.AlignmentFile(args.output, 'wbu' if args.output == "-" else 'wb', template=in_reads)
+    num_kept, num_total = filter_on_target(in_reads, out_reads, target_index, depth)
+    stream_contigs = list(zip(in_reads.references, in_reads.lengths))
+    out_reads.close()
+    in_reads.close()
+
+    if depth is not None:
+        coverage_engine.write_sample_outputs(args.coverage_prefix, region_sets, depth.results(),
+                                             tuple(int(t) for t in args.thresholds.split(',')), stream_contigs)
+
+    sys.stderr.write("Kept {} of {} reads on target\n".format(num_kept, num_total))
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# Standard packages
+import sys
+import mmap
+import zlib
+import struct
+import argparse
+
+from collections import OrderedDict
+from collections import defaultdict
+
+# Third-party packages
+import numpy as np
+
+# Package methods
+import intervals
+
+
+STORE_MAGIC = b"BCOV\x01"
+DEFAULT_BLOCK_SIZE = 16384
+# Decompressed blocks kept per open store
+BLOCK_CACHE_SIZE = 64
+
+
+def encode_runs(depth):
+    """Run-length encode a depth array as (run starts, run values), both int32"""
+
+    if not len(depth):
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(depth)) + 1)).astype(np.int32)
+
+    return starts, depth[starts].astype(np.int32)
+
+
+def decode_runs(starts, values, length):
+    lengths = np.diff(np.append(starts, length))
+
+    return np.repeat(values, lengths)
+
+
+class BaseCoverageWriter(object):
+    """Write a base coverage store: a magic string, one zlib compressed run-length block per non-empty
+    block_size window of a contig, then a block index and the offset of that index.
+
+    Index layout: sample name, block size, contig count, then per contig its name, length, block count and
+    the (block number, offset, compressed size) of every stored block in ascending order. Windows without
+    a block have zero depth."""
+
+    def __init__(self, store_file, sample_name, contig_lengths, block_size=DEFAULT_BLOCK_SIZE):
+        self.store_file = store_file
+        self.sample_name = sample_name
+        self.contig_lengths = OrderedDict(contig_lengths)
+        self.block_size = block_size
+        self.blocks = OrderedDict((contig, list()) for contig in self.contig_lengths)
+        self.handle = open(store_file, 'wb')
+        self.handle.write(STORE_MAGIC)
+
+    def add_block(self, contig, block_number, depth):
+        """Store the depth of one whole block window. Blocks of a contig must be added in ascending order"""
+
+        if not depth.any():
+            return
+        starts, values = encode_runs(depth)
+        data = zlib.compress(starts.tobytes() + values.tobytes())
+        self.blocks[contig].append((block_number, self.handle.tell(), len(data)))
+        self.handle.write(data)
+
+    def close(self):
+        index_offset = self.handle.tell()
+        encoded = self.sample_name.encode('utf-8')
+        self.handle.write(struct.pack("<H", len(encoded)) + encoded)
+        self.handle.write(struct.pack("<II", self.block_size, len(self.contig_lengths)))
+        for contig, length in self.contig_lengths.items():
+            encoded = contig.encode('utf-8')
+            blocks = self.blocks[contig]
+            self.handle.write(struct.pack("<H", len(encoded)) + encoded)
+            self.handle.write(struct.pack("<QI", length, len(blocks)))
+            if blocks:
+                self.handle.write(np.array(blocks, dtype=np.uint64).tobytes())
+        self.handle.write(struct.pack("<Q", index_offset))
+        self.handle.close()
+
+
+class BaseCoverage(object):
+    """Read-only, memory mapped base coverage store with per-interval depth queries"""
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.handle = open(store_file, 'rb')
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ValueError("{} is not a base coverage store".format(store_file))
+
+        position = struct.unpack_from("<Q", self.data, len(self.data) - 8)[0]
+        name_length = struct.unpack_from("<H", self.data, position)[0]
+        position += 2
+        self.sample_name = self.data[position:position + name_length].decode('utf-8')
+        position += name_length
+        self.block_size, num_contigs = struct.unpack_from("<II", self.data, position)
+        position += 8
+
+        self.contig_lengths = OrderedDict()
+        self.index = dict()
+        for _ in range(num_contigs):
+            name_length = struct.unpack_from("<H", self.data, position)[0]
+            position += 2
+            contig = self.data[position:position + name_length].decode('utf-8')
+            position += name_length
+            length, num_blocks = struct.unpack_from("<QI", self.data, position)
+            position += 12
+            blocks = np.frombuffer(self.data, dtype=np.uint64, count=num_blocks * 3,
+                                   offset=position).reshape(num_blocks, 3).copy()
+            position += num_blocks * 24
+            self.contig_lengths[contig] = length
+            self.index[contig] = blocks
+
+        self.cache = OrderedDict()
+
+    def close(self):
+        self.cache.clear()
+        self.index.clear()
+        self.data.close()
+        self.handle.close()
+
+    def block(self, contig, block_number):
+        """Return the depth of a whole block window, or None when the window has no coverage"""
+
+        key = (contig, block_number)
+        if key in self.cache:
+            return self.cache[key]
+
+        blocks = self.index[contig]
+        row = np.searchsorted(blocks[:, 0], block_number)
+        depth = None
+        if row < len(blocks) and blocks[row, 0] == block_number:
+            offset, size = int(blocks[row, 1]), int(blocks[row, 2])
+            runs = np.frombuffer(zlib.decompress(self.data[offset:offset + size]), dtype=np.int32)
+            block_start = block_number * self.block_size
+            block_length = min(self.block_size, self.contig_lengths[contig] - block_start)
+            depth = decode_runs(runs[:len(runs) // 2], runs[len(runs) // 2:], block_length)
+
+        self.cache[key] = depth
+        if len(self.cache) > BLOCK_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+        return depth
+
+    def depth(self, contig, start, end):
+        """Per-base depth over the 0-based half-open interval [start, end) as an int32 array"""
+
+        result = np.zeros(end - start, dtype=np.int32)
+        if contig not in self.index:
+            return result
+
+        for block_number in range(start // self.block_size, (end - 1) // self.block_size + 1):
+            block_depth = self.block(contig, block_number)
+            if block_depth is None:
+                continue
+            block_start = block_number * self.block_size
+            overlap_start = max(start, block_start)
+            overlap_end = min(end, block_start + len(block_depth))
+            if overlap_start < overlap_end:
+                result[overlap_start - start:overlap_end - start] = \
+                    block_depth[overlap_start - block_start:overlap_end - block_start]
+
+        return result
+
+    def mean(self, contig, start, end):
+        return float(self.depth(contig, start, end).mean()) if end > start else 0.0
+
+
+def stack(stores, contig, start, end):
+    """Return a samples x bases depth matrix over [start, end) for a list of open BaseCoverage stores"""
+
+    matrix = np.zeros((len(stores), end - start), dtype=np.int32)
+    for row, store in enumerate(stores):
+        matrix[row] = store.depth(contig, start, end)
+
+    return matrix
+
+
+def write_target_store(store_file, sample_name, contig_lengths, targets, depths, block_size=DEFAULT_BLOCK_SIZE):
+    """Build a base coverage store from per-target depth arrays already computed by coverage_engine, so the
+    store costs no extra BAM pass. depths holds one array (or None) per (contig, start, end, name) target.
+    Bases outside the targets read as zero"""
+
+    writer = BaseCoverageWriter(store_file, sample_name, contig_lengths, block_size)
+    contig_targets = defaultdict(list)
+    for (contig, start, end, name), depth in zip(targets, depths):
+        if depth is not None:
+            contig_targets[contig].append((start, end, depth))
+
+    for contig, length in writer.contig_lengths.items():
+        blocks = dict()
+        for start, end, depth in contig_targets.get(contig, ()):
+            end = min(end, length)
+            for block_number in range(start // block_size, (end - 1) // block_size + 1):
+                block_start = block_number * block_size
+                if block_number not in blocks:
+                    blocks[block_number] = np.zeros(min(block_size, length - block_start), dtype=np.int32)
+                overlap_start = max(start, block_start)
+                overlap_end = min(end, block_start + len(blocks[block_number]))
+                # Overlapping targets see the same reads, so their depths agree where they overlap
+                np.maximum(blocks[block_number][overlap_start - block_start:overlap_end - block_start],
+                           depth[overlap_start - start:overlap_end - start],
+                           out=blocks[block_number][overlap_start - block_start:overlap_end - block_start])
+        for block_number in sorted(blocks):
+            writer.add_block(contig, block_number, blocks[block_number])
+
+    writer.close()
+
+    return store_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report mean depth over BED regions from base coverage stores")
+    parser.add_argument('-s', '--stores', nargs='+', help="Base coverage store files")
+    parser.add_argument('-r', '--regions', help="BED file of regions to report")
+    args = parser.parse_args()
+
+    coverage_stores = [BaseCoverage(store) for store in args.stores]
+    sys.stdout.write("chrom\tstart\tend\tname\t{}\n".format("\t".join(store.sample_name
+                                                                    for store in coverage_stores)))
+    for region_contig, region_start, region_end, region_name in intervals.read_bed(args.regions):
+        depths = stack(coverage_stores, region_contig, region_start, region_end)
+        sys.stdout.write("{}\t{}\t{}\t{}\t{}\n".format(region_contig, region_start, region_end, region_name,
+                                                       "\t".join("{:.2f}".format(value)
+                                                                 for value in depths.mean(axis=1))))
+    for store in coverage_stores:
+        store.close()
@@ -0,0 +1,261 @@
+import os
+import heapq
+
+from collections import defaultdict
+from ddb_ngsflow import pipeline
+from ddb_ngsflow import annotation
+
+import annotation_slices
+import samples_config
+
+
+BATCH_TAG = "DDB_BATCH"
+BATCH_HEADER = '##INFO=<ID={},Number=1,Type=Integer,Description="Index of the source VCF in a batched ' \
+               'annotation run">\n'.format(BATCH_TAG)
+
+
+def read_vcf_header(vcf_file):
+    """Return the (meta lines, #CHROM line) of a VCF file"""
+
+    meta = list()
+    with open(vcf_file, 'r') as vcf:
+        for line in vcf:
+            if line.startswith('##'):
+                meta.append(line)
+            elif line.startswith('#'):
+                return meta, line
+            else:
+                break
+
+    raise ValueError("VCF file {} has no #CHROM header line".format(vcf_file))
+
+
+def tag_record(line, tag):
+    fields = line.rstrip('\n').split('\t')
+    tag_entry = "{}={}".format(BATCH_TAG, tag)
+    fields[7] = tag_entry if fields[7] == '.' else "{};{}".format(tag_entry, fields[7])
+
+    return "{}\n".format("\t".join(fields))
+
+
+def untag_record(line):
+    """Remove the batch tag from an annotated record, returning (tag, record line)"""
+
+    fields = line.rstrip('\n').split('\t')
+    tag = None
+    info = list()
+    for entry in fields[7].split(';'):
+        if entry.startswith("{}=".format(BATCH_TAG)):
+            tag = int(entry.split('=', 1)[1])
+        else:
+            info.append(entry)
+    fields[7] = ";".join(info) or '.'
+
+    return tag, "{}\n".format("\t".join(fields))
+
+
+def records(vcf_file):
+    with open(vcf_file, 'r') as vcf:
+        for line in vcf:
+            if not line.startswith('#'):
+                yield line
+
+
+def contig_order(meta, input_vcfs):
+    """Rank contigs by ##contig header order, then by first appearance in the inputs"""
+
+    ranks = dict()
+    for line in meta:
+        if line.startswith("##contig=<"):
+            for entry in line[len("##contig=<"):].rstrip('>\n').split(','):
+                if entry.startswith("ID="):
+                    ranks.setdefault(entry[3:], len(ranks))
+    for vcf in input_vcfs:
+        for line in records(vcf):
+            ranks.setdefault(line.split('\t', 1)[0], len(ranks))
+
+    return ranks
+
+
+def keyed_records(vcf_file, tag, ranks):
+    for line in records(vcf_file):
+        fields = line.split('\t', 2)
+        yield ranks[fields[0]], int(fields[1]), tag, line
+
+
+def combine_vcfs(input_vcfs, combined_vcf, sort=False):
+    """Combine VCFs into one batch file, tagging each record with the index of its source VCF.
+
+    Inputs are concatenated, or with sort=True merged by (contig, position) for tools such as vcfanno that
+    sweep sorted input. Each input must already be sorted; records keep their order within each input."""
+
+    headers = [read_vcf_header(vcf) for vcf in input_vcfs]
+    meta = list()
+    seen = set()
+    for header_meta, chrom_line in headers:
+        for line in header_meta:
+            if line not in seen:
+                seen.add(line)
+                meta.append(line)
+
+    with open(combined_vcf, 'w') as combined:
+        combined.writelines(meta)
+        combined.write(BATCH_HEADER)
+        combined.write(headers[0][1])
+        if sort:
+            ranks = contig_order(meta, input_vcfs)
+            streams = [keyed_records(vcf, tag, ranks) for tag, vcf in enumerate(input_vcfs)]
+            for rank, position, tag, line in heapq.merge(*streams):
+                combined.write(tag_record(line, tag))
+        else:
+            for tag, vcf in enumerate(input_vcfs):
+                for line in records(vcf):
+                    combined.write(tag_record(line, tag))
+
+    return meta + [BATCH_HEADER]
+
+
+def split_vcf(annotated_vcf, combined_meta, input_vcfs, output_vcfs):
+    """Split an annotated batch VCF back into per-input files.
+
+    Each output keeps its own input header, with any header lines added by the annotation tool inserted
+    before the #CHROM line exactly as a single-sample run would place them. Record order within each
+    input is preserved."""
+
+    annotated_meta, _ = read_vcf_header(annotated_vcf)
+    known = set(combined_meta)
+    added = [line for line in annotated_meta if line not in known]
+
+    outputs = list()
+    for vcf, output_vcf in zip(input_vcfs, output_vcfs):
+        meta, chrom_line = read_vcf_header(vcf)
+        output = open(output_vcf, 'w')
+        output.writelines(meta)
+        output.writelines(added)
+        output.write(chrom_line)
+        outputs.append(output)
+
+    for line in records(annotated_vcf):
+        tag, record = untag_record(line)
+        outputs[tag].write(record)
+
+    for output in outputs:
+        output.close()
+
+
+def snpeff_batch(job, config, samples, input_vcfs):
+    """Annotate every sample's VCF with a single snpEff invocation, so the JVM and database load once per run
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param input_vcfs: Dictionary of sample name to input VCF file.
+    :type input_vcfs: dict.
+    :returns:  dict -- Dictionary of sample name to snpEff annotated VCF file.
+    """
+
+    batch_samples = sorted(input_vcfs)
+    vcfs = [input_vcfs[sample] for sample in batch_samples]
+    output_vcfs = ["{}.snpEff.{}.vcf".format(sample, config['snpeff']['reference']) for sample in batch_samples]
+
+    batch_name = "{}.snpeff_batch".format(samples_config.run_name(config, samples, batch_samples))
+    combined_vcf = "{}.vcf".format(batch_name)
+    annotated_vcf = "{}.snpEff.{}.vcf".format(batch_name, config['snpeff']['reference'])
+
+    combined_meta = combine_vcfs(vcfs, combined_vcf)
+
+    # annotation.snpeff runs on the combined VCF as if it were one sample named after the batch, so the batch
+    # uses exactly the per-sample snpEff command, options and defaults
+    job.fileStore.logToMaster("SnpEff batch for {} samples: {}\n".format(len(batch_samples), combined_vcf))
+    result = annotation.snpeff(job, config, batch_name, combined_vcf)
+    if isinstance(result, str) and os.path.isfile(result):
+        annotated_vcf = result
+
+    split_vcf(annotated_vcf, combined_meta, vcfs, output_vcfs)
+    os.remove(combined_vcf)
+    os.remove(annotated_vcf)
+
+    return dict(zip(batch_samples, output_vcfs))
+
+
+def vcfanno_config_batch(job, config, run_id, vcfanno_config, regions, input_vcfs):
+    """Annotate the VCFs of all samples sharing a vcfanno config in one pass over the annotation sources.
+    If config['vcfanno'] sets slice_cache, annotation runs against cached panel-restricted source slices.
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param run_id: The run name used for batch file names.
+    :type run_id: str.
+    :param vcfanno_config: The vcfanno configuration file shared by the batch.
+    :type vcfanno_config: str.
+    :param regions: The panel regions BED file shared by the batch.
+    :type regions: str.
+    :param input_vcfs: Dictionary of sample name to snpEff annotated VCF file.
+    :type input_vcfs: dict.
+    :returns:  dict -- Dictionary of sample name to vcfanno annotated VCF file.
+    """
+
+    batch_samples = sorted(input_vcfs)
+    vcfs = [input_vcfs[sample] for sample in batch_samples]
+    output_vcfs = ["{}.vcfanno.snpEff.{}.vcf".format(sample, config['snpeff']['reference'])
+                   for sample in batch_samples]
+
+    batch_name = "{}.{}.{}".format(run_id, os.path.splitext(os.path.basename(vcfanno_config))[0],
+                                   os.path.splitext(os.path.basename(regions))[0])
+    combined_vcf = "{}.vcfanno_batch.vcf".format(batch_name)
+    annotated_vcf = "{}.vcfanno_batch.annotated.vcf".format(batch_name)
+    logfile = "{}.vcfanno_batch.log".format(batch_name)
+
+    combined_meta = combine_vcfs(vcfs, combined_vcf, sort=True)
+
+    if config['vcfanno'].get('slice_cache'):
+        vcfanno_config = annotation_slices.panel_config(vcfanno_config, regions, config['vcfanno']['slice_cache'],
+                                                        int(config['vcfanno'].get('slice_padding', 100)))
+        job.fileStore.logToMaster("Using panel-restricted vcfanno config {}\n".format(vcfanno_config))
+
+    vcfanno_command = ["{}".format(config['vcfanno']['bin']),
+                       "-p",
+                       "{}".format(config['vcfanno']['num_cores'])]
+    if config['vcfanno'].get('lua'):
+        vcfanno_command.extend(["--lua", "{}".format(config['vcfanno']['lua'])])
+    vcfanno_command.extend(["{}".format(vcfanno_config),
+                            "{}".format(combined_vcf),
+                            ">",
+                            "{}".format(annotated_vcf)])
+
+    job.fileStore.logToMaster("VCFAnno batch command for {} samples: {}\n".format(len(batch_samples),
+                                                                                   vcfanno_command))
+    pipeline.run_and_log_command(" ".join(vcfanno_command), logfile)
+
+    split_vcf(annotated_vcf, combined_meta, vcfs, output_vcfs)
+    os.remove(combined_vcf)
+    os.remove(annotated_vcf)
+
+    return dict(zip(batch_samples, output_vcfs))
+
+
+def vcfanno_batch(job, config, samples, input_vcfs):
+    """Group samples by vcfanno_config and panel regions and spawn one batched vcfanno job per group
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param input_vcfs: Dictionary of sample name to snpEff annotated VCF file.
+    :type input_vcfs: dict.
+    :returns:  list -- Promises for each group's dictionary of sample name to annotated VCF file.
+    """
+
+    groups = defaultdict(dict)
+    for sample in input_vcfs:
+        groups[(samples[sample]['vcfanno_config'], samples[sample]['regions'])][sample] = input_vcfs[sample]
+
+    run_id = samples_config.run_name(config, samples, input_vcfs)
+    results = list()
+    for vcfanno_config, regions in sorted(groups):
+        group = groups[(vcfanno_config, regions)]
+        job.fileStore.logToMaster("Batching {} samples for {}\n".format(len(group), vcfanno_config))
+        batch_job = job.addChildJobFn(vcfanno_config_batch, config, run_id, vcfanno_config, regions, group,
+                                      cores=int(config['vcfanno']['num_cores']),
+                                      memory="{}G".format(config['vcfanno']['max_mem']))
+        results.append(batch_job.rv())
+
+    return results
@@ -0,0 +1,303 @@
+import bisect
+import multiprocessing
+
+import numpy as np
+import pysam
+
+from collections import OrderedDict
+
+# Package methods
+import intervals
+import base_coverage
+
+
+DEFAULT_THRESHOLDS = (1, 20, 50, 100, 200, 500, 1000)
+# sambamba depth's default filter is "mapping_quality > 0 and not duplicate and not failed_quality_control";
+# unmapped reads are skipped as well since they have no aligned blocks
+SKIP_FLAGS = 0x4 | 0x200 | 0x400
+
+
+def coverage_thresholds(config):
+    if config.get('coverage_thresholds'):
+        return tuple(int(threshold) for threshold in config['coverage_thresholds'].split(','))
+
+    return DEFAULT_THRESHOLDS
+
+
+class DepthAccumulator(object):
+    """Per-target read counts and difference-array depth for any number of named region sets.
+
+    Targets are looked up per aligned block through starts sorted per contig plus a running maximum of ends,
+    so reads may arrive in any order (coordinate sorted BAMs or an aligner stream)."""
+
+    def __init__(self, region_sets, contigs=None):
+        self.region_sets = region_sets
+        self.targets = dict()
+        for set_name, targets in region_sets.items():
+            for index, (contig, start, end, name) in enumerate(targets):
+                if contigs is None or contig in contigs:
+                    self.targets.setdefault(contig, []).append((start, end, set_name, index))
+
+        self.starts = dict()
+        self.max_ends = dict()
+        self.diffs = dict()
+        self.reads = dict()
+        for contig, contig_targets in self.targets.items():
+            contig_targets.sort()
+            self.starts[contig] = [target[0] for target in contig_targets]
+            self.max_ends[contig] = np.maximum.accumulate([target[1] for target in contig_targets]).tolist()
+            for start, end, set_name, index in contig_targets:
+                self.diffs[(set_name, index)] = np.zeros(end - start + 1, dtype=np.int32)
+                self.reads[(set_name, index)] = 0
+
+    def add(self, read):
+        if read.flag & SKIP_FLAGS or read.mapping_quality == 0:
+            return
+        contig_targets = self.targets.get(read.reference_name)
+        if contig_targets is None:
+            return
+
+        starts = self.starts[read.reference_name]
+        max_ends = self.max_ends[read.reference_name]
+        read_start = read.reference_start
+        read_end = read.reference_end
+        last = bisect.bisect_left(starts, read_end) - 1
+        blocks = None
+        i = last
+        while i >= 0 and max_ends[i] > read_start:
+            start, end, set_name, index = contig_targets[i]
+            i -= 1
+            if end <= read_start:
+                continue
+            if blocks is None:
+                blocks = read.get_blocks()
+            diff = self.diffs[(set_name, index)]
+            counted = False
+            for block_start, block_end in blocks:
+                overlap_start = max(block_start, start)
+                overlap_end = min(block_end, end)
+                if overlap_start < overlap_end:
+                    diff[overlap_start - start] += 1
+                    diff[overlap_end - start] -= 1
+                    counted = True
+            if counted:
+                self.reads[(set_name, index)] += 1
+
+    def depth(self, set_name, index):
+        return np.cumsum(self.diffs[(set_name, index)][:-1])
+
+    def results(self):
+        """Return {(set name, target index): (read count, per-base depth array)}"""
+
+        return dict((key, (self.reads[key], np.cumsum(diff[:-1]).astype(np.int32)))
+                    for key, diff in self.diffs.items())
+
+
+def summarise(region_sets, results, thresholds):
+    """Return {set name: (read counts, mean depth, percent of bases at thresholds)} arrays in BED order"""
+
+    summaries = OrderedDict()
+    for set_name, targets in region_sets.items():
+        reads = np.zeros(len(targets), dtype=np.int64)
+        mean = np.zeros(len(targets), dtype=np.float64)
+        percent = np.zeros((len(targets), len(thresholds)), dtype=np.float64)
+        for index in range(len(targets)):
+            read_count, depth = results.get((set_name, index), (0, None))
+            reads[index] = read_count
+            if depth is not None and len(depth):
+                mean[index] = depth.mean()
+                percent[index] = [100.0 * (depth >= threshold).mean() for threshold in thresholds]
+        summaries[set_name] = (reads, mean, percent)
+
+    return summaries
+
+
+def contig_worker(arguments):
+    """Accumulate depth for one contig across all BAMs, fetching each merged target span once"""
+
+    bam_files, region_sets, contig = arguments
+    accumulator = DepthAccumulator(region_sets, set([contig]))
+    spans = intervals.IntervalIndex((target[:3] for targets in region_sets.values() for target in targets
+                                     if target[0] == contig)).intervals(contig)
+
+    for bam_file in bam_files:
+        bam = pysam.AlignmentFile(bam_file, 'rb')
+        previous_end = -1
+        for span_start, span_end in spans:
+            for read in bam.fetch(contig, span_start, span_end):
+                # Reads spanning two merged targets were already counted from the previous span
+                if read.reference_start < previous_end:
+                    continue
+                accumulator.add(read)
+            previous_end = span_end
+        bam.close()
+
+    return accumulator.results()
+
+
+def compute_coverage(bam_files, region_sets, processes=1):
+    """Compute per-target depth for region sets over one or more (pooled) indexed BAMs, in parallel by contig"""
+
+    contigs = sorted(set(target[0] for targets in region_sets.values() for target in targets))
+    work = [(bam_files, region_sets, contig) for contig in contigs]
+
+    results = dict()
+    if processes > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(min(processes, len(work)))
+        for contig_results in pool.imap_unordered(contig_worker, work):
+            results.update(contig_results)
+        pool.close()
+        pool.join()
+    else:
+        for item in work:
+            results.update(contig_worker(item))
+
+    return results
+
+
+def load_region_sets(named_beds):
+    """Read {set name: BED file} into {set name: [(contig, start, end, name), ...]} in BED order"""
+
+    return OrderedDict((set_name, list(intervals.read_bed(bed))) for set_name, bed in named_beds.items())
+
+
+def write_region_bed(output_file, targets, summary, thresholds, sample_name):
+    """Write per-target metrics in the sambamba region coverage BED layout read by process_sample_coverage"""
+
+    reads, mean, percent = summary
+    with open(output_file, 'w') as output:
+        output.write("# chrom\tchromStart\tchromEnd\tF3\treadCount\tmeanCoverage\t{}\tsampleName\n".format(
+            "\t".join("percentage{}".format(threshold) for threshold in thresholds)))
+        for index, (contig, start, end, name) in enumerate(targets):
+            output.write("{}\t{}\t{}\t{}\t{}\t{:.2f}\t{}\t{}\n".format(
+                contig, start, end, name, reads[index], mean[index],
+                "\t".join("{:.2f}".format(value) for value in percent[index]), sample_name))
+
+
+def write_binary(output_file, targets, summary, thresholds):
+    reads, mean, percent = summary
+    np.savez_compressed(output_file, names=np.array([target[3] for target in targets]),
+                        contigs=np.array([target[0] for target in targets]),
+                        starts=np.array([target[1] for target in targets], dtype=np.int64),
+                        ends=np.array([target[2] for target in targets], dtype=np.int64),
+                        reads=reads, mean=mean, percent=percent, thresholds=np.array(thresholds))
+
+
+def write_outputs(prefix, region_sets, results, thresholds, sample_name):
+    """Write <prefix>.<set>.coverage.bed/.npz per region set and return the coverage BED file names by set"""
+
+    outputs = OrderedDict()
+    for set_name, summary in summarise(region_sets, results, thresholds).items():
+        bed_file = "{}.{}.coverage.bed".format(prefix, set_name)
+        write_region_bed(bed_file, region_sets[set_name], summary, thresholds, sample_name)
+        write_binary("{}.{}.coverage.npz".format(prefix, set_name), region_sets[set_name], summary, thresholds)
+        outputs[set_name] = bed_file
+
+    return outputs
+
+
+def write_sample_outputs(library, region_sets, results, thresholds, contig_lengths=None,
+                         block_size=base_coverage.DEFAULT_BLOCK_SIZE):
+    """Write a library's panel coverage as {library}.sambamba_coverage.bed and {library}.coverage.npz, plus the
+    per-base depth as {library}.base_coverage.bcov when the BAM's (contig, length) pairs are given"""
+
+    summary = summarise(region_sets, results, thresholds)['regions']
+    output_bed = "{}.sambamba_coverage.bed".format(library)
+    write_region_bed(output_bed, region_sets['regions'], summary, thresholds, library)
+    write_binary("{}.coverage.npz".format(library), region_sets['regions'], summary, thresholds)
+    if contig_lengths is not None:
+        write_store(library, region_sets, results, contig_lengths, block_size)
+
+    return output_bed
+
+
+def write_store(library, region_sets, results, contig_lengths, block_size=base_coverage.DEFAULT_BLOCK_SIZE):
+    """Write the per-base depth of the 'regions' set as {library}.base_coverage.bcov"""
+
+    return base_coverage.write_target_store("{}.base_coverage.bcov".format(library), library, contig_lengths,
+                                            region_sets['regions'],
+                                            [results.get(('regions', index), (0, None))[1]
+                                             for index in range(len(region_sets['regions']))], block_size)
+
+
+def bam_contig_lengths(input_bam):
+    bam = pysam.AlignmentFile(input_bam, 'rb')
+    contig_lengths = list(zip(bam.references, bam.lengths))
+    bam.close()
+
+    return contig_lengths
+
+
+def region_coverage(job, config, sample, samples, input_bam):
+    """Compute per-amplicon coverage in-process, replacing sambamba.sambamba_region_coverage. The same pass
+    writes the base coverage store ({library}.base_coverage.bcov)
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param input_bam: The input, indexed BAM file.
+    :type input_bam: str.
+    :returns:  str -- The region coverage BED file name.
+    """
+
+    library = samples[sample]['library_name']
+    thresholds = coverage_thresholds(config)
+    region_sets = load_region_sets({'regions': samples[sample]['regions']})
+
+    job.fileStore.logToMaster("Computing coverage of {} targets for {}\n".format(len(region_sets['regions']),
+                                                                               input_bam))
+    results = compute_coverage([input_bam], region_sets, int(config['gatk']['num_cores']))
+
+    return write_sample_outputs(library, region_sets, results, thresholds, bam_contig_lengths(input_bam),
+                                int(config.get('base_coverage_block_size', base_coverage.DEFAULT_BLOCK_SIZE)))
+
+
+def base_coverage_store(job, config, sample, samples, input_bam):
+    """Write the base coverage store ({library}.base_coverage.bcov) for workflows without a region_coverage pass
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param input_bam: The input, indexed BAM file.
+    :type input_bam: str.
+    :returns:  str -- The base coverage store file name.
+    """
+
+    library = samples[sample]['library_name']
+    region_sets = load_region_sets({'regions': samples[sample]['regions']})
+
+    job.fileStore.logToMaster("Building base coverage store of {} targets for {}\n".format(
+        len(region_sets['regions']), input_bam))
+    results = compute_coverage([input_bam], region_sets, int(config['gatk']['num_cores']))
+
+    return write_store(library, region_sets, results, bam_contig_lengths(input_bam),
+                       int(config.get('base_coverage_block_size', base_coverage.DEFAULT_BLOCK_SIZE)))
+
+
+def pooled_region_coverage(job, config, sample, samples, region_keys, input_bams):
+    """Compute coverage of several region sets over pooled BAMs in one pass, replacing per-set sambamba runs
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param region_keys: Sample configuration keys of the region BED files to evaluate, e.g. snv_regions.
+    :type region_keys: list.
+    :param input_bams: The indexed BAM files pooled for this sample.
+    :type input_bams: list.
+    :returns:  dict -- Region coverage BED file names by region key.
+    """
+
+    thresholds = coverage_thresholds(config)
+    region_sets = load_region_sets(OrderedDict((key, samples[sample][key]) for key in region_keys))
+
+    job.fileStore.logToMaster("Computing coverage of {} region sets over {} for {}\n".format(
+        len(region_sets), ", ".join(input_bams), sample))
+    results = compute_coverage(input_bams, region_sets, int(config['gatk']['num_cores']))
+
+    return write_outputs(sample, region_sets, results, thresholds, sample)
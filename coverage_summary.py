@@ -0,0 +1,156 @@
+import os
+import csv
+import json
+
+import numpy as np
+
+from collections import defaultdict
+
+# Package methods
+import samples_config
+
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def read_region_coverage(coverage_file):
+    """Parse a sambamba region coverage BED into (amplicons, thresholds, metrics matrix).
+
+    Matrix columns are read count, mean coverage, then percent of bases covered at each threshold."""
+
+    with open(coverage_file, 'r') as coverage:
+        reader = csv.reader(coverage, delimiter='\t')
+        header = next(reader)
+        threshold_indices = list()
+        thresholds = list()
+        for index, element in enumerate(header):
+            if element.startswith("percentage"):
+                threshold_indices.append(index)
+                thresholds.append(int(element.replace('percentage', '')))
+
+        amplicons = list()
+        rows = list()
+        for row in reader:
+            amplicons.append(row[3])
+            rows.append([float(row[4]), float(row[5])] + [float(row[i]) for i in threshold_indices])
+
+    metrics = np.array(rows, dtype=np.float32).reshape(len(rows), 2 + len(thresholds))
+
+    return amplicons, thresholds, metrics
+
+
+def load_sample_coverage(job, config, sample, samples):
+    """Convert a sample's region coverage into a memory-mappable NumPy intermediate for run-level summaries
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :returns:  str -- The .npy intermediate file name (amplicon names and thresholds in a .json sidecar).
+    """
+
+    library = samples[sample]['library_name']
+    amplicons, thresholds, metrics = read_region_coverage("{}.sambamba_coverage.bed".format(library))
+
+    output = "{}.coverage_metrics.npy".format(library)
+    matrix = np.lib.format.open_memmap(output, mode='w+', dtype=np.float32, shape=metrics.shape)
+    matrix[:] = metrics
+    matrix.flush()
+    del matrix
+
+    with open("{}.json".format(output), 'w') as sidecar:
+        json.dump({'sample': sample, 'amplicons': amplicons, 'thresholds': thresholds,
+                   'regions': samples[sample]['regions'], 'run_id': samples[sample].get('run_id')}, sidecar)
+
+    job.fileStore.logToMaster("Stored coverage for {} amplicons of sample {}\n".format(len(amplicons), sample))
+
+    return output
+
+
+def summarize_panel(sample_names, amplicons, thresholds, matrix, min_depth):
+    """Return report sections for a samples x amplicons x metrics array"""
+
+    mean_coverage = matrix[:, :, 1]
+    failed = mean_coverage < min_depth
+    sample_failure_rate = failed.mean(axis=1)
+    amplicon_dropout = failed.mean(axis=0)
+    amplicon_percentiles = np.percentile(mean_coverage, PERCENTILES, axis=0).T
+    sample_percentiles = np.percentile(mean_coverage, PERCENTILES, axis=1).T
+    threshold_means = matrix[:, :, 2:].mean(axis=1)
+
+    run_lines = ["Samples\t{}".format(len(sample_names)),
+                 "Amplicons\t{}".format(len(amplicons)),
+                 "Minimum mean depth\t{}".format(min_depth),
+                 "Run amplicon failure rate\t{:.4f}".format(failed.mean()),
+                 "Amplicons failed in every sample\t{}".format(int((amplicon_dropout == 1.0).sum())),
+                 "Amplicons failed in any sample\t{}".format(int((amplicon_dropout > 0.0).sum()))]
+
+    percentile_header = "\t".join("P{}".format(p) for p in PERCENTILES)
+    sample_lines = ["Sample\tFailure Rate\t{}\t{}".format(
+        percentile_header, "\t".join("Mean % >= {}x".format(t) for t in thresholds))]
+    for i, sample in enumerate(sample_names):
+        sample_lines.append("{}\t{:.4f}\t{}\t{}".format(sample, sample_failure_rate[i],
+                                                       "\t".join("{:.1f}".format(v) for v in sample_percentiles[i]),
+                                                       "\t".join("{:.2f}".format(v) for v in threshold_means[i])))
+
+    amplicon_lines = ["Amplicon\tDropout Rate\tMean Reads\t{}".format(percentile_header)]
+    mean_reads = matrix[:, :, 0].mean(axis=0)
+    for order in np.argsort(-amplicon_dropout, kind='mergesort'):
+        amplicon_lines.append("{}\t{:.4f}\t{:.1f}\t{}".format(amplicons[order], amplicon_dropout[order],
+                                                             mean_reads[order],
+                                                             "\t".join("{:.1f}".format(v)
+                                                                       for v in amplicon_percentiles[order])))
+
+    return [("Run Summary", run_lines), ("Per Sample", sample_lines), ("Per Amplicon", amplicon_lines)]
+
+
+def summarize_run_coverage(job, config, sample_files):
+    """Stack all samples' coverage intermediates per panel and compute run-level coverage summaries
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample_files: Dictionary of sample name to the .npy intermediate from load_sample_coverage.
+    :type sample_files: dict.
+    :returns:  list -- The summary report file names.
+    """
+
+    min_depth = float(config.get('coverage_threshold', 20))
+    panels = defaultdict(list)
+    sample_info = dict()
+    for sample in sorted(sample_files):
+        with open("{}.json".format(sample_files[sample]), 'r') as sidecar:
+            info = json.load(sidecar)
+        panels[info['regions']].append((sample, sample_files[sample], info))
+        sample_info[sample] = info
+    run_id = samples_config.run_name(config, sample_info)
+
+    reports = list()
+    for regions in sorted(panels):
+        entries = panels[regions]
+        amplicons = entries[0][2]['amplicons']
+        thresholds = entries[0][2]['thresholds']
+        panel_name = os.path.splitext(os.path.basename(regions))[0]
+
+        matrix_file = "{}.{}.coverage_matrix.npy".format(run_id, panel_name)
+        first = np.load(entries[0][1], mmap_mode='r')
+        matrix = np.lib.format.open_memmap(matrix_file, mode='w+', dtype=np.float32,
+                                           shape=(len(entries),) + first.shape)
+        for i, (sample, sample_file, info) in enumerate(entries):
+            if info['amplicons'] != amplicons:
+                raise ValueError("Sample {} has a different amplicon set to the rest of panel {}".format(sample,
+                                                                                                     regions))
+            matrix[i] = np.load(sample_file, mmap_mode='r')
+        matrix.flush()
+
+        sections = summarize_panel([entry[0] for entry in entries], amplicons, thresholds, matrix, min_depth)
+        report = os.path.join("Reports", "{}.{}.coverage_summary.txt".format(run_id, panel_name))
+        with open(report, 'w') as output:
+            for title, lines in sections:
+                output.write("# {}\n{}\n\n".format(title, "\n".join(lines)))
+        reports.append(report)
+        del matrix
+
+        job.fileStore.logToMaster("Wrote coverage summary for {} samples on {} to {}\n".format(len(entries),
+                                                                                             panel_name, report))
+
+    return reports
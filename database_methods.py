@@ -1,3 +1,4 @@
+import os
 import csv
 import utils
 
@@ -79,6 +80,8 @@ def process_sample(job, addresses, keyspace, authenticator, parse_functions, sam
     vcf_parsing.parse_vcf("{}.scalpel.normalized.vcf".format(sample), "scalpel", caller_records)
     vcf_parsing.parse_vcf("{}.platypus.normalized.vcf".format(sample), "platypus", caller_records)
     vcf_parsing.parse_vcf("{}.pindel.normalized.vcf".format(sample), "pindel", caller_records)
+    if os.path.exists("{}.manta.normalized.vcf".format(sample)):
+        vcf_parsing.parse_vcf("{}.manta.normalized.vcf".format(sample), "manta", caller_records)
 
     annotated_vcf = "{}.vcfanno.snpEff.GRCh37.75.vcf".format(sample)
 
@@ -10,12 +10,13 @@ from toil.job import Job
 
 # Package methods
 from ddb import configuration
-from ddb_ngsflow import gatk
 from ddb_ngsflow import pipeline
-from ddb_ngsflow.rna import star
-from ddb_ngsflow.rna import bowtie
 from ddb_ngsflow.rna import cufflinks
 
+# Local methods
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import viral_partition
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -39,26 +40,14 @@ if __name__ == "__main__":
         # Alignment and Refinement Stages
         flags = ("keep_retained", "limit_bam_sort_ram", "cufflinks")
 
-        align_job = Job.wrapJobFn(star.star_unpaired, config, sample, samples, flags,
+        # One alignment against the combined host+viral index, partitioned into host and viral BAMs
+        align_job = Job.wrapJobFn(viral_partition.align_dual_reference, config, sample, samples, flags,
                                   cores=int(config['star']['num_cores']),
-                                  memory="{}G".format(config['star']['max_mem']))
-
-        samples[sample]['star'] = "{}.star.Aligned.sortedByCoord.out.bam".format(sample)
-        samples[sample]['unmapped_fastq'] = "{}.star.Unmapped.out.mate1".format(sample)
-
-        bowtie_job = Job.wrapJobFn(bowtie.bowtie_unpaired, config, sample, samples, flags,
-                                   cores=int(config['bowtie']['num_cores']),
-                                   memory="{}G".format(config['bowtie']['max_mem']))
-
-        samples[sample]['bowtie'] = "{}.bowtie.sam".format(sample)
-
-        input_bams = list()
-        input_bams.append(samples[sample]['star'])
-        input_bams.append(samples[sample]['bowtie'])
+                                  memory=viral_partition.job_memory(config))
 
-        merge_job = Job.wrapJobFn(gatk.merge_sam, config, sample, input_bams,
-                               cores=int(config['picard-merge']['num_cores']),
-                               memory="{}G".format(config['picard-merge']['max_mem']))
+        samples[sample]['host_bam'] = "{}.host.sorted.bam".format(sample)
+        samples[sample]['viral_bam'] = "{}.viral.sorted.bam".format(sample)
+        samples[sample]['viral_load'] = "{}.viral_load.txt".format(sample)
 
         working_dir = os.getcwd()
         samples[sample]['bam'] = os.path.join(working_dir, "{}.merged.sorted.bam".format(sample))
@@ -68,11 +57,8 @@ if __name__ == "__main__":
                                       memory="{}G".format(config['cufflinks']['max_mem']))
 
         # Create workflow from created jobs
-        # root_job.addChild(align_job)
-        # align_job.addChild(bowtie_job)
-        # bowtie_job.addChild(merge_job)
-        # merge_job.addChild(cufflinks_job)
-        root_job.addChild(cufflinks_job)
+        root_job.addChild(align_job)
+        align_job.addChild(cufflinks_job)
 
     cuffmerge_job = Job.wrapJobFn(cufflinks.cuffmerge, config, "blah", samples, "manifest.txt",
                                   cores=int(config['cuffmerge']['num_cores']),
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 # Standard packages
+import os
 import sys
 import argparse
 
@@ -12,6 +13,10 @@ from ddb import configuration
 from ddb_ngsflow import pipeline
 from ddb_ngsflow.coverage import sambamba
 
+# Local methods
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import coverage_engine
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -37,8 +42,15 @@ if __name__ == "__main__":
                                      cores=int(config['gatk']['num_cores']),
                                      memory="{}G".format(config['gatk']['max_mem']))
 
+        # Queryable per-base depth over the sample's regions, for reports
+        store_job = Job.wrapJobFn(coverage_engine.base_coverage_store, config, sample, samples,
+                                  "{}.recalibrated.sorted.bam".format(sample),
+                                  cores=int(config['gatk']['num_cores']),
+                                  memory="{}G".format(config['gatk']['max_mem']))
+
         # Create workflow from created jobs
         root_job.addChild(coverage_job)
+        root_job.addChild(store_job)
 
     # Start workflow execution
     Job.Runner.startToil(root_job, args)
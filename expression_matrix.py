@@ -0,0 +1,383 @@
+import os
+import json
+import multiprocessing
+
+import numpy as np
+
+# Package methods
+import samples_config
+import transcript_models
+
+
+# quant.sf columns: Name, Length, EffectiveLength, TPM, NumReads
+QUANT_COLUMNS = 5
+QUANT_VALUES = (('tpm', 3), ('counts', 4))
+
+
+def read_quant(quant_file):
+    """Return (transcript names, {value: float64 array}) from a salmon quant.sf file.
+
+    The file is split into tokens in one pass, so columns are strided slices rather than parsed lines."""
+
+    with open(quant_file, 'r') as quant:
+        quant.readline()
+        tokens = quant.read().split()
+    if len(tokens) % QUANT_COLUMNS:
+        raise ValueError("{} is not a {} column salmon quant.sf file".format(quant_file, QUANT_COLUMNS))
+
+    return tokens[0::QUANT_COLUMNS], dict((value, np.array(tokens[column::QUANT_COLUMNS], dtype=np.float64))
+                                          for value, column in QUANT_VALUES)
+
+
+def quant_file(config, sample, result):
+    """Locate a sample's quant.sf from the salmon job's return value (the quant.sf or its output directory),
+    or from salmon output_dir ({sample} is replaced by the sample name) when set. Nothing else is guessed"""
+
+    candidates = list()
+    if result:
+        result = "{}".format(result)
+        candidates.append(result if result.endswith("quant.sf") else os.path.join(result, "quant.sf"))
+    if config['salmon'].get('output_dir'):
+        candidates.append(os.path.join(config['salmon']['output_dir'].format(sample=sample), "quant.sf"))
+    if not candidates:
+        raise ValueError("The salmon job for sample {} returned no output and salmon output_dir is not "
+                         "configured, so its quant.sf cannot be located".format(sample))
+
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+
+    raise ValueError("No salmon quant.sf found for sample {} (tried {})".format(sample, ", ".join(candidates)))
+
+
+def fill_row(arguments):
+    """Worker: parse one quant.sf and write its values into row of each memory mapped matrix"""
+
+    row, quant, matrix_files, names = arguments
+    sample_names, values = read_quant(quant)
+    order = None
+    if sample_names != names:
+        positions = dict((name, i) for i, name in enumerate(sample_names))
+        missing = [name for name in names if name not in positions]
+        if missing:
+            raise ValueError("{} is missing {} transcripts, e.g. {}".format(quant, len(missing), missing[0]))
+        order = np.array([positions[name] for name in names], dtype=np.int64)
+
+    for value, matrix_file in matrix_files.items():
+        matrix = np.load(matrix_file, mmap_mode='r+')
+        matrix[row] = values[value] if order is None else values[value][order]
+        matrix.flush()
+        del matrix
+
+    return row
+
+
+def transcript_genes(config, transcripts):
+    """Map transcripts to genes with the transcript reference GTF, or salmon tx2gene (transcript, gene TSV)"""
+
+    mapping = dict()
+    if config['salmon'].get('tx2gene'):
+        with open(config['salmon']['tx2gene'], 'r') as tx2gene:
+            for line in tx2gene:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) > 1:
+                    mapping[fields[0]] = fields[1]
+    elif config.get('transcript_reference'):
+        models = transcript_models.load_models(config['transcript_reference'],
+                                               config.get('transcript_model_cache',
+                                                          os.path.join(os.getcwd(), "Intermediates",
+                                                                       "transcript_models")))
+        for index, transcript_id in enumerate(models.transcript_ids):
+            mapping[transcript_id] = models.gene(index)
+    else:
+        return None
+
+    # Transcripts missing from the mapping are kept as their own gene
+    return [mapping.get(transcript, transcript) for transcript in transcripts]
+
+
+def gene_matrix(transcript_file, gene_file, gene_index, num_genes, rows_per_chunk=64):
+    """Sum a samples x transcripts matrix into samples x genes, a block of samples at a time"""
+
+    transcripts = np.load(transcript_file, mmap_mode='r')
+    genes = np.lib.format.open_memmap(gene_file, mode='w+', dtype=np.float64,
+                                      shape=(transcripts.shape[0], num_genes))
+    for start in range(0, transcripts.shape[0], rows_per_chunk):
+        block = np.asarray(transcripts[start:start + rows_per_chunk])
+        for offset, row in enumerate(block):
+            genes[start + offset] = np.bincount(gene_index, weights=row, minlength=num_genes)
+    genes.flush()
+    del genes
+    del transcripts
+
+
+def build_salmon_matrices(config, quant_files, prefix, processes=1):
+    """Assemble samples x transcripts (and samples x genes) TPM and count matrices as .npy files.
+
+    Writes <prefix>.transcript_<value>.npy, <prefix>.gene_<value>.npy and a <prefix>.json index of sample,
+    transcript and gene names. Returns the .json file name."""
+
+    samples = sorted(quant_files)
+    names, _ = read_quant(quant_files[samples[0]])
+
+    matrix_files = dict()
+    for value, _ in QUANT_VALUES:
+        matrix_files[value] = "{}.transcript_{}.npy".format(prefix, value)
+        matrix = np.lib.format.open_memmap(matrix_files[value], mode='w+', dtype=np.float64,
+                                           shape=(len(samples), len(names)))
+        del matrix
+
+    work = [(row, quant_files[sample], matrix_files, names) for row, sample in enumerate(samples)]
+    if processes > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(min(processes, len(work)))
+        for _ in pool.imap_unordered(fill_row, work):
+            pass
+        pool.close()
+        pool.join()
+    else:
+        for item in work:
+            fill_row(item)
+
+    index = {'samples': samples, 'transcripts': names, 'genes': None,
+             'transcript_matrices': matrix_files, 'gene_matrices': None}
+
+    genes = transcript_genes(config, names)
+    if genes is not None:
+        gene_names = sorted(set(genes))
+        positions = dict((gene, i) for i, gene in enumerate(gene_names))
+        gene_index = np.array([positions[gene] for gene in genes], dtype=np.int64)
+        index['genes'] = gene_names
+        index['gene_matrices'] = dict()
+        for value, transcript_file in matrix_files.items():
+            gene_file = "{}.gene_{}.npy".format(prefix, value)
+            gene_matrix(transcript_file, gene_file, gene_index, len(gene_names))
+            index['gene_matrices'][value] = gene_file
+
+    index_file = "{}.json".format(prefix)
+    with open(index_file, 'w') as output:
+        json.dump(index, output)
+
+    return index_file
+
+
+def salmon_expression_matrix(job, config, samples, quant_results):
+    """Merge every sample's salmon quantification into run-level expression matrices
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param quant_results: Dictionary of sample name to the salmon job's return value.
+    :type quant_results: dict.
+    :returns:  str -- The matrix index (.json) file name.
+    """
+
+    quant_files = dict((sample, quant_file(config, sample, result)) for sample, result in quant_results.items())
+    prefix = "{}.salmon".format(samples_config.run_name(config, samples, quant_results))
+
+    job.fileStore.logToMaster("Building salmon expression matrices for {} samples\n".format(len(quant_files)))
+    index_file = build_salmon_matrices(config, quant_files, prefix, int(config['salmon']['num_cores']))
+
+    return index_file
+
+
+# StringTie transcript attributes kept in the sparse matrices
+STRINGTIE_VALUES = ('cov', 'FPKM', 'TPM')
+# Only the abundance measures add up over a gene's transcripts; cov is a per-base depth of one transcript
+STRINGTIE_GENE_VALUES = ('FPKM', 'TPM')
+
+
+def read_stringtie_gtf(gtf_file):
+    """Return (transcript ids, gene ids, {value: float64 array}) from the transcript lines of a StringTie GTF"""
+
+    transcripts = list()
+    genes = list()
+    values = dict((value, list()) for value in STRINGTIE_VALUES)
+    with open(gtf_file, 'r') as gtf:
+        for line in gtf:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] != 'transcript':
+                continue
+            attributes = transcript_models.parse_attributes(fields[8])
+            transcripts.append(attributes['transcript_id'])
+            genes.append(attributes.get('gene_id', attributes['transcript_id']))
+            for value in STRINGTIE_VALUES:
+                values[value].append(attributes.get(value, 0))
+
+    return transcripts, genes, dict((value, np.array(column, dtype=np.float64)) for value, column in values.items())
+
+
+def stringtie_gtf(config, sample, result):
+    """Locate a sample's re-quantified StringTie GTF from the job's return value or the configured name"""
+
+    candidates = list()
+    if isinstance(result, str):
+        candidates.append(result)
+    candidates.append(config['stringtie'].get('output_gtf', "{sample}.stringtie.gtf").format(sample=sample))
+    for candidate in candidates:
+        if os.path.isfile(candidate) and candidate.endswith(".gtf"):
+            return candidate
+
+    raise ValueError("No StringTie GTF found for sample {} (tried {})".format(sample, ", ".join(candidates)))
+
+
+class SparseColumnWriter(object):
+    """Append sample columns to a CSR store of samples x features with one data file per value.
+
+    Rows of the CSR store are the columns of the features x samples matrix, so each sample is written once
+    and read back on its own. The non-zero pattern is shared by all values."""
+
+    def __init__(self, prefix, values):
+        self.prefix = prefix
+        self.values = values
+        self.features = list()
+        self.feature_index = dict()
+        self.samples = list()
+        self.indptr = [0]
+        self.indices = open("{}.indices".format(prefix), 'wb')
+        self.data = dict((value, open("{}.{}.data".format(prefix, value), 'wb')) for value in values)
+
+    def add(self, sample, features, columns):
+        """Add one sample's column. features are names and columns a {value: array} aligned with them"""
+
+        positions = list()
+        for feature in features:
+            if feature not in self.feature_index:
+                self.feature_index[feature] = len(self.features)
+                self.features.append(feature)
+            positions.append(self.feature_index[feature])
+        positions = np.array(positions, dtype=np.int32)
+
+        nonzero = np.zeros(len(positions), dtype=bool)
+        for value in self.values:
+            nonzero |= columns[value] != 0
+        order = np.argsort(positions[nonzero], kind='mergesort')
+
+        positions[nonzero][order].tofile(self.indices)
+        for value in self.values:
+            columns[value][nonzero][order].astype(np.float64).tofile(self.data[value])
+        self.samples.append(sample)
+        self.indptr.append(self.indptr[-1] + int(nonzero.sum()))
+
+    def close(self):
+        self.indices.close()
+        for handle in self.data.values():
+            handle.close()
+        np.save("{}.indptr.npy".format(self.prefix), np.array(self.indptr, dtype=np.int64))
+        index_file = "{}.json".format(self.prefix)
+        with open(index_file, 'w') as output:
+            json.dump({'format': 'csr', 'orientation': 'samples x features', 'samples': self.samples,
+                       'features': self.features, 'values': list(self.values), 'indices_dtype': 'int32',
+                       'data_dtype': 'float64'}, output)
+
+        return index_file
+
+
+class SparseExpression(object):
+    """Lazy accessor for a SparseColumnWriter store. Nothing is read until a column is requested, and columns
+    are sliced from memory mapped indices and data"""
+
+    def __init__(self, index_file):
+        with open(index_file, 'r') as index:
+            info = json.load(index)
+        self.prefix = os.path.splitext(index_file)[0]
+        self.samples = info['samples']
+        self.features = info['features']
+        self.values = info['values']
+        self.sample_index = dict((sample, i) for i, sample in enumerate(self.samples))
+        self.feature_index = dict((feature, i) for i, feature in enumerate(self.features))
+        self.indptr = np.load("{}.indptr.npy".format(self.prefix))
+        self._indices = None
+        self._data = dict()
+
+    @property
+    def shape(self):
+        return len(self.features), len(self.samples)
+
+    def indices(self):
+        if self._indices is None:
+            self._indices = np.memmap("{}.indices".format(self.prefix), dtype=np.int32, mode='r') \
+                if self.indptr[-1] else np.zeros(0, dtype=np.int32)
+        return self._indices
+
+    def data(self, value):
+        if value not in self._data:
+            if value not in self.values:
+                raise KeyError("{} has no {} values (has {})".format(self.prefix, value, ", ".join(self.values)))
+            self._data[value] = np.memmap("{}.{}.data".format(self.prefix, value), dtype=np.float64, mode='r') \
+                if self.indptr[-1] else np.zeros(0, dtype=np.float64)
+        return self._data[value]
+
+    def sparse_column(self, sample, value):
+        """Return (feature positions, values) of a sample's non-zero entries"""
+
+        row = self.sample_index[sample]
+        start, end = self.indptr[row], self.indptr[row + 1]
+
+        return np.asarray(self.indices()[start:end]), np.asarray(self.data(value)[start:end])
+
+    def column(self, sample, value):
+        """Dense vector of one value over all features for a sample"""
+
+        positions, values = self.sparse_column(sample, value)
+        dense = np.zeros(len(self.features), dtype=np.float64)
+        dense[positions] = values
+
+        return dense
+
+    def columns(self, samples, value):
+        """Dense features x samples matrix for the given samples"""
+
+        return np.column_stack([self.column(sample, value) for sample in samples]) if samples \
+            else np.zeros((len(self.features), 0))
+
+    def get(self, feature, sample, value):
+        positions, values = self.sparse_column(sample, value)
+        found = np.searchsorted(positions, self.feature_index[feature])
+        if found < len(positions) and positions[found] == self.feature_index[feature]:
+            return float(values[found])
+        return 0.0
+
+
+def build_stringtie_matrices(gtf_files, prefix):
+    """Stream every sample's StringTie GTF into sparse transcripts x samples and genes x samples stores.
+
+    Gene FPKM and TPM are sums over each gene's transcripts; cov is kept for transcripts only. Returns {'transcripts': index, 'genes': index}."""
+
+    transcript_writer = SparseColumnWriter("{}.transcripts".format(prefix), STRINGTIE_VALUES)
+    gene_writer = SparseColumnWriter("{}.genes".format(prefix), STRINGTIE_GENE_VALUES)
+
+    for sample in sorted(gtf_files):
+        transcripts, genes, values = read_stringtie_gtf(gtf_files[sample])
+        transcript_writer.add(sample, transcripts, values)
+
+        gene_names = sorted(set(genes))
+        positions = dict((gene, i) for i, gene in enumerate(gene_names))
+        gene_index = np.array([positions[gene] for gene in genes], dtype=np.int64)
+        gene_writer.add(sample, gene_names,
+                        dict((value, np.bincount(gene_index, weights=values[value], minlength=len(gene_names)))
+                             for value in STRINGTIE_GENE_VALUES))
+
+    return {'transcripts': transcript_writer.close(), 'genes': gene_writer.close()}
+
+
+def stringtie_expression_matrix(job, config, samples, quant_results):
+    """Merge every sample's StringTie re-quantification into run-level sparse expression matrices
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param quant_results: Dictionary of sample name to the StringTie job's return value.
+    :type quant_results: dict.
+    :returns:  dict -- Matrix index (.json) file names for transcripts and genes.
+    """
+
+    gtf_files = dict((sample, stringtie_gtf(config, sample, result)) for sample, result in quant_results.items())
+    prefix = "{}.stringtie".format(samples_config.run_name(config, samples, quant_results))
+
+    job.fileStore.logToMaster("Building sparse StringTie expression matrices for {} samples\n".format(
+        len(gtf_files)))
+    index_files = build_stringtie_matrices(gtf_files, prefix)
+
+    return index_files
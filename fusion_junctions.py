@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+# Standard packages
+import os
+import bisect
+import argparse
+
+from collections import defaultdict
+
+# Package methods
+import samples_config
+import transcript_models
+
+
+# Chimeric.out.junction columns: donor contig, base after the donor, strand, acceptor contig, base before the
+# acceptor, strand, junction type (-1 spanning mate pair, 0-2 split read). Spanning pair records do not give the
+# junction: their donor position is where the donor mate's alignment ends, upstream of the donor breakpoint in
+# transcript orientation, and their acceptor position where the acceptor mate's starts, downstream of it
+BREAKPOINT_COLUMNS = 7
+SUMMARY_HEADER = ("Donor", "Donor Position", "Donor Strand", "Acceptor", "Acceptor Position", "Acceptor Strand",
+                  "Split Reads", "Spanning Pairs")
+
+
+def fusion_settings(config):
+    settings = config.get('fusion', dict())
+
+    return {'window': int(settings.get('cluster_window', 10)),
+            'spanning_window': int(settings.get('spanning_window', 1000)),
+            'min_split_reads': int(settings.get('min_split_reads', 2)),
+            'min_support': int(settings.get('min_support', 3)),
+            'keep_intragenic': str(settings.get('keep_intragenic', 'false')).lower() in ('true', 'yes', '1')}
+
+
+def read_junctions(junction_file):
+    """Yield (breakpoint, is_split_read) from a STAR Chimeric.out.junction file, one line at a time"""
+
+    with open(junction_file, 'r') as junctions:
+        for line in junctions:
+            if line.startswith(('#', 'chr_donorA')):
+                continue
+            fields = line.split('\t', BREAKPOINT_COLUMNS)
+            if len(fields) < BREAKPOINT_COLUMNS:
+                continue
+            yield (fields[0], int(fields[1]), fields[2], fields[3], int(fields[4]), fields[5]), \
+                int(fields[6]) >= 0
+
+
+def summarise_junctions(junction_file):
+    """Count split reads and spanning pairs per exact breakpoint"""
+
+    support = defaultdict(lambda: [0, 0])
+    for breakpoint, split in read_junctions(junction_file):
+        support[breakpoint][0 if split else 1] += 1
+
+    return support
+
+
+def write_summary(support, output_file):
+    with open(output_file, 'w') as output:
+        output.write("{}\n".format("\t".join(SUMMARY_HEADER)))
+        for breakpoint in sorted(support):
+            output.write("{}\t{}\t{}\n".format("\t".join(str(field) for field in breakpoint), support[breakpoint][0],
+                                               support[breakpoint][1]))
+
+
+def read_summary(summary_file):
+    with open(summary_file, 'r') as summary:
+        summary.readline()
+        for line in summary:
+            fields = line.rstrip('\n').split('\t')
+            yield (fields[0], int(fields[1]), fields[2], fields[3], int(fields[4]), fields[5]), \
+                int(fields[6]), int(fields[7])
+
+
+def sweep(entries, position, window):
+    """Group entries sorted by position(entry) into runs whose neighbouring positions are within window"""
+
+    group = list()
+    for entry in entries:
+        if group and position(entry) - position(group[-1]) > window:
+            yield group
+            group = list()
+        group.append(entry)
+    if group:
+        yield group
+
+
+def upstream_distance(position, breakpoint_position, strand):
+    """How far position lies upstream of a breakpoint in transcript orientation (negative when downstream)"""
+
+    return breakpoint_position - position if strand == '+' else position - breakpoint_position
+
+
+def attach_spanning(clusters, spanning, window):
+    """Add each spanning pair to the nearest split read cluster of its partition whose representative junction
+    lies downstream of the donor mate and upstream of the acceptor mate, both within window. Pairs matching
+    no cluster give no junction position of their own and are dropped"""
+
+    representatives = defaultdict(list)
+    for number, cluster in enumerate(clusters):
+        breakpoint = max(cluster, key=lambda entry: entry[2])[1]
+        representatives[(breakpoint[0], breakpoint[2], breakpoint[3], breakpoint[5])].append(
+            (breakpoint[1], breakpoint, number))
+    for candidates in representatives.values():
+        candidates.sort()
+
+    attached = 0
+    for entry in spanning:
+        mates = entry[1]
+        candidates = representatives.get((mates[0], mates[2], mates[3], mates[5]), ())
+        positions = [candidate[0] for candidate in candidates]
+        best = None
+        for donor_position, breakpoint, number in candidates[bisect.bisect_left(positions, mates[1] - window):
+                                                             bisect.bisect_right(positions, mates[1] + window)]:
+            donor_gap = upstream_distance(mates[1], donor_position, breakpoint[2])
+            acceptor_gap = -upstream_distance(mates[4], breakpoint[4], breakpoint[5])
+            if 0 <= donor_gap <= window and 0 <= acceptor_gap <= window:
+                if best is None or donor_gap + acceptor_gap < best[0]:
+                    best = (donor_gap + acceptor_gap, number)
+        if best is not None:
+            clusters[best[1]].append(entry)
+            attached += 1
+
+    return attached
+
+
+def cluster_breakpoints(summaries, window, spanning_window=1000):
+    """Cluster every sample's split read breakpoints across the run with a sort-based sweep, then attach
+    spanning pairs to the clusters they support.
+
+    Breakpoints are partitioned by contig and strand pair, swept on donor position, and each donor group is
+    swept again on acceptor position. Returns clusters as lists of (sample, breakpoint, split, spanning)."""
+
+    partitions = defaultdict(list)
+    spanning = list()
+    for sample, summary_file in summaries.items():
+        for breakpoint, split, spanning_pairs in read_summary(summary_file):
+            if split:
+                partitions[(breakpoint[0], breakpoint[2], breakpoint[3], breakpoint[5])].append(
+                    (sample, breakpoint, split, 0))
+            if spanning_pairs:
+                spanning.append((sample, breakpoint, 0, spanning_pairs))
+
+    clusters = list()
+    for key in sorted(partitions):
+        entries = sorted(partitions[key], key=lambda entry: entry[1][1])
+        for donor_group in sweep(entries, lambda entry: entry[1][1], window):
+            donor_group.sort(key=lambda entry: entry[1][4])
+            clusters.extend(sweep(donor_group, lambda entry: entry[1][4], window))
+
+    attach_spanning(clusters, spanning, spanning_window)
+
+    return clusters
+
+
+class GeneLookup(object):
+    """Gene names at a position from the cached transcript model store, memoised per position"""
+
+    def __init__(self, models):
+        self.models = models
+        self.cache = dict()
+
+    def genes(self, contig, position):
+        key = (contig, position)
+        if key not in self.cache:
+            if self.models is None:
+                self.cache[key] = ()
+            else:
+                indices = self.models.overlapping(contig, position - 1, position)
+                self.cache[key] = tuple(sorted(set(self.models.gene_name(index) for index in indices.tolist())))
+        return self.cache[key]
+
+
+def describe_cluster(cluster, lookup):
+    """Representative breakpoint (most split reads), partner genes and per-sample support"""
+
+    per_sample = defaultdict(lambda: [0, 0])
+    for sample, breakpoint, split, spanning in cluster:
+        per_sample[sample][0] += split
+        per_sample[sample][1] += spanning
+    breakpoint = max(cluster, key=lambda entry: entry[2])[1]
+    donor_genes = lookup.genes(breakpoint[0], breakpoint[1])
+    acceptor_genes = lookup.genes(breakpoint[3], breakpoint[4])
+
+    return {'breakpoint': breakpoint, 'donor_genes': donor_genes, 'acceptor_genes': acceptor_genes,
+            'samples': dict((sample, tuple(counts)) for sample, counts in per_sample.items())}
+
+
+def passes(candidate, sample, settings):
+    split, spanning = candidate['samples'][sample]
+    if split < settings['min_split_reads'] or split + spanning < settings['min_support']:
+        return False
+    if not settings['keep_intragenic'] and set(candidate['donor_genes']) & set(candidate['acceptor_genes']):
+        return False
+
+    return True
+
+
+def fusion_name(candidate):
+    return "{}--{}".format(",".join(candidate['donor_genes']) or ".", ",".join(candidate['acceptor_genes']) or ".")
+
+
+def write_candidates(candidates, summaries, settings, prefix):
+    """Write {sample}.fusion_candidates.txt for each sample and <prefix>.fusion_candidates.txt for the run"""
+
+    header = ["Fusion", "Donor", "Donor Position", "Donor Strand", "Acceptor", "Acceptor Position",
+              "Acceptor Strand"]
+    sample_rows = defaultdict(list)
+    run_file = "{}.fusion_candidates.txt".format(prefix)
+    with open(run_file, 'w') as output:
+        output.write("{}\n".format("\t".join(header + ["Samples", "Split Reads", "Spanning Pairs", "Support"])))
+        for candidate in candidates:
+            passing = sorted(sample for sample in candidate['samples'] if passes(candidate, sample, settings))
+            if not passing:
+                continue
+            fields = [fusion_name(candidate)] + [str(field) for field in candidate['breakpoint']]
+            output.write("{}\t{}\t{}\t{}\t{}\n".format(
+                "\t".join(fields), len(passing), sum(candidate['samples'][sample][0] for sample in passing),
+                sum(candidate['samples'][sample][1] for sample in passing),
+                ",".join("{}:{}/{}".format(sample, *candidate['samples'][sample]) for sample in passing)))
+            for sample in passing:
+                sample_rows[sample].append(fields + [str(count) for count in candidate['samples'][sample]] +
+                                           [str(len(passing))])
+
+    for sample in summaries:
+        with open("{}.fusion_candidates.txt".format(sample), 'w') as output:
+            output.write("{}\n".format("\t".join(header + ["Split Reads", "Spanning Pairs", "Run Samples"])))
+            for row in sorted(sample_rows[sample], key=lambda row: -int(row[-3])):
+                output.write("{}\n".format("\t".join(row)))
+
+    return run_file
+
+
+def find_fusions(summaries, settings, models=None, prefix="run"):
+    lookup = GeneLookup(models)
+    candidates = [describe_cluster(cluster, lookup)
+                  for cluster in cluster_breakpoints(summaries, settings['window'], settings['spanning_window'])]
+
+    return write_candidates(candidates, summaries, settings, prefix)
+
+
+def chimeric_breakpoints(job, config, sample):
+    """Stream a sample's STAR chimeric junctions into per-breakpoint split read and spanning pair counts
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :returns:  str -- The breakpoint summary file name.
+    """
+
+    junction_file = "{}.star.Chimeric.out.junction".format(sample)
+    summary_file = "{}.chimeric_breakpoints.txt".format(sample)
+
+    job.fileStore.logToMaster("Summarising chimeric junctions in {}\n".format(junction_file))
+    write_summary(summarise_junctions(junction_file), summary_file)
+
+    return summary_file
+
+
+def fusion_candidates(job, config, samples, summaries):
+    """Cluster breakpoints across the run, annotate partner genes and report fusion candidates
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param summaries: Dictionary of sample name to breakpoint summary file.
+    :type summaries: dict.
+    :returns:  str -- The run level fusion candidates file name.
+    """
+
+    models = None
+    if config.get('transcript_reference'):
+        models = transcript_models.load_models(config['transcript_reference'],
+                                               config.get('transcript_model_cache',
+                                                          os.path.join(os.getcwd(), "Intermediates",
+                                                                       "transcript_models")))
+
+    job.fileStore.logToMaster("Clustering chimeric breakpoints across {} samples\n".format(len(summaries)))
+    run_file = find_fusions(summaries, fusion_settings(config), models,
+                            samples_config.run_name(config, samples, summaries))
+
+    return run_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report fusion candidates from STAR chimeric junction files")
+    parser.add_argument('-j', '--junctions', nargs='+', help="sample=Chimeric.out.junction pairs")
+    parser.add_argument('-g', '--gtf', help="Transcript annotation GTF for partner genes")
+    parser.add_argument('-c', '--cache_dir', default=os.path.join("Intermediates", "transcript_models"),
+                        help="Directory holding cached transcript model stores")
+    parser.add_argument('-o', '--output', default="run", help="Prefix of the run level report")
+    parser.add_argument('-w', '--window', type=int, default=10, help="Breakpoint clustering window")
+    parser.add_argument('-p', '--spanning_window', type=int, default=1000,
+                        help="Maximum distance from a spanning pair's mates to the junction they support")
+    parser.add_argument('-m', '--min_split_reads', type=int, default=2, help="Minimum split reads per sample")
+    parser.add_argument('-s', '--min_support', type=int, default=3, help="Minimum supporting reads per sample")
+    args = parser.parse_args()
+
+    sample_summaries = dict()
+    for pair in args.junctions:
+        name, junctions = pair.split('=', 1)
+        sample_summaries[name] = "{}.chimeric_breakpoints.txt".format(name)
+        write_summary(summarise_junctions(junctions), sample_summaries[name])
+
+    transcript_store = transcript_models.load_models(args.gtf, args.cache_dir) if args.gtf else None
+    find_fusions(sample_summaries, {'window': args.window, 'spanning_window': args.spanning_window,
+                                    'min_split_reads': args.min_split_reads,
+                                    'min_support': args.min_support, 'keep_intragenic': False},
+                 transcript_store, args.output)
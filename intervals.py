@@ -0,0 +1,141 @@
+import os
+import bisect
+import pickle
+import hashlib
+import tempfile
+
+from collections import defaultdict
+
+
+def read_bed(bed_file):
+    """Yield (contig, start, end, name) tuples from a BED file, skipping headers and track lines"""
+
+    with open(bed_file, 'r') as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            name = fields[3] if len(fields) > 3 else "{}:{}-{}".format(fields[0], fields[1], fields[2])
+            yield fields[0], int(fields[1]), int(fields[2]), name
+
+
+def file_checksum(path, block_size=1 << 20):
+    """Return the SHA1 hex digest of a file, read in blocks"""
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        block = handle.read(block_size)
+        while block:
+            digest.update(block)
+            block = handle.read(block_size)
+
+    return digest.hexdigest()
+
+
+class IntervalIndex(object):
+    """Sorted, merged per-contig intervals (0-based, half-open) supporting O(log n) overlap queries"""
+
+    def __init__(self, intervals, padding=0):
+        by_contig = defaultdict(list)
+        for contig, start, end in intervals:
+            by_contig[contig].append((max(0, start - padding), end + padding))
+
+        self.starts = dict()
+        self.ends = dict()
+        for contig, contig_intervals in by_contig.items():
+            contig_intervals.sort()
+            starts = list()
+            ends = list()
+            for start, end in contig_intervals:
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[contig] = starts
+            self.ends[contig] = ends
+
+    @classmethod
+    def from_bed(cls, bed_file, padding=0):
+        return cls(((contig, start, end) for contig, start, end, name in read_bed(bed_file)), padding)
+
+    def contigs(self):
+        return list(self.starts.keys())
+
+    def intervals(self, contig):
+        return list(zip(self.starts.get(contig, []), self.ends.get(contig, [])))
+
+    def overlaps(self, contig, start, end):
+        """Return True if [start, end) overlaps any interval on contig"""
+
+        starts = self.starts.get(contig)
+        if not starts:
+            return False
+        i = bisect.bisect_left(starts, end) - 1
+
+        return i >= 0 and self.ends[contig][i] > start
+
+    def sweep(self):
+        return IntervalSweep(self)
+
+
+class IntervalSweep(object):
+    """Overlap queries against an IntervalIndex for coordinate-sorted input.
+
+    A cursor per contig only moves forward, so each query costs amortised O(1). Queries that arrive out of
+    order (e.g. name-sorted aligner output) fall back to a binary search without disturbing the cursor."""
+
+    def __init__(self, index):
+        self.index = index
+        self.contig = None
+        self.cursor = 0
+        self.last_start = -1
+
+    def overlaps(self, contig, start, end):
+        if contig != self.contig:
+            self.contig = contig
+            self.cursor = 0
+            self.last_start = -1
+
+        if start < self.last_start:
+            return self.index.overlaps(contig, start, end)
+        self.last_start = start
+
+        starts = self.index.starts.get(contig)
+        if not starts:
+            return False
+        ends = self.index.ends[contig]
+        while self.cursor < len(ends) and ends[self.cursor] <= start:
+            self.cursor += 1
+
+        return self.cursor < len(starts) and starts[self.cursor] < end
+
+
+def load_index(bed_file, cache_dir, padding=0):
+    """Load the IntervalIndex for a panel BED file, building and caching it on disk on first use.
+
+    The cache key is the checksum of the BED contents plus padding, so an edited panel file is never served a
+    stale index. Indexes are written to a temporary file and renamed so concurrent jobs can share a cache."""
+
+    key = "{}.{}.p{}".format(os.path.basename(bed_file), file_checksum(bed_file)[:16], padding)
+    cache_file = os.path.join(cache_dir, "{}.idx".format(key))
+
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as cached:
+            return pickle.load(cached)
+
+    index = IntervalIndex.from_bed(bed_file, padding)
+
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+    handle, temp_file = tempfile.mkstemp(dir=cache_dir, prefix=key)
+    with os.fdopen(handle, 'wb') as temp:
+        pickle.dump(index, temp, 2)
+    os.rename(temp_file, cache_file)
+
+    return index
@@ -0,0 +1,158 @@
+import os
+import re
+import shutil
+
+# Package methods
+import shell_commands
+import samples_config
+from ddb_ngsflow import pipeline
+
+
+LANE_RE = re.compile(r'_L(\d{3})_R[12]_')
+
+
+def lane_pairs(sample_config):
+    """Return [(lane, fastq1, fastq2), ...] from a sample's comma separated fastq1 and fastq2 lists.
+    Lanes are taken from Illumina file names (_L001_) and otherwise numbered in list order"""
+
+    fastq1s = [fastq.strip() for fastq in sample_config['fastq1'].split(',') if fastq.strip()]
+    fastq2s = [fastq.strip() for fastq in sample_config['fastq2'].split(',') if fastq.strip()]
+    if len(fastq1s) != len(fastq2s):
+        raise ValueError("Library {} has {} read 1 and {} read 2 FASTQ files".format(
+            sample_config.get('library_name'), len(fastq1s), len(fastq2s)))
+
+    pairs = list()
+    for number, (fastq1, fastq2) in enumerate(zip(fastq1s, fastq2s), 1):
+        match = LANE_RE.search(os.path.basename(fastq1))
+        pairs.append((match.group(1) if match else "{:03d}".format(number), fastq1, fastq2))
+
+    return pairs
+
+
+def link_or_copy(source, destination):
+    """Hard link source to destination, copying when they are on different file systems. The source is left in
+    place, so a retried job can repeat this"""
+
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def read_group(config, sample, samples, lane):
+    """Lane specific read group: one ID and platform unit per lane, shared sample and library"""
+
+    library = samples[sample].get('library_name', sample)
+
+    return "@RG\\tID:{lib}.L{lane}\\tSM:{sample}\\tLB:{lib}\\tPL:illumina\\tPU:{run}.L{lane}".format(
+        lib=library, lane=lane, sample=samples[sample].get('sample_name', sample),
+        run=samples_config.run_name(config, samples, [sample]))
+
+
+def run_bwa_mem_lane(job, config, sample, samples, lane, fastq1, fastq2):
+    """Align and coordinate sort a single lane of a library with BWA-MEM and a lane read group
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param lane: The lane number, e.g. 001.
+    :type lane: str.
+    :param fastq1: The lane's read 1 FASTQ file.
+    :type fastq1: str.
+    :param fastq2: The lane's read 2 FASTQ file.
+    :type fastq2: str.
+    :returns:  str -- The lane's sorted BAM file name.
+    """
+
+    output_bam = "{}.L{}.bwa.sorted.bam".format(sample, lane)
+    temp = "{}.L{}.bwa.sort.temp".format(sample, lane)
+    logfile = "{}.L{}.bwa-align.log".format(sample, lane)
+
+    bwa_cmd = ["{}".format(config['bwa']['bin']),
+               "mem",
+               "-t", "{}".format(config['bwa']['num_cores']),
+               "-M", "-v", "2",
+               "-R", "'{}'".format(read_group(config, sample, samples, lane)),
+               "{}".format(config['reference']),
+               "{}".format(fastq1),
+               "{}".format(fastq2)]
+
+    sort_cmd = ["{}".format(config['samtools']['bin']),
+                "sort",
+                "-@", "{}".format(config['bwa']['num_cores']),
+                "-O", "bam",
+                "-o", "{}".format(output_bam),
+                "-T", "{}".format(temp),
+                "-"]
+
+    command = shell_commands.pipefail("{} | {}".format(" ".join(bwa_cmd), " ".join(sort_cmd)))
+
+    job.fileStore.logToMaster("BWA Command: {}\n".format(command))
+    pipeline.run_and_log_command(command, logfile)
+
+    return output_bam
+
+
+def spawn_lane_alignments(job, config, sample, samples):
+    """Align every lane of a library as its own job. Add merge_lane_bams as this job's follow-on, passing it
+    this job's return value
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :returns:  list -- Promises for the per-lane sorted BAM files.
+    """
+
+    lane_bams = list()
+    for lane, fastq1, fastq2 in lane_pairs(samples[sample]):
+        lane_job = job.addChildJobFn(run_bwa_mem_lane, config, sample, samples, lane, fastq1, fastq2,
+                                     cores=int(config['bwa']['num_cores']),
+                                     memory="{}G".format(config['bwa']['max_mem']))
+        lane_bams.append(lane_job.rv())
+
+    job.fileStore.logToMaster("Aligning {} lanes for sample {}\n".format(len(lane_bams), sample))
+
+    return lane_bams
+
+
+def merge_lane_bams(job, config, sample, samples, lane_bams):
+    """Merge sorted per-lane BAMs, keeping each lane's read group, into one sorted and indexed BAM
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param lane_bams: The sorted per-lane BAM files.
+    :type lane_bams: list.
+    :returns:  str -- The merged BAM file name.
+    """
+
+    output_bam = "{}.bwa.sorted.bam".format(sample)
+    logfile = "{}.lane-merge.log".format(sample)
+
+    if len(lane_bams) == 1:
+        link_or_copy(lane_bams[0], output_bam)
+        command = "{} index {}".format(config['samtools']['bin'], output_bam)
+    else:
+        merge_cmd = ["{}".format(config['samtools']['bin']),
+                     "merge",
+                     "-f",
+                     "-@", "{}".format(config['bwa']['num_cores']),
+                     "{}".format(output_bam)] + ["{}".format(lane_bam) for lane_bam in lane_bams]
+        command = "{} && {} index {}".format(" ".join(merge_cmd), config['samtools']['bin'], output_bam)
+
+    job.fileStore.logToMaster("Lane merge command: {}\n".format(command))
+    pipeline.run_and_log_command(command, logfile)
+
+    if len(lane_bams) > 1:
+        for lane_bam in lane_bams:
+            os.remove(lane_bam)
+
+    return output_bam
@@ -0,0 +1,224 @@
+import os
+import subprocess
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+# Package methods
+import transcript_models
+from ddb_ngsflow import pipeline
+
+
+TRACKING_FILES = ("genes.fpkm_tracking", "isoforms.fpkm_tracking")
+SCALED_COLUMNS = ("FPKM", "FPKM_conf_lo", "FPKM_conf_hi")
+
+
+def locus_ids(models):
+    """Cluster transcripts into independent loci: transcripts overlapping on a contig share a locus, as do
+    transcripts of the same gene, so no Cufflinks bundle or gene is split between shards"""
+
+    table = models.transcripts
+    num = len(table)
+    if not num:
+        return np.zeros(0, dtype=np.int64)
+
+    # Transcripts are sorted by contig and start, so a new locus starts wherever the running end falls short
+    breaks = np.ones(num, dtype=bool)
+    breaks[1:] = (table['contig'][1:] != table['contig'][:-1]) | (table['start'][1:] >= table['max_end'][:-1])
+    overlap_ids = np.cumsum(breaks) - 1
+
+    parent = list(range(int(overlap_ids[-1]) + 1))
+
+    def find(locus):
+        while parent[locus] != locus:
+            parent[locus] = parent[parent[locus]]
+            locus = parent[locus]
+        return locus
+
+    gene_locus = dict()
+    for gene, locus in zip(table['gene'].tolist(), overlap_ids.tolist()):
+        if gene in gene_locus:
+            first, second = find(gene_locus[gene]), find(locus)
+            if first != second:
+                parent[max(first, second)] = min(first, second)
+        else:
+            gene_locus[gene] = locus
+
+    return np.array([find(locus) for locus in overlap_ids.tolist()], dtype=np.int64)
+
+
+def shard_loci(models, num_shards):
+    """Assign loci to at most num_shards shards, balancing exonic bases (a proxy for reads) by placing the
+    largest loci first on the lightest shard. Returns lists of transcript indices, heaviest shard first"""
+
+    loci = locus_ids(models)
+    exonic = np.array([models.length(index) for index in range(len(models))], dtype=np.int64)
+    locus_bases = np.bincount(loci, weights=exonic) if len(loci) else np.zeros(0)
+    members = dict()
+    for index, locus in enumerate(loci.tolist()):
+        members.setdefault(locus, list()).append(index)
+
+    num_shards = max(1, min(num_shards, len(members)))
+    loads = np.zeros(num_shards)
+    shards = [list() for _ in range(num_shards)]
+    for locus in sorted(members, key=lambda item: -locus_bases[item]):
+        lightest = int(np.argmin(loads))
+        shards[lightest].extend(members[locus])
+        loads[lightest] += locus_bases[locus]
+
+    order = np.argsort(-loads, kind='mergesort')
+
+    return [sorted(shards[i]) for i in order if shards[i]]
+
+
+def write_shard_bed(models, indices, output_file):
+    """Write the merged spans of a shard's transcripts as a BED file for region-restricted BAM extraction"""
+
+    spans = sorted((models.transcripts[index]['contig'], int(models.transcripts[index]['start']),
+                    int(models.transcripts[index]['end'])) for index in indices)
+    with open(output_file, 'w') as output:
+        current = None
+        for contig, start, end in spans:
+            if current and current[0] == contig and start <= current[2]:
+                current[2] = max(current[2], end)
+                continue
+            if current:
+                output.write("{}\t{}\t{}\n".format(models.contigs[current[0]], current[1], current[2]))
+            current = [contig, start, end]
+        if current:
+            output.write("{}\t{}\t{}\n".format(models.contigs[current[0]], current[1], current[2]))
+
+
+def shard_reference(job, config, merged_gtf, shard_dir):
+    """Split a merged transcript reference into independent gene locus shards for parallel quantification
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param merged_gtf: The merged transcript reference GTF.
+    :type merged_gtf: str.
+    :param shard_dir: Directory for the shard GTF and BED files.
+    :type shard_dir: str.
+    :returns:  list -- (GTF, BED) file name pairs, heaviest shard first.
+    """
+
+    cache_dir = config.get('transcript_model_cache', os.path.join(os.getcwd(), "Intermediates", "transcript_models"))
+    models = transcript_models.load_models(merged_gtf, cache_dir)
+    num_shards = int(config['cuffquant'].get('locus_shards', 4 * int(config['cuffquant']['num_cores'])))
+
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    shards = list()
+    for number, indices in enumerate(shard_loci(models, num_shards)):
+        gtf = os.path.join(shard_dir, "shard{:04d}.gtf".format(number))
+        bed = os.path.join(shard_dir, "shard{:04d}.bed".format(number))
+        models.write_gtf(gtf, indices)
+        write_shard_bed(models, indices, bed)
+        shards.append((gtf, bed))
+
+    job.fileStore.logToMaster("Split {} transcripts of {} into {} locus shards\n".format(len(models), merged_gtf,
+                                                                                     len(shards)))
+
+    return shards
+
+
+def mapped_reads(config, bam, regions=None):
+    """Primary mapped reads in a BAM, optionally restricted to a BED file of regions"""
+
+    command = ["{}".format(config['samtools']['bin']), "view", "-c", "-F", "0x904"]
+    if regions:
+        command.extend(["-M", "-L", "{}".format(regions)])
+    command.append("{}".format(bam))
+
+    return int(subprocess.check_output(command).strip())
+
+
+def shard_command(config, input_bam, shard_bam, gtf, output_dir):
+    """Extract a shard's reads and quantify them against the shard's transcripts with one Cufflinks thread"""
+
+    bed = "{}.bed".format(os.path.splitext(gtf)[0])
+    extract = ["{}".format(config['samtools']['bin']), "view", "-b", "-M", "-L", "{}".format(bed),
+               "-o", "{}".format(shard_bam), "{}".format(input_bam)]
+
+    quantify = ["{}".format(config['cufflinks']['bin']),
+                "-p", "1",
+                "-G", "{}".format(gtf),
+                "-o", "{}".format(output_dir)]
+    if config['cufflinks'].get('library_type'):
+        quantify.extend(["--library-type", "{}".format(config['cufflinks']['library_type'])])
+    quantify.append("{}".format(shard_bam))
+
+    return "{} && {}".format(" ".join(extract), " ".join(quantify))
+
+
+def combine_tracking(shard_results, total_reads, output_file, tracking_file):
+    """Concatenate shard tracking tables, rescaling FPKM columns from each shard's read total to the library's.
+
+    Cufflinks normalises each shard by the reads it was given, so FPKM * shard reads / total reads restores
+    the whole-library normalisation."""
+
+    header = None
+    with open(output_file, 'w') as output:
+        for shard_dir, shard_reads in shard_results:
+            with open(os.path.join(shard_dir, tracking_file), 'r') as tracking:
+                columns = tracking.readline().rstrip('\n').split('\t')
+                if header is None:
+                    header = columns
+                    output.write("{}\n".format("\t".join(header)))
+                scaled = [columns.index(column) for column in SCALED_COLUMNS if column in columns]
+                scale = float(shard_reads) / total_reads if total_reads else 0.0
+                for line in tracking:
+                    fields = line.rstrip('\n').split('\t')
+                    for column in scaled:
+                        fields[column] = repr(float(fields[column]) * scale)
+                    output.write("{}\n".format("\t".join(fields)))
+
+
+def locus_quant(job, config, sample, samples, shards):
+    """Quantify a sample against the merged reference shard by shard on a pool of Cufflinks processes,
+    recombining the results into genes.fpkm_tracking and isoforms.fpkm_tracking
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param shards: (GTF, BED) pairs from shard_reference.
+    :type shards: list.
+    :returns:  str -- The output directory holding the recombined tracking files.
+    """
+
+    input_bam = samples[sample].get('bam', "{}.star.Aligned.sortedByCoord.out.bam".format(sample))
+    output_dir = "{}.locus_quant".format(sample)
+    work_dir = os.path.join(output_dir, "shards")
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    total_reads = mapped_reads(config, input_bam)
+    job.fileStore.logToMaster("Quantifying {} ({} mapped reads) over {} locus shards\n".format(sample, total_reads,
+                                                                                           len(shards)))
+
+    def quantify(shard):
+        gtf, bed = shard
+        name = os.path.splitext(os.path.basename(gtf))[0]
+        shard_bam = os.path.join(work_dir, "{}.bam".format(name))
+        shard_dir = os.path.join(work_dir, name)
+        pipeline.run_and_log_command(shard_command(config, input_bam, shard_bam, gtf, shard_dir),
+                                     os.path.join(work_dir, "{}.log".format(name)))
+        shard_reads = mapped_reads(config, shard_bam)
+        os.remove(shard_bam)
+
+        return shard_dir, shard_reads
+
+    pool = ThreadPool(min(len(shards), int(config['cuffquant']['num_cores'])) or 1)
+    try:
+        # Shards arrive heaviest first, so map with chunksize 1 keeps every process busy until the end
+        shard_results = pool.map(quantify, shards, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+    for tracking_file in TRACKING_FILES:
+        combine_tracking(shard_results, total_reads, os.path.join(output_dir, tracking_file), tracking_file)
+
+    return output_dir
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 # Standard packages
+import os
 import sys
 import argparse
 
@@ -10,9 +11,13 @@ from toil.job import Job
 # Package methods
 from ddb import configuration
 from ddb_ngsflow import pipeline
-from ddb_ngsflow.rna import star
 from ddb_ngsflow.rna import cufflinks
 
+# Local methods
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import locus_quant
+import star_shared
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -31,25 +36,23 @@ if __name__ == "__main__":
     # Workflow Graph definition. The following workflow definition should create a valid Directed Acyclic Graph (DAG)
     root_job = Job.wrapJobFn(pipeline.spawn_batch_jobs, cores=1)
 
-    # Per sample jobs
-    for sample in samples:
-        # Alignment and Refinement Stages
-        # 1st Pass STAR
-
-        flags = list()
-        flags.append("compressed")
-
-        align_job = Job.wrapJobFn(star.star_paired, config, sample, samples, flags,
-                                  cores=int(config['star']['num_cores']),
-                                  memory="{}G".format(config['star']['max_mem']))
+    # STAR runs in node batches sharing one copy of the genome in memory
+    flags = list()
+    flags.append("compressed")
 
-        cufflinks_job = Job.wrapJobFn(cufflinks.cufflinks, config, sample, samples,
-                                      cores=int(config['cufflinks']['num_cores']),
-                                      memory="{}G".format(config['cufflinks']['max_mem']))
-
-        # Create workflow from created jobs
+    for batch in star_shared.node_batches(samples, int(config['star'].get('samples_per_node', 4))):
+        batch_cores, batch_mem = star_shared.batch_resources(config, len(batch))
+        align_job = Job.wrapJobFn(star_shared.star_node_batch, config, batch, samples, flags,
+                                  cores=batch_cores,
+                                  memory="{}G".format(batch_mem))
         root_job.addChild(align_job)
-        align_job.addChild(cufflinks_job)
+
+        # Per sample jobs
+        for sample in batch:
+            cufflinks_job = Job.wrapJobFn(cufflinks.cufflinks, config, sample, samples,
+                                          cores=int(config['cufflinks']['num_cores']),
+                                          memory="{}G".format(config['cufflinks']['max_mem']))
+            align_job.addChild(cufflinks_job)
 
     cuffmerge_job = Job.wrapJobFn(cufflinks.cuffmerge, config,
                                   cores=int(config['cuffmerge']['num_cores']),
@@ -57,12 +60,20 @@ if __name__ == "__main__":
 
     root_job.addFollowOn(cuffmerge_job)
 
+    # Quantification is sharded by gene locus against the merged reference and run on a process pool
+    merged_gtf = config.get('merged_transcript_reference', os.path.join("merged_asm", "merged.gtf"))
+    shard_job = Job.wrapJobFn(locus_quant.shard_reference, config, merged_gtf,
+                              os.path.join("Intermediates", "locus_shards"),
+                              cores=1)
+
+    cuffmerge_job.addChild(shard_job)
+
     for sample in samples:
-        cuffquant_job = Job.wrapJobFn(cufflinks.cuffquant, config, sample, samples,
-                                      cores=int(config['cuffquant']['num_cores']),
-                                      memory="{}G".format(config['cuffquant']['max_mem']))
+        quant_job = Job.wrapJobFn(locus_quant.locus_quant, config, sample, samples, shard_job.rv(),
+                                  cores=int(config['cuffquant']['num_cores']),
+                                  memory="{}G".format(config['cuffquant']['max_mem']))
 
-        cuffmerge_job.addChild(cuffquant_job)
+        shard_job.addChild(quant_job)
 
     # Start workflow execution
     Job.Runner.startToil(root_job, args)
@@ -0,0 +1,103 @@
+import os
+import math
+
+# Package methods
+import shell_commands
+from ddb_ngsflow import pipeline
+
+
+MEMORY_UNITS = {'K': 1.0 / (1024 * 1024), 'M': 1.0 / 1024, 'G': 1.0}
+
+
+def sort_memory(config, tool, sort_threads=None):
+    """GB held by a sort_command pipe stage: sort_mem_per_thread for each sort thread"""
+
+    per_thread = "{}".format(config[tool].get('sort_mem_per_thread', '768M')).strip().upper()
+    if per_thread[-1] in MEMORY_UNITS:
+        per_thread_gb = float(per_thread[:-1]) * MEMORY_UNITS[per_thread[-1]]
+    else:
+        per_thread_gb = float(per_thread) / (1024 * 1024 * 1024)
+
+    return per_thread_gb * int(sort_threads or config[tool]['num_cores'])
+
+
+def job_memory(config, tool):
+    """Toil memory request for an aligner piped into sort_command: the tool's max_mem plus the sort's memory"""
+
+    return "{}G".format(int(config[tool]['max_mem']) + int(math.ceil(sort_memory(config, tool))))
+
+
+def sort_command(config, tool, output_bam, sort_threads=None):
+    """samtools sort reading an aligner's stream on stdin. Each thread holds at most the tool's
+    sort_mem_per_thread (default 768M) before spilling a sorted run to disk, and runs are merged at the end"""
+
+    threads = sort_threads or config[tool]['num_cores']
+
+    return " ".join(["{}".format(config['samtools']['bin']),
+                     "sort",
+                     "-@", "{}".format(threads),
+                     "-m", "{}".format(config[tool].get('sort_mem_per_thread', '768M')),
+                     "-T", "{}.sort.temp".format(os.path.splitext(output_bam)[0]),
+                     "-O", "bam",
+                     "-o", "{}".format(output_bam),
+                     "-"])
+
+
+def index_command(config, output_bam):
+    return "{} index {}".format(config['samtools']['bin'], output_bam)
+
+
+def hisat_sorted(job, config, sample, samples, flags, paired=True):
+    """Align with HISAT2, streaming SAM output into a coordinate sort and index without intermediate files
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param flags: HISAT2 option flags (keep_retained, max_intron, stranded).
+    :type flags: list.
+    :param paired: Whether the sample has paired FASTQ files.
+    :type paired: bool.
+    :returns:  str -- The sorted, indexed BAM file name.
+    """
+
+    output_bam = "{}.hisat.sorted.bam".format(sample)
+    logfile = "{}.hisat.log".format(sample)
+
+    hisat_cmd = ["{}".format(config['hisat']['bin']),
+                 "-p", "{}".format(config['hisat']['num_cores']),
+                 "-x", "{}".format(config['hisat']['index'])]
+
+    if paired:
+        hisat_cmd.extend(["-1", "{}".format(samples[sample]['fastq1']),
+                          "-2", "{}".format(samples[sample]['fastq2'])])
+        # HISAT2 replaces % with the mate number, writing one file per mate
+        unaligned_option = ["--un-conc-gz", "{}.hisat.unaligned.%.fastq.gz".format(sample)]
+    else:
+        hisat_cmd.extend(["-U", "{}".format(samples[sample]['fastq1'])])
+        unaligned_option = ["--un-gz", "{}.hisat.unaligned.fastq.gz".format(sample)]
+
+    if "keep_retained" in flags:
+        hisat_cmd.extend(unaligned_option)
+    if "max_intron" in flags:
+        hisat_cmd.extend(["--max-intronlen", "{}".format(config['hisat']['max_intron'])])
+    if "stranded" in flags:
+        hisat_cmd.extend(["--rna-strandness", "{}".format(config['hisat'].get('strandness', 'RF'))])
+
+    command = "{} && {}".format(shell_commands.pipefail("{} | {}".format(" ".join(hisat_cmd),
+                                                                         sort_command(config, 'hisat', output_bam))),
+                                index_command(config, output_bam))
+
+    job.fileStore.logToMaster("HISAT2 Command: {}\n".format(command))
+    pipeline.run_and_log_command(command, logfile)
+
+    return output_bam
+
+
+def hisat_paired_sorted(job, config, sample, samples, flags):
+    return hisat_sorted(job, config, sample, samples, flags, paired=True)
+
+
+def hisat_unpaired_sorted(job, config, sample, samples, flags):
+    return hisat_sorted(job, config, sample, samples, flags, paired=False)
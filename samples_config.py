@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+# Standard packages
+import os
+import re
+import csv
+import sys
+import argparse
+
+from collections import OrderedDict
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+
+# bcl2fastq names: <Sample>_S<n>_L<lane>_R<read>_001.fastq.gz, without the lane part when lanes are merged
+FASTQ_RE = re.compile(r'^(?P<sample>.+)_S(?P<number>\d+)(?:_L(?P<lane>\d{3}))?_R(?P<read>[12])_001\.fastq\.gz$')
+PANEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "panels")
+FILE_KEYS = ('regions', 'vcfanno_config')
+
+
+class Panel(object):
+    """Panel definition read from an INI file (see panels/).
+
+    The [panel] section names the sample sheet columns holding the sample name and target pool (0-based
+    indices, negative indices from the end, or [Data] header names) and default values written for every
+    library, e.g. regions and vcfanno_config. Each [pool:<name>] section lists the sheet values (aliases)
+    that select it and the values it overrides for those libraries."""
+
+    def __init__(self, panel_file):
+        parser = RawConfigParser()
+        parser.optionxform = str
+        if not parser.read(panel_file):
+            raise ValueError("Could not read panel definition {}".format(panel_file))
+
+        settings = OrderedDict(parser.items('panel'))
+        self.name = settings.pop('name', os.path.splitext(os.path.basename(panel_file))[0])
+        self.sample_column = settings.pop('sample_column', 'Sample_ID')
+        self.pool_column = settings.pop('pool_column', None)
+        self.defaults = settings
+
+        self.pools = OrderedDict()
+        self.aliases = dict()
+        for section in parser.sections():
+            if section.startswith('pool:'):
+                pool = section[len('pool:'):]
+                values = OrderedDict(parser.items(section))
+                for alias in values.pop('aliases', pool).split(','):
+                    self.aliases[alias.strip()] = pool
+                self.pools[pool] = values
+
+    def values(self, pool):
+        """Return the panel values for a pool, or None if the panel has pools and this is not one of them"""
+
+        values = OrderedDict(self.defaults)
+        if self.pools:
+            if pool not in self.aliases:
+                return None
+            values.update(self.pools[self.aliases[pool]])
+
+        return values
+
+
+def find_panel(panel):
+    """Accept a panel definition file or the name of one in panels/"""
+
+    if os.path.isfile(panel):
+        return panel
+
+    return os.path.join(PANEL_DIR, "{}.ini".format(panel))
+
+
+def read_sample_sheet(sheet_file):
+    """Parse an Illumina SampleSheet. Returns (header settings, [Data] column names, data rows).
+
+    Sheets without [Section] lines are treated as bare, headerless data rows."""
+
+    sections = OrderedDict()
+    section = None
+    with open(sheet_file, 'r') as sheet:
+        for row in csv.reader(sheet):
+            if not any(field.strip() for field in row):
+                continue
+            if row[0].startswith('[') and row[0].strip().endswith(']'):
+                section = row[0].strip()[1:-1]
+                sections[section] = list()
+                continue
+            sections.setdefault(section, list()).append([field.strip() for field in row])
+
+    if 'Data' in sections:
+        data = sections['Data']
+        settings = dict((row[0], row[1]) for row in sections.get('Header', []) if len(row) > 1)
+        return settings, data[0] if data else [], data[1:]
+
+    return dict(), None, sections.get(None, [])
+
+
+def column_index(column, header):
+    if re.match(r'^-?\d+$', column):
+        return int(column)
+    if header is None or column not in header:
+        raise ValueError("Sample sheet has no column {}".format(column))
+
+    return header.index(column)
+
+
+def discover_fastqs(fastq_dir):
+    """Scan fastq_dir once (including bcl2fastq project sub-directories) for Illumina named FASTQs.
+
+    Returns {library: {'sample': name, 'number': n, 'lanes': {lane: {read: path}}}} with libraries named
+    <Sample>_S<n> and lane 0 for lane-merged files."""
+
+    libraries = dict()
+    for directory, subdirectories, files in os.walk(fastq_dir):
+        subdirectories.sort()
+        for file_name in files:
+            match = FASTQ_RE.match(file_name)
+            if match is None:
+                continue
+            library_name = "{}_S{}".format(match.group('sample'), match.group('number'))
+            library = libraries.setdefault(library_name, {'sample': match.group('sample'),
+                                                          'number': int(match.group('number')),
+                                                          'lanes': dict()})
+            path = os.path.join(directory, file_name)
+            if fastq_dir == ".":
+                path = os.path.relpath(path, fastq_dir)
+            lane = int(match.group('lane') or 0)
+            library['lanes'].setdefault(lane, dict())[int(match.group('read'))] = path
+
+    return libraries
+
+
+def sheet_libraries(panel, header, rows, fastqs):
+    """Yield (library, sample, pool, discovered FASTQ entry or None) in sheet order"""
+
+    sample_index = column_index(panel.sample_column, header)
+    pool_index = column_index(panel.pool_column, header) if panel.pool_column else None
+    by_sample = dict()
+    for library_name, library in fastqs.items():
+        by_sample.setdefault(library['sample'], list()).append(library_name)
+
+    for number, row in enumerate(rows, 1):
+        sample = row[sample_index]
+        pool = row[pool_index] if pool_index is not None else "default"
+        discovered = by_sample.get(sample, [])
+        if len(discovered) == 1:
+            yield discovered[0], sample, pool, fastqs[discovered[0]]
+        else:
+            # Fall back on bcl2fastq numbering by sheet order
+            library_name = "{}_S{}".format(sample, number)
+            yield library_name, sample, pool, fastqs.get(library_name)
+
+
+def build_samples(panel, libraries, settings):
+    """Return (samples config entries by library, validation errors)"""
+
+    libraries = list(libraries)
+    samples = OrderedDict()
+    errors = list()
+    for library_name, sample, pool, fastq_entry in libraries:
+        if library_name in samples:
+            errors.append("Library {} is listed more than once".format(library_name))
+            continue
+
+        values = panel.values(pool)
+        if values is None:
+            errors.append("Library {} has unknown pool {} for panel {}".format(library_name, pool, panel.name))
+            values = OrderedDict(panel.defaults)
+
+        entry = OrderedDict()
+        if fastq_entry is None:
+            errors.append("No FASTQ files found for library {}".format(library_name))
+            entry['fastq1'] = "{}_L001_R1_001.fastq.gz".format(library_name)
+            entry['fastq2'] = "{}_L001_R2_001.fastq.gz".format(library_name)
+        else:
+            # Multi-lane libraries list one FASTQ per lane, in lane order (see lane_alignment.lane_pairs)
+            lanes = fastq_entry['lanes']
+            for lane in sorted(lanes):
+                for read in (1, 2):
+                    if read not in lanes[lane]:
+                        errors.append("Library {} has no read {} FASTQ for lane {}".format(library_name, read,
+                                                                                           lane))
+            entry['fastq1'] = ",".join(lanes[lane].get(1, "") for lane in sorted(lanes))
+            entry['fastq2'] = ",".join(lanes[lane].get(2, "") for lane in sorted(lanes))
+
+        entry['library_name'] = library_name
+        entry['sample_name'] = sample
+        entry['extraction'] = values.pop('extraction', 'default')
+        entry['panel'] = settings['panel'] or panel.name
+        entry['report'] = values.pop('report', '')
+        entry['target_pool'] = pool
+        entry['sequencer'] = settings['sequencer']
+        entry['run_id'] = settings['run_id']
+        entry['num_libraries_in_run'] = len(libraries)
+        entry.update(values)
+
+        checked = FILE_KEYS if fastq_entry is None else ('fastq1', 'fastq2') + FILE_KEYS
+        for key in checked:
+            for path in entry.get(key, "").split(','):
+                if path and not os.path.isfile(path):
+                    errors.append("Library {} {} file {} does not exist".format(library_name, key, path))
+
+        samples[library_name] = entry
+
+    return samples, errors
+
+
+def run_name(config, samples, sample_names=None):
+    """Name for run level files: the configured run_id, else the run_id(s) of the named samples (all samples by
+    default) joined with underscores, falling back to 'run' when no sample has one"""
+
+    if config.get('run_id'):
+        return config['run_id']
+    sample_names = samples if sample_names is None else sample_names
+    run_ids = sorted(set(samples[sample].get('run_id') for sample in sample_names if samples[sample].get('run_id')))
+
+    return "_".join(run_ids) or "run"
+
+
+def write_samples_config(output_file, samples):
+    with open(output_file, 'w') as output:
+        for library_name, entry in samples.items():
+            output.write("[{}]\n".format(library_name))
+            for key, value in entry.items():
+                output.write("{}: {}\n".format(key, value).replace(": \n", ":\n"))
+            output.write("\n")
+
+
+def generate(panel_file, output_file, sample_sheet=None, fastq_dir=".", panel_name=None, sequencer=None,
+             run_id=None, allow_missing=False):
+    """Build and write a samples configuration file, exiting before writing if validation fails"""
+
+    panel = Panel(panel_file)
+    fastqs = discover_fastqs(fastq_dir)
+    sys.stdout.write("Found FASTQ files for {} libraries in {}\n".format(len(fastqs), fastq_dir))
+
+    if sample_sheet:
+        header_settings, header, rows = read_sample_sheet(sample_sheet)
+        libraries = sheet_libraries(panel, header, rows, fastqs)
+        run_id = run_id or header_settings.get('Experiment Name')
+    else:
+        libraries = ((library_name, fastqs[library_name]['sample'], "default", fastqs[library_name])
+                     for library_name in sorted(fastqs, key=lambda name: fastqs[name]['number']))
+
+    samples, errors = build_samples(panel, libraries, {'panel': panel_name, 'sequencer': sequencer,
+                                                       'run_id': run_id})
+    for error in errors:
+        sys.stderr.write("ERROR: {}\n".format(error))
+    if errors and not allow_missing:
+        sys.stderr.write("{} problems found, not writing {}\n".format(len(errors), output_file))
+        sys.exit(1)
+
+    write_samples_config(output_file, samples)
+    sys.stdout.write("Wrote {} libraries to {}\n".format(len(samples), output_file))
+
+    return samples
+
+
+def add_arguments(parser, default_panel=None):
+    parser.add_argument('-i', '--input', help="Input SampleSheet (omit to configure every FASTQ found)")
+    parser.add_argument('-o', '--output', help="Output samples configuration file name")
+    parser.add_argument('-d', '--definition', default=default_panel,
+                        help="Panel definition file, or the name of one in panels/")
+    parser.add_argument('-f', '--fastq_dir', default=".", help="Directory to search for FASTQ files")
+    parser.add_argument('-p', '--panel', help="Panel name (default: from the panel definition)")
+    parser.add_argument('-s', '--sequencer', help="Sequencer name")
+    parser.add_argument('-r', '--run_id', help="Run ID (default: the SampleSheet Experiment Name)")
+    parser.add_argument('-a', '--allow_missing', action='store_true',
+                        help="Write the configuration even if referenced files are missing")
+
+
+def run(args):
+    return generate(find_panel(args.definition), args.output, args.input, args.fastq_dir, args.panel,
+                    args.sequencer, args.run_id, args.allow_missing)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a samples configuration file from a SampleSheet "
+                                                 "and a panel definition")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,10 @@
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+def pipefail(command):
+    """Run a shell pipeline under bash with pipefail, so a failed aligner is not hidden by a successful sort"""
+
+    return "bash -o pipefail -c {}".format(quote(command))
@@ -0,0 +1,100 @@
+import zlib
+import struct
+
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+
+class BgzfReader(object):
+    """Minimal BGZF reader exposing htslib-style virtual offsets (block start << 16 | offset in block)"""
+
+    def __init__(self, path):
+        self.handle = open(path, 'rb')
+        self.block_start = 0
+        self.next_block = 0
+        self.buffer = b""
+        self.within = 0
+        self.eof = False
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load_block(self, start):
+        self.handle.seek(start)
+        header = self.handle.read(12)
+        if len(header) < 12:
+            self.block_start = start
+            self.buffer = b""
+            self.within = 0
+            self.eof = True
+            return
+        if header[:4] != BGZF_MAGIC:
+            raise IOError("Invalid BGZF block at offset {} of {}".format(start, self.handle.name))
+
+        extra_length = struct.unpack("<H", header[10:12])[0]
+        extra = self.handle.read(extra_length)
+        block_size = None
+        position = 0
+        while position < extra_length:
+            subfield_id = extra[position:position + 2]
+            subfield_length = struct.unpack("<H", extra[position + 2:position + 4])[0]
+            if subfield_id == b"BC":
+                block_size = struct.unpack("<H", extra[position + 4:position + 6])[0] + 1
+            position += 4 + subfield_length
+        if block_size is None:
+            raise IOError("BGZF block at offset {} has no BC subfield".format(start))
+
+        compressed = self.handle.read(block_size - extra_length - 20)
+        self.block_start = start
+        self.next_block = start + block_size
+        self.buffer = zlib.decompress(compressed, -15)
+        self.within = 0
+        self.eof = False
+
+    def _ensure(self):
+        """Advance past exhausted (and empty EOF marker) blocks so tell() points at the next byte"""
+
+        while self.within >= len(self.buffer) and not self.eof:
+            self._load_block(self.next_block)
+
+    def tell(self):
+        self._ensure()
+        return (self.block_start << 16) | self.within
+
+    def seek(self, virtual_offset):
+        start = virtual_offset >> 16
+        if start != self.block_start or not self.buffer:
+            self._load_block(start)
+        self.within = virtual_offset & 0xFFFF
+
+    def readline(self):
+        parts = list()
+        while True:
+            self._ensure()
+            if self.eof:
+                break
+            newline = self.buffer.find(b"\n", self.within)
+            if newline >= 0:
+                parts.append(self.buffer[self.within:newline + 1])
+                self.within = newline + 1
+                break
+            parts.append(self.buffer[self.within:])
+            self.within = len(self.buffer)
+
+        return b"".join(parts)
+
+    def lines(self):
+        """Yield (virtual offset, line) for every line from the current position"""
+
+        while True:
+            offset = self.tell()
+            line = self.readline()
+            if not line:
+                return
+            yield offset, line
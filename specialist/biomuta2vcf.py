@@ -1,13 +1,211 @@
+import re
+import io
 import sys
 import argparse
 
-# This only works for BioMuta2. BioMuta3 appears to have a different format and order of columns, and is not documented
-# with a header
+from collections import Counter
+
+import pysam
+
+from sortvcf import ExternalSorter
+from sortvcf import write_vcf
+
+# BioMuta2 files have a header line and give the position as chr:start-end in one column. BioMuta3 files have
+# no header and split chromosome and position into separate columns. The BioMuta3 indices below were read off a
+# BioMuta3 TSV download rather than a published schema, so check them against the release being converted and
+# override any of them with --columns (e.g. --columns chrom=3,position=4). Column indices for each layout:
+LAYOUTS = {'biomuta2': {'header': True, 'min_columns': 16, 'position': 3, 'chrom': None, 'ref': 5, 'alt': 6,
+                        'uniprot': 0, 'gene': 1, 'polyphen': 10, 'pmid': 11, 'cancertype': 12, 'source': 13,
+                        'status': 14, 'func': 15},
+           'biomuta3': {'header': False, 'min_columns': 15, 'position': 4, 'chrom': 3, 'ref': 5, 'alt': 6,
+                        'uniprot': 0, 'gene': 1, 'polyphen': 10, 'pmid': 11, 'cancertype': 12, 'source': 13,
+                        'status': 14, 'func': None}}
+
+INFO_FIELDS = (('BM_Uniprot', 'uniprot'), ('BM_Gene', 'gene'), ('BM_PolyPhen', 'polyphen'), ('BM_PMID', 'pmid'),
+               ('BM_cancertype', 'cancertype'), ('BM_source', 'source'), ('BM_status', 'status'),
+               ('BM_func', 'func'))
+
+ALLELE_RE = re.compile(r'^[ACGTN]+$')
+EMPTY_ALLELE = '-'
+READ_CHUNK_BYTES = 1 << 24
+
+
+def info_value(value):
+    """Make a free-text value safe for a VCF INFO field"""
+
+    value = value.strip()
+    if not value:
+        return "."
+
+    return value.replace(' ', '_').replace(';', '|').replace(',', '|').replace('=', ':')
+
+
+def normalise_contig(contig):
+    contig = contig.strip()
+    if contig.lower().startswith('chr'):
+        contig = contig[3:]
+    if contig == 'M':
+        contig = 'MT'
+
+    return contig
+
+
+class ReferenceSequence(object):
+    """Reference FASTA lookups by normalised contig name, so chr-prefixed and chrM references both match"""
+
+    def __init__(self, fasta):
+        self.fasta = pysam.FastaFile(fasta)
+        self.names = dict()
+        for name in self.fasta.references:
+            self.names.setdefault(normalise_contig(name), name)
+
+    def sequence(self, contig, start, end):
+        """Bases from 1-based start to end inclusive, or None when the contig is not in the reference"""
+
+        if contig not in self.names:
+            return None
+
+        return self.fasta.fetch(self.names[contig], start - 1, end).upper()
+
+
+def indel_alleles(chrom, position, ref, alt, reference, skipped):
+    """Convert a BioMuta '-' allele indel to anchored VCF alleles, shifted left through repeats.
+
+    Deletions give the first deleted base as the position and insertions the base the insertion follows (the
+    MAF convention). Returns (position, ref, alt), or None after counting the reason it is skipped."""
+
+    indel = alt if ref == EMPTY_ALLELE else ref
+    if not ALLELE_RE.match(indel):
+        skipped['invalid_allele'] += 1
+        return None
+    if reference is None:
+        skipped['indel_without_reference'] += 1
+        return None
+
+    anchor = position if ref == EMPTY_ALLELE else position - 1
+    if ref != EMPTY_ALLELE and reference.sequence(chrom, position, position + len(ref) - 1) != ref:
+        skipped['reference_mismatch'] += 1
+        return None
+    if anchor < 1:
+        skipped['invalid_position'] += 1
+        return None
+
+    anchor_base = reference.sequence(chrom, anchor, anchor)
+    if not anchor_base:
+        skipped['contig_not_in_reference'] += 1
+        return None
+    while anchor > 1 and anchor_base == indel[-1]:
+        indel = anchor_base + indel[:-1]
+        anchor -= 1
+        anchor_base = reference.sequence(chrom, anchor, anchor)
+
+    if ref == EMPTY_ALLELE:
+        return anchor, anchor_base, anchor_base + indel
+
+    return anchor, anchor_base + indel, anchor_base
+
+
+def vcf_alleles(chrom, position, ref, alt, reference, skipped):
+    """Return VCF (position, ref, alt) for a row's alleles, or None after counting the reason it is skipped"""
+
+    ref = ref.strip().upper()
+    alt = alt.strip().upper()
+    if (ref == EMPTY_ALLELE) != (alt == EMPTY_ALLELE):
+        return indel_alleles(chrom, position, ref, alt, reference, skipped)
+    if not ALLELE_RE.match(ref) or not ALLELE_RE.match(alt):
+        skipped['invalid_allele'] += 1
+        return None
+    if ref == alt:
+        skipped['ref_equals_alt'] += 1
+        return None
+
+    return position, ref, alt
+
+
+def read_layout(layout_format, columns):
+    """Column layout for a format, with comma separated name=index overrides applied"""
+
+    layout = dict(LAYOUTS[layout_format])
+    if columns:
+        for override in columns.split(','):
+            name, _, index = override.partition('=')
+            if name.strip() not in layout or name.strip() in ('header', 'min_columns'):
+                raise ValueError("Unknown BioMuta column {} in --columns".format(name))
+            layout[name.strip()] = int(index) if index.strip() not in ('', 'none') else None
+        layout['min_columns'] = max(layout['min_columns'],
+                                    1 + max(index for name, index in layout.items()
+                                            if name not in ('header', 'min_columns') and index is not None))
+
+    return layout
+
+
+def parse_row(info, layout, skipped, reference=None):
+    """Return (contig, position, VCF line) for a BioMuta row, or None after counting the reason it is skipped"""
+
+    if len(info) < layout['min_columns']:
+        skipped['too_few_columns'] += 1
+        return None
+
+    if layout['chrom'] is None:
+        pos_sect = info[layout['position']].split(':')
+        if len(pos_sect) < 2:
+            skipped['missing_position'] += 1
+            return None
+        chrom = pos_sect[0]
+        position = pos_sect[1].split('-')[0]
+    else:
+        chrom = info[layout['chrom']]
+        position = info[layout['position']]
+
+    chrom = normalise_contig(chrom)
+    try:
+        position = int(position.strip())
+    except ValueError:
+        skipped['invalid_position'] += 1
+        return None
+    if not chrom or position < 1:
+        skipped['invalid_position'] += 1
+        return None
+
+    alleles = vcf_alleles(chrom, position, info[layout['ref']], info[layout['alt']], reference, skipped)
+    if alleles is None:
+        return None
+    position, ref, alt = alleles
+
+    info_data = ";".join("{}={}".format(key, info_value(info[layout[column]]) if layout[column] is not None else ".")
+                         for key, column in INFO_FIELDS)
+    line = "{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\tPASS\t{info}\n".format(chrom=chrom, pos=position, ref=ref, alt=alt,
+                                                                       info=info_data)
+    return chrom, position, line
+
+
+def read_rows(infile, has_header):
+    """Yield tab split rows, reading the input in large buffered chunks"""
+
+    with io.open(infile, 'r', buffering=READ_CHUNK_BYTES, newline=None) as handle:
+        if has_header:
+            handle.readline()
+        while True:
+            lines = handle.readlines(READ_CHUNK_BYTES)
+            if not lines:
+                break
+            for line in lines:
+                if line.strip():
+                    yield line.rstrip('\n').split('\t')
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--infile', help="BioMuta CSV input file")
-    parser.add_argument('-o', '--outfile', help="Name of output VCF file")
+    parser.add_argument('-o', '--outfile', help="Name of output VCF file. Names ending in .gz are bgzipped and "
+                                                "tabix indexed")
+    parser.add_argument('-f', '--format', default='biomuta2', choices=sorted(LAYOUTS), help="BioMuta column layout")
+    parser.add_argument('-c', '--columns', help="Comma separated name=index overrides of the layout's columns")
+    parser.add_argument('-r', '--reference', help="Indexed reference FASTA, used to anchor '-' allele indels. "
+                                                  "Without it those rows are skipped")
+    parser.add_argument('-b', '--buffer_size', type=int, default=1000000,
+                        help="Records held in memory before spilling a sorted run to disk")
+    parser.add_argument('-t', '--temp_dir', help="Directory for temporary sort runs")
     args = parser.parse_args()
 
     header = '##fileformat=VCFv4.1\n' \
@@ -22,34 +220,19 @@ if __name__ == "__main__":
              '##CADDCOMMENT=<ID=comment,comment="{comment}">\n' \
              '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
 
-    with open(args.outfile, 'w') as outfile:
-        outfile.write(header)
-        with open(args.infile, 'r') as infile:
-            infile.readline()
-            for line in infile.readlines():
-                info = line.split('\t')
-
-                # There are some malformed lines that are not complete. Skip them
-                if len(info) < 15:
-                    # sys.stderr.write("WARNING: Error processing line: {}\n".format(line))
-                    continue
-
-                position = info[3]
-                pos_sect = position.split(':')
-
-                # Some lines don't have a position. Skip them
-                if len(pos_sect) < 2:
-                    # sys.stderr.write("WARNING: Error processing coordinates ({}) for line {}\n".format(position,
-                    # line))
-                    continue
-
-                chrom = pos_sect[0]
-                positions = pos_sect[1].split('-')
-
-                outfile.write("{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\tPASS\t".format(chrom=chrom, pos=positions[0],
-                                                                                  ref=info[5], alt=info[6]))
-
-                outfile.write("BM_Uniprot={uni};BM_Gene={gene};BM_PolyPhen={poly};BM_PMID={pmid};"
-                              "BM_cancertype={type};BM_source={source};BM_status={status};"
-                              "BM_func={func}\n".format(uni=info[0], gene=info[1], poly=info[10], pmid=info[11],
-                                                        type=info[12], source=info[13], status=info[14], func=info[15]))
+    layout = read_layout(args.format, args.columns)
+    reference_sequence = ReferenceSequence(args.reference) if args.reference else None
+    skipped = Counter()
+    sorter = ExternalSorter(args.buffer_size, args.temp_dir)
+
+    sys.stdout.write("Parsing {} as {}\n".format(args.infile, args.format))
+    for row in read_rows(args.infile, layout['header']):
+        record = parse_row(row, layout, skipped, reference_sequence)
+        if record is not None:
+            sorter.add(*record)
+
+    sys.stdout.write("Writing {} sorted records to {}\n".format(sorter.count, args.outfile))
+    write_vcf(args.outfile, header, sorter.sorted_lines())
+
+    for reason in sorted(skipped):
+        sys.stdout.write("Skipped {} rows: {}\n".format(skipped[reason], reason))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+# Standard packages
+import io
+import sys
+import argparse
+import multiprocessing
+
+from collections import Counter
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+from sortvcf import ExternalSorter
+from sortvcf import write_vcf
+from biomuta2vcf import info_value
+from biomuta2vcf import vcf_alleles
+from biomuta2vcf import normalise_contig
+from biomuta2vcf import ReferenceSequence
+
+DELIMITERS = {'tab': '\t', 'comma': ',', 'semicolon': ';', 'pipe': '|'}
+TYPES = ('String', 'Integer', 'Float', 'Flag')
+READ_CHUNK_BYTES = 1 << 24
+
+worker_mapping = None
+worker_reference = None
+
+
+class SourceMapping(object):
+    """Declarative description of how to turn a delimited database into VCF records.
+
+    The [source] section gives the delimiter, header handling and the chrom, position, ref and alt columns.
+    Columns are 0-based indices or header names. position_format is 'plain' or 'chrom:start-end' (the chrom
+    column is then unused). Empty values are left out of INFO unless empty_value is set. Each [info:<ID>]
+    section maps one INFO field with column, type, number and description keys. Rows are checked and
+    converted with the same allele, contig and value rules as biomuta2vcf.py."""
+
+    def __init__(self, mapping_file):
+        parser = RawConfigParser()
+        parser.read(mapping_file)
+
+        source = dict(parser.items('source'))
+        self.name = source.get('name', 'source')
+        self.delimiter = DELIMITERS.get(source.get('delimiter', 'tab'), source.get('delimiter', 'tab'))
+        self.header = source.get('header', 'true').lower() in ('true', 'yes', '1')
+        self.skip_lines = int(source.get('skip_lines', 0))
+        self.position_format = source.get('position_format', 'plain')
+        self.strip_chr = source.get('strip_chr', 'true').lower() in ('true', 'yes', '1')
+        self.empty_value = source.get('empty_value')
+        self.columns = dict((key, source.get(key)) for key in ('chrom', 'position', 'ref', 'alt'))
+
+        self.info = list()
+        for section in parser.sections():
+            if section.startswith('info:'):
+                field = dict(parser.items(section))
+                field_type = field.get('type', 'String')
+                if field_type not in TYPES:
+                    raise ValueError("INFO field {} in {} has unknown type {}".format(section, mapping_file,
+                                                                                     field_type))
+                self.info.append({'id': section[len('info:'):], 'column': field['column'], 'type': field_type,
+                                  'number': field.get('number', '0' if field_type == 'Flag' else '1'),
+                                  'description': field.get('description', section[len('info:'):])})
+
+    def resolve(self, header_fields):
+        """Convert column names to indices once the header (if any) is known"""
+
+        def index(column):
+            if column is None:
+                return None
+            if column.isdigit():
+                return int(column)
+            if header_fields is None or column not in header_fields:
+                raise ValueError("Column {} not found in {} header".format(column, self.name))
+            return header_fields.index(column)
+
+        self.indices = dict((key, index(column)) for key, column in self.columns.items())
+        for field in self.info:
+            field['index'] = index(field['column'])
+        self.min_columns = 1 + max([i for i in self.indices.values() if i is not None] +
+                                   [field['index'] for field in self.info])
+
+    def vcf_header(self):
+        lines = ['##fileformat=VCFv4.1\n', '##source={}\n'.format(self.name)]
+        for field in self.info:
+            lines.append('##INFO=<ID={id},Number={number},Type={type},Description="{description}">\n'.format(**field))
+        lines.append('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+
+        return "".join(lines)
+
+    def vcfanno_fragment(self, output_vcf):
+        names = ", ".join('"{}"'.format(field['id']) for field in self.info)
+        # vcfanno only carries Flag fields over with the flag op
+        ops = ", ".join('"flag"' if field['type'] == 'Flag' else '"self"' for field in self.info)
+
+        return '[[annotation]]\nfile="{}"\nfields=[{}]\nops=[{}]\nnames=[{}]\n'.format(output_vcf, names, ops, names)
+
+
+def typed_value(value, field_type):
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        if field_type == 'Integer':
+            return str(int(value))
+        if field_type == 'Float':
+            return repr(float(value))
+    except ValueError:
+        return None
+
+    return info_value(value)
+
+
+def parse_line(fields, mapping, skipped, reference=None):
+    """Return (contig, position, VCF line) for a delimited row, or None after counting why it was skipped"""
+
+    if len(fields) < mapping.min_columns:
+        skipped['too_few_columns'] += 1
+        return None
+
+    position = fields[mapping.indices['position']].strip()
+    if mapping.position_format == 'chrom:start-end':
+        chrom, separator, span = position.partition(':')
+        if not separator:
+            skipped['missing_position'] += 1
+            return None
+        position = span.split('-')[0]
+    else:
+        chrom = fields[mapping.indices['chrom']]
+    chrom = normalise_contig(chrom) if mapping.strip_chr else chrom.strip()
+    if not chrom:
+        skipped['missing_position'] += 1
+        return None
+    try:
+        position = int(position)
+    except ValueError:
+        skipped['invalid_position'] += 1
+        return None
+    if position < 1:
+        skipped['invalid_position'] += 1
+        return None
+
+    alleles = vcf_alleles(chrom, position, fields[mapping.indices['ref']], fields[mapping.indices['alt']],
+                          reference, skipped)
+    if alleles is None:
+        return None
+    position, ref, alt = alleles
+
+    info = list()
+    for field in mapping.info:
+        value = typed_value(fields[field['index']], field['type'])
+        if field['type'] == 'Flag':
+            if value and value.lower() not in ('0', 'false', 'no', '.'):
+                info.append(field['id'])
+        elif value is not None:
+            info.append("{}={}".format(field['id'], value))
+        elif fields[field['index']].strip():
+            skipped['invalid_{}_values'.format(field['id'])] += 1
+        elif mapping.empty_value is not None:
+            info.append("{}={}".format(field['id'], mapping.empty_value))
+
+    return chrom, position, "{}\t{}\t.\t{}\t{}\t.\tPASS\t{}\n".format(chrom, position, ref, alt,
+                                                                     ";".join(info) or ".")
+
+
+def init_worker(mapping, reference_fasta):
+    global worker_mapping, worker_reference
+    worker_mapping = mapping
+    worker_reference = ReferenceSequence(reference_fasta) if reference_fasta else None
+
+
+def parse_chunk(lines):
+    skipped = Counter()
+    records = list()
+    for line in lines:
+        if not line.strip():
+            continue
+        record = parse_line(line.rstrip('\r\n').split(worker_mapping.delimiter), worker_mapping, skipped,
+                             worker_reference)
+        if record is not None:
+            records.append(record)
+
+    return records, skipped
+
+
+def read_header(handle, mapping):
+    """Skip leading lines and return the header fields, or None when the mapping says there is no header"""
+
+    for _ in range(mapping.skip_lines):
+        handle.readline()
+    if not mapping.header:
+        return None
+
+    return handle.readline().rstrip('\r\n').split(mapping.delimiter)
+
+
+def read_chunks(handle):
+    """Yield the rest of the input as lists of lines"""
+
+    while True:
+        lines = handle.readlines(READ_CHUNK_BYTES)
+        if not lines:
+            break
+        yield lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a delimited database to a sorted, indexed VCF "
+                                                 "annotation source using a column mapping file")
+    parser.add_argument('-i', '--infile', help="Delimited input database")
+    parser.add_argument('-m', '--mapping', help="Column mapping file (see specialist/source_mappings)")
+    parser.add_argument('-o', '--outfile', help="Output VCF. Names ending in .gz are bgzipped and tabix indexed")
+    parser.add_argument('-r', '--reference', help="Indexed reference FASTA, used to anchor '-' allele indels")
+    parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count(),
+                        help="Parser processes")
+    parser.add_argument('-b', '--buffer_size', type=int, default=1000000,
+                        help="Records held in memory before spilling a sorted run to disk")
+    parser.add_argument('-t', '--temp_dir', help="Directory for temporary sort runs")
+    parser.add_argument('-f', '--fragment', help="File for the vcfanno config fragment (default: <outfile>.toml)")
+    args = parser.parse_args()
+
+    source_mapping = SourceMapping(args.mapping)
+
+    total_skipped = Counter()
+    sorter = ExternalSorter(args.buffer_size, args.temp_dir)
+    sys.stdout.write("Parsing {} with {} processes\n".format(args.infile, args.processes))
+    with io.open(args.infile, 'r', buffering=READ_CHUNK_BYTES) as infile:
+        source_mapping.resolve(read_header(infile, source_mapping))
+        pool = multiprocessing.Pool(args.processes, init_worker, (source_mapping, args.reference))
+        for chunk_records, chunk_skipped in pool.imap(parse_chunk, read_chunks(infile)):
+            sorter.extend(chunk_records)
+            total_skipped.update(chunk_skipped)
+        pool.close()
+        pool.join()
+
+    sys.stdout.write("Writing {} sorted records to {}\n".format(sorter.count, args.outfile))
+    write_vcf(args.outfile, source_mapping.vcf_header(), sorter.sorted_lines())
+
+    fragment_file = args.fragment or "{}.toml".format(args.outfile)
+    with open(fragment_file, 'w') as fragment:
+        fragment.write(source_mapping.vcfanno_fragment(args.outfile))
+    sys.stdout.write("Wrote vcfanno config fragment to {}\n".format(fragment_file))
+
+    for reason in sorted(total_skipped):
+        sys.stdout.write("Skipped {} rows: {}\n".format(total_skipped[reason], reason))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# Standard packages
+import sys
+import struct
+import argparse
+
+from array import array
+from collections import defaultdict
+
+from bgzf import BgzfReader
+
+
+INDEX_MAGIC = b"GIDX\x01"
+SEVERITIES = {'MODIFIER': 0, 'LOW': 1, 'MODERATE': 2, 'HIGH': 3}
+GENE = 0
+TRANSCRIPT = 1
+
+
+class IndexedRecord(object):
+    """Just enough of a cyvcf2 Variant (CHROM, POS, REF, ALT and INFO.get) to decode effects from a VCF line"""
+
+    def __init__(self, line):
+        fields = line.rstrip('\n').split('\t', 8)
+        self.CHROM = fields[0]
+        self.POS = int(fields[1])
+        self.REF = fields[3]
+        self.ALT = fields[4].split(',')
+        self.INFO = dict()
+        if fields[7] != '.':
+            for entry in fields[7].split(';'):
+                key, _, value = entry.partition('=')
+                self.INFO[key] = value if value else True
+
+
+def parse_annotation_keys(header_line):
+    description = header_line.split('Description="', 1)[1].rsplit('"', 1)[0]
+    return [key.strip(" '\"") for key in description.split(":", 1)[1].split("|")]
+
+
+def record_features(info, key_index):
+    """Return {(kind, name): max severity} for the genes and transcripts in a record's ANN field"""
+
+    features = dict()
+    ann = None
+    for entry in info.split(';'):
+        if entry.startswith("ANN="):
+            ann = entry[4:]
+            break
+    if ann is None:
+        return features
+
+    gene_column, transcript_column, impact_column = key_index
+    for effect in ann.split(','):
+        fields = effect.split('|')
+        severity = SEVERITIES.get(fields[impact_column], 0) if impact_column < len(fields) else 0
+        for kind, column in ((GENE, gene_column), (TRANSCRIPT, transcript_column)):
+            if column < len(fields) and fields[column]:
+                key = (kind, fields[column])
+                if severity >= features.get(key, -1):
+                    features[key] = severity
+
+    return features
+
+
+def build_index(vcf_file):
+    """Scan a bgzipped snpEff-annotated VCF once, mapping genes and transcripts to record offsets"""
+
+    offsets = defaultdict(lambda: array('Q'))
+    severities = defaultdict(lambda: array('B'))
+    key_index = None
+
+    with BgzfReader(vcf_file) as reader:
+        for offset, line in reader.lines():
+            line = line.decode('utf-8')
+            if line.startswith('#'):
+                if line.startswith("##INFO=<ID=ANN,"):
+                    keys = parse_annotation_keys(line)
+                    key_index = (keys.index("Gene_Name"), keys.index("Feature_ID"), keys.index("Annotation_Impact"))
+                continue
+            if key_index is None:
+                raise ValueError("{} has no snpEff ANN header".format(vcf_file))
+            info = line.split('\t', 8)[7]
+            for key, severity in record_features(info, key_index).items():
+                offsets[key].append(offset)
+                severities[key].append(severity)
+
+    return offsets, severities
+
+
+def write_index(index_file, offsets, severities):
+    with open(index_file, 'wb') as index:
+        index.write(INDEX_MAGIC)
+        index.write(struct.pack("<I", len(offsets)))
+        for kind, name in sorted(offsets):
+            encoded = name.encode('utf-8')
+            key_offsets = offsets[(kind, name)]
+            index.write(struct.pack("<BHI", kind, len(encoded), len(key_offsets)))
+            index.write(encoded)
+            index.write(struct.pack("<{}Q".format(len(key_offsets)), *key_offsets))
+            index.write(struct.pack("<{}B".format(len(key_offsets)), *severities[(kind, name)]))
+
+
+def read_index(index_file):
+    """Load a gene index as {(kind, name): [(virtual offset, severity), ...]}"""
+
+    entries = dict()
+    with open(index_file, 'rb') as index:
+        data = index.read()
+    if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise IOError("{} is not a gene index".format(index_file))
+
+    position = len(INDEX_MAGIC)
+    num_keys = struct.unpack_from("<I", data, position)[0]
+    position += 4
+    for _ in range(num_keys):
+        kind, name_length, count = struct.unpack_from("<BHI", data, position)
+        position += 7
+        name = data[position:position + name_length].decode('utf-8')
+        position += name_length
+        key_offsets = struct.unpack_from("<{}Q".format(count), data, position)
+        position += 8 * count
+        key_severities = struct.unpack_from("<{}B".format(count), data, position)
+        position += count
+        entries[(kind, name)] = list(zip(key_offsets, key_severities))
+
+    return entries
+
+
+def query_records(vcf_file, index, genes=(), transcripts=(), min_severity=0):
+    """Yield IndexedRecords for the requested genes and transcripts in file order, seeking directly to them"""
+
+    wanted = set()
+    for kind, names in ((GENE, genes), (TRANSCRIPT, transcripts)):
+        for name in names:
+            for offset, severity in index.get((kind, name), ()):
+                if severity >= min_severity:
+                    wanted.add(offset)
+
+    with BgzfReader(vcf_file) as reader:
+        for offset in sorted(wanted):
+            reader.seek(offset)
+            yield IndexedRecord(reader.readline().decode('utf-8'))
+
+
+def index_name(vcf_file):
+    return "{}.gidx".format(vcf_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a gene/transcript index for a bgzipped snpEff VCF")
+    parser.add_argument('-a', '--annotated_vcf', help="bgzipped snpEff annotated VCF file to index")
+    parser.add_argument('-o', '--output', help="Index file name (default: <annotated_vcf>.gidx)")
+    args = parser.parse_args()
+
+    sys.stdout.write("Indexing {}\n".format(args.annotated_vcf))
+    key_offsets, key_severities = build_index(args.annotated_vcf)
+    write_index(args.output or index_name(args.annotated_vcf), key_offsets, key_severities)
+    sys.stdout.write("Indexed {} genes and transcripts\n".format(len(key_offsets)))
@@ -1,12 +1,35 @@
 #!/usr/bin/env python
 
 # Standard packages
+import os
+import re
 import sys
-import cyvcf2
+import heapq
+import shutil
 import argparse
+import tempfile
+import multiprocessing
+
 import geneimpacts
 
 from cyvcf2 import VCF
+from collections import defaultdict
+
+import gene_index
+
+# Decoded ANN strings are memoised per process; the cache is reset when it grows past this many entries
+MAX_CACHED_ANNOTATIONS = 100000
+
+worker_vcf = None
+worker_keys = None
+annotation_cache = dict()
+
+
+def get_annotation_keys(vcf):
+    desc = vcf["ANN"]["Description"]
+    annotation_keys = [x.strip("\"'") for x in re.split("\s*\|\s*", desc.split(":", 1)[1].strip('" '))]
+
+    return annotation_keys
 
 
 def get_effects(variant, annotation_keys):
@@ -27,9 +50,11 @@ def get_top_impact(effects):
 
 def get_genes(effects):
     genes_list = []
+    seen = set()
 
     for effect in effects:
-        if effect.gene not in genes_list:
+        if effect.gene not in seen:
+            seen.add(effect.gene)
             genes_list.append(effect.gene)
 
     return genes_list
@@ -46,23 +71,186 @@ def get_transcript_effects(effects):
     return transcript_effects
 
 
+def decode_annotation(variant, annotation_keys):
+    """Decode a variant's ANN field to (top impact, per-gene transcript effects), memoising on the raw string.
+    Cohort VCFs repeat the same ANN string for every sample-specific record of a variant, and neighbouring
+    variants in a gene often share it, so most records skip the geneimpacts parse entirely."""
+
+    ann = variant.INFO.get("ANN")
+    if ann is None:
+        return None
+
+    decoded = annotation_cache.get(ann)
+    if decoded is None:
+        effects = get_effects(variant, annotation_keys)
+        top_impact = get_top_impact(effects)
+        gene_effects = defaultdict(dict)
+        for effect in effects:
+            if effect.gene is not None and effect.transcript is not None:
+                gene_effects[effect.gene][effect.transcript] = "{}|{}".format(effect.biotype,
+                                                                              effect.impact_severity)
+        for gene in get_genes(effects):
+            if gene is not None:
+                gene_effects.setdefault(gene, dict())
+        decoded = ((top_impact.gene, top_impact.top_consequence, top_impact.impact_severity), dict(gene_effects))
+        if len(annotation_cache) >= MAX_CACHED_ANNOTATIONS:
+            annotation_cache.clear()
+        annotation_cache[ann] = decoded
+
+    return decoded
+
+
+def scan_variants(variants, annotation_keys, genes=None, start=None, end=None):
+    """Return a dict of gene to output rows for the variants, restricted to a gene set if given.
+    With start/end only variants whose POS falls in [start, end] are kept, so records overlapping two
+    chunks are reported once."""
+
+    gene_rows = defaultdict(list)
+    for variant in variants:
+        if start is not None and not start <= variant.POS <= end:
+            continue
+        decoded = decode_annotation(variant, annotation_keys)
+        if decoded is None:
+            continue
+        top_impact, gene_effects = decoded
+        for gene, transcripts in gene_effects.items():
+            if genes is not None and gene not in genes:
+                continue
+            transcript_data = ",".join("{}={}".format(transcript, transcripts[transcript])
+                                       for transcript in sorted(transcripts))
+            gene_rows[gene].append((variant.CHROM, variant.POS, variant.REF, ",".join(variant.ALT),
+                                    top_impact[0], top_impact[1], top_impact[2], transcript_data))
+
+    return gene_rows
+
+
+def write_chunk(gene_rows, chunk_file):
+    """Write a chunk's rows grouped by gene, each gene's rows in the order they were scanned"""
+
+    with open(chunk_file, 'w') as output:
+        for gene in sorted(gene_rows):
+            for row in gene_rows[gene]:
+                output.write("{}\t{}\n".format(gene, "\t".join(str(value) for value in row)))
+
+    return chunk_file
+
+
+def spill_chunks(variants, annotation_keys, genes, temp_dir, variants_per_chunk=100000):
+    """Scan variants in genome order, writing a chunk file every variants_per_chunk records"""
+
+    chunk_files = list()
+    batch = list()
+    for variant in variants:
+        batch.append(variant)
+        if len(batch) >= variants_per_chunk:
+            chunk_files.append(write_chunk(scan_variants(batch, annotation_keys, genes),
+                                           os.path.join(temp_dir, "chunk{:06d}.tsv".format(len(chunk_files)))))
+            batch = list()
+    if batch:
+        chunk_files.append(write_chunk(scan_variants(batch, annotation_keys, genes),
+                                       os.path.join(temp_dir, "chunk{:06d}.tsv".format(len(chunk_files)))))
+
+    return chunk_files
+
+
+def chunk_lines(number, chunk_file):
+    with open(chunk_file, 'r') as chunk:
+        for line_number, line in enumerate(chunk):
+            yield line.split('\t', 1)[0], number, line_number, line
+
+
+def merge_chunks(chunk_files, output):
+    """Stream genome-ordered chunk files into output grouped by gene, keeping genome order within each gene"""
+
+    for gene, number, line_number, line in heapq.merge(*[chunk_lines(number, chunk_file)
+                                                         for number, chunk_file in enumerate(chunk_files)]):
+        output.write(line)
+
+
+def init_worker(vcf_file):
+    global worker_vcf, worker_keys
+    worker_vcf = VCF(vcf_file)
+    worker_keys = get_annotation_keys(worker_vcf)
+
+
+def scan_chunk(chunk):
+    number, contig, start, end, genes, temp_dir = chunk
+    region = contig if start is None else "{}:{}-{}".format(contig, start, end)
+
+    return write_chunk(scan_variants(worker_vcf(region), worker_keys, genes, start, end),
+                       os.path.join(temp_dir, "chunk{:06d}.tsv".format(number)))
+
+
+def contig_lengths(vcf):
+    """Return (contig, length) pairs from the VCF header, with None lengths when ##contig lines lack them"""
+
+    names = list(vcf.seqnames)
+    try:
+        lengths = list(vcf.seqlens)
+    except (AttributeError, ValueError, KeyError):
+        lengths = list()
+    if len(lengths) != len(names):
+        lengths = [None] * len(names)
+
+    return list(zip(names, lengths))
+
+
+def get_chunks(vcf, chunk_size, genes, temp_dir):
+    """Split the VCF's contigs into 1-based inclusive (contig, start, end) tabix regions, or whole contigs when
+    the header has no contig lengths"""
+
+    regions = list()
+    for contig, length in contig_lengths(vcf):
+        if not length:
+            regions.append((contig, None, None))
+            continue
+        for start in range(1, length + 1, chunk_size):
+            regions.append((contig, start, min(start + chunk_size - 1, length)))
+    if not regions:
+        raise ValueError("VCF has no contigs in its header or index, so it cannot be split; use one process")
+
+    return [(number, contig, start, end, genes, temp_dir) for number, (contig, start, end) in enumerate(regions)]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--annotated_vcf', help="snpEff annotated VCF file to scan")
     parser.add_argument('-o', '--output', help="File for output information")
+    parser.add_argument('-g', '--genes', help="Optional comma separated list of genes to report")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="Worker processes; more than one requires a tabix or CSI indexed VCF")
+    parser.add_argument('-c', '--chunk_size', type=int, default=5000000, help="Region size (bp) per work chunk")
+    parser.add_argument('-i', '--index', help="Gene index from gene_index.py (default: <annotated_vcf>.gidx "
+                                              "if present), used to seek directly to records for --genes")
+    parser.add_argument('-m', '--min_severity', default='MODIFIER', choices=sorted(gene_index.SEVERITIES),
+                        help="Minimum impact severity for indexed gene queries")
     args = parser.parse_args()
 
+    gene_set = set(args.genes.split(',')) if args.genes else None
+
     sys.stdout.write("Parsing VCFAnno VCF with CyVCF2\n")
-    reader = cyvcf2.VCFReader(args.annotated_vcf)
-    desc = reader["ANN"]["Description"]
-    annotation_keys = [x.strip("\"'") for x in re.split("\s*\|\s*", desc.split(":", 1)[1].strip('" '))]
+    vcf = VCF(args.annotated_vcf)
+    annotation_keys = get_annotation_keys(vcf)
 
+    index_file = args.index or gene_index.index_name(args.annotated_vcf)
+    chunk_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(args.output)), prefix="scan_chunks.")
     sys.stdout.write("Parsing VCFAnno VCF\n")
-    vcf = VCF(args.annotated_vcf)
-    for variant in vcf:
-        effects = get_effects(variant, annotation_keys)
-        top_impact = get_top_impact(effects)
-        gene_effects = dict()
-        for effect in effects:
-            if effect.gene not in gene_effects.keys():
-                if effect.transcript is not None:
+    if gene_set and os.path.exists(index_file):
+        sys.stdout.write("Querying {} genes with index {}\n".format(len(gene_set), index_file))
+        records = gene_index.query_records(args.annotated_vcf, gene_index.read_index(index_file), gene_set,
+                                           min_severity=gene_index.SEVERITIES[args.min_severity])
+        chunk_files = spill_chunks(records, annotation_keys, gene_set, chunk_dir)
+    elif args.processes > 1:
+        chunks = get_chunks(vcf, args.chunk_size, gene_set, chunk_dir)
+        sys.stdout.write("Scanning {} chunks with {} processes\n".format(len(chunks), args.processes))
+        pool = multiprocessing.Pool(args.processes, init_worker, (args.annotated_vcf,))
+        chunk_files = list(pool.imap(scan_chunk, chunks))
+        pool.close()
+        pool.join()
+    else:
+        chunk_files = spill_chunks(vcf, annotation_keys, gene_set, chunk_dir)
+
+    with open(args.output, 'w') as output:
+        output.write("Gene\tChrom\tPos\tRef\tAlt\tTop Gene\tTop Consequence\tTop Severity\tTranscripts\n")
+        merge_chunks(chunk_files, output)
+    shutil.rmtree(chunk_dir)
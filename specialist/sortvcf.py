@@ -0,0 +1,99 @@
+import os
+import re
+import heapq
+import tempfile
+import subprocess
+
+
+def contig_key(contig):
+    """Sort key placing 1-22, X, Y and MT first in karyotype order, then other contigs by name"""
+
+    name = re.sub(r'^chr', '', contig)
+    if name.isdigit():
+        return 0, int(name), ""
+    order = {'X': 23, 'Y': 24, 'M': 25, 'MT': 25}
+    if name in order:
+        return 0, order[name], ""
+
+    return 1, 0, name
+
+
+class ExternalSorter(object):
+    """Sort VCF records by (contig, position) in bounded memory.
+
+    Records are buffered and spilled to sorted temporary runs of at most buffer_size records, then streamed
+    back through a k-way merge."""
+
+    def __init__(self, buffer_size=1000000, temp_dir=None):
+        self.buffer_size = buffer_size
+        self.temp_dir = temp_dir
+        self.buffer = list()
+        self.runs = list()
+        self.count = 0
+
+    def add(self, contig, position, line):
+        self.buffer.append((contig_key(contig), position, line))
+        self.count += 1
+        if len(self.buffer) >= self.buffer_size:
+            self._spill()
+
+    def extend(self, keyed_records):
+        for contig, position, line in keyed_records:
+            self.add(contig, position, line)
+
+    def _spill(self):
+        self.buffer.sort()
+        handle, run_file = tempfile.mkstemp(dir=self.temp_dir, prefix="vcfsort.", suffix=".run")
+        with os.fdopen(handle, 'w') as run:
+            for key, position, line in self.buffer:
+                run.write(line)
+        self.runs.append(run_file)
+        self.buffer = list()
+
+    def _read_run(self, run_file):
+        with open(run_file, 'r') as run:
+            for line in run:
+                fields = line.split('\t', 2)
+                yield contig_key(fields[0]), int(fields[1]), line
+
+    def sorted_lines(self):
+        """Yield all records in sorted order, removing temporary runs afterwards"""
+
+        self.buffer.sort()
+        try:
+            if not self.runs:
+                for key, position, line in self.buffer:
+                    yield line
+                return
+            if self.buffer:
+                self._spill()
+            for key, position, line in heapq.merge(*[self._read_run(run) for run in self.runs]):
+                yield line
+        finally:
+            for run in self.runs:
+                if os.path.exists(run):
+                    os.remove(run)
+            self.runs = list()
+            self.buffer = list()
+
+
+def write_vcf(output_file, header, lines):
+    """Write a VCF. Outputs ending in .gz are bgzip compressed and tabix indexed for use with vcfanno"""
+
+    if not output_file.endswith('.gz'):
+        with open(output_file, 'w') as output:
+            output.write(header)
+            output.writelines(lines)
+        return
+
+    with open(output_file, 'wb') as output:
+        bgzip = subprocess.Popen(["bgzip", "-c"], stdin=subprocess.PIPE, stdout=output,
+                                 universal_newlines=True)
+        bgzip.stdin.write(header)
+        for line in lines:
+            bgzip.stdin.write(line)
+        bgzip.stdin.close()
+        if bgzip.wait() != 0:
+            raise subprocess.CalledProcessError(bgzip.returncode, "bgzip -c")
+
+    subprocess.check_call(["tabix", "-f", "-p", "vcf", output_file])
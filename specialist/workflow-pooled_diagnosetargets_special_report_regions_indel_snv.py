@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 # Standard packages
+import os
 import sys
 import argparse
 
@@ -12,6 +13,10 @@ from ddb import configuration
 from ddb_ngsflow import gatk
 from ddb_ngsflow import pipeline
 
+# Local methods
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import coverage_engine
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -39,8 +44,17 @@ if __name__ == "__main__":
                                                    samples, samples[sample]['bam1'], samples[sample]['bam2'],
                                                    cores=int(config['gatk']['num_cores']),
                                                    memory="{}G".format(config['gatk']['max_mem']))
+
+        # DiagnoseTargets keeps its VCF output for the report sets; coverage of every region set over both
+        # pooled BAMs comes from one pass instead of a sambamba run per set
+        region_keys = [key for key in ("regions", "snv_regions", "indel_regions") if samples[sample].get(key)]
+        coverage_job = Job.wrapJobFn(coverage_engine.pooled_region_coverage, config, sample, samples, region_keys,
+                                     [samples[sample]['bam1'], samples[sample]['bam2']],
+                                     cores=int(config['gatk']['num_cores']),
+                                     memory="{}G".format(config['gatk']['max_mem']))
         root_job.addChild(diagnose_snv_targets_job)
         root_job.addChild(diagnose_indel_targets_job)
+        root_job.addChild(coverage_job)
 
     # Start workflow execution
     Job.Runner.startToil(root_job, args)
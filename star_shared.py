@@ -0,0 +1,161 @@
+import os
+import math
+import fcntl
+import hashlib
+import tempfile
+
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+# Package methods
+import rna_alignment
+import shell_commands
+import samples_config
+from ddb_ngsflow import pipeline
+
+
+def node_batches(samples, samples_per_node):
+    """Split samples, in sorted order, into batches that each run on one node against a shared genome"""
+
+    ordered = sorted(samples)
+
+    return [ordered[i:i + samples_per_node] for i in range(0, len(ordered), samples_per_node)]
+
+
+def batch_resources(config, batch_size):
+    """Return (cores, memory in GB) for a node batch: one genome copy plus, per concurrent alignment, STAR's
+    working memory and its samtools sort threads' sort_mem_per_thread"""
+
+    concurrent = min(batch_size, int(config['star'].get('jobs_per_node', batch_size)))
+    genome_mem = int(config['star'].get('genome_mem', config['star']['max_mem']))
+    job_mem = int(config['star'].get('shared_job_mem', 8)) + rna_alignment.sort_memory(config, 'star')
+
+    return int(config['star']['num_cores']) * concurrent, genome_mem + int(math.ceil(job_mem * concurrent))
+
+
+def genome_lock_file(config, suffix):
+    digest = hashlib.sha1(config['star']['index'].encode('utf-8')).hexdigest()
+
+    return os.path.join(tempfile.gettempdir(), "star_genome.{}.{}".format(digest, suffix))
+
+
+@contextmanager
+def genome_loader(config):
+    """Hold this node's exclusive lock for loading or removing the shared genome. Node batches are separate Toil
+    jobs that may land on the same node, so loading and the last-user check for removal are serialised"""
+
+    with open(genome_lock_file(config, "load"), 'a') as handle:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def last_genome_user(users):
+    """True when no other process holds a shared lock on the genome users file. Every batch holds one for as
+    long as it uses the genome, and the kernel drops it when the process exits, even if it is killed"""
+
+    try:
+        fcntl.flock(users.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+def genome_command(config, action, prefix):
+    return " ".join(["{}".format(config['star']['bin']),
+                     "--genomeDir", "{}".format(config['star']['index']),
+                     "--genomeLoad", "{}".format(action),
+                     "--outSAMtype", "None",
+                     "--outFileNamePrefix", "{}".format(prefix)])
+
+
+def star_command(config, sample, samples, flags, paired=True):
+    """STAR command aligning one sample against the genome already held in shared memory, streamed into a
+    coordinate sort and index"""
+
+    fastqs = [samples[sample]['fastq1']]
+    if paired:
+        fastqs.append(samples[sample]['fastq2'])
+
+    command = ["{}".format(config['star']['bin']),
+               "--genomeDir", "{}".format(config['star']['index']),
+               "--genomeLoad", "LoadAndKeep",
+               "--runThreadN", "{}".format(config['star']['num_cores']),
+               "--readFilesIn", "{}".format(" ".join(fastqs)),
+               "--outFileNamePrefix", "{}.star.".format(sample),
+               # Uncompressed BAM is streamed to samtools sort rather than sorted by STAR
+               "--outSAMtype", "BAM", "Unsorted",
+               "--outStd", "BAM_Unsorted",
+               "--outBAMcompression", "0"]
+
+    if "compressed" in flags:
+        command.extend(["--readFilesCommand", "zcat"])
+    if "keep_retained" in flags:
+        command.extend(["--outReadsUnmapped", "Fastx"])
+    if "cufflinks" in flags:
+        command.extend(["--outSAMstrandField", "intronMotif"])
+    if "chimeric" in flags:
+        # Chimeric alignments are written to {sample}.star.Chimeric.out.junction for fusion detection
+        command.extend(["--chimSegmentMin", "{}".format(config['star'].get('chim_segment_min', 12)),
+                        "--chimJunctionOverhangMin", "{}".format(config['star'].get('chim_overhang_min', 12)),
+                        "--chimOutType", "Junctions"])
+
+    output_bam = "{}.star.Aligned.sortedByCoord.out.bam".format(sample)
+
+    return "{} && {}".format(shell_commands.pipefail("{} | {}".format(" ".join(command),
+                                                                      rna_alignment.sort_command(config, 'star',
+                                                                                                 output_bam))),
+                             rna_alignment.index_command(config, output_bam))
+
+
+def star_node_batch(job, config, batch, samples, flags, paired=True):
+    """Load the STAR genome into shared memory once and align a batch of samples against it concurrently.
+    config['star']['index'] (the STAR genome directory) is required. The genome is removed from shared memory
+    when the last batch on the node finishes, unless star keep_genome is set
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param batch: Names of the samples aligned on this node.
+    :type batch: list.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param flags: STAR option flags (compressed, keep_retained, cufflinks, chimeric).
+    :type flags: list.
+    :param paired: Whether samples have paired FASTQ files.
+    :type paired: bool.
+    :returns:  dict -- Dictionary of sample name to sorted STAR BAM file.
+    """
+
+    batch_name = "{}.star_batch.{}".format(samples_config.run_name(config, samples, batch), batch[0])
+    logfile = "{}.genome.log".format(batch_name)
+
+    job.fileStore.logToMaster("Loading STAR genome {} into shared memory for {} samples\n".format(
+        config['star']['index'], len(batch)))
+    users = open(genome_lock_file(config, "users"), 'a')
+    with genome_loader(config):
+        fcntl.flock(users.fileno(), fcntl.LOCK_SH)
+        pipeline.run_and_log_command(genome_command(config, "LoadAndExit", "{}.load.".format(batch_name)),
+                                     logfile)
+
+    def align(sample):
+        command = star_command(config, sample, samples, flags, paired)
+        job.fileStore.logToMaster("STAR Command: {}\n".format(command))
+        pipeline.run_and_log_command(command, "{}.star.log".format(sample))
+
+        return sample, "{}.star.Aligned.sortedByCoord.out.bam".format(sample)
+
+    pool = ThreadPool(min(len(batch), int(config['star'].get('jobs_per_node', len(batch)))))
+    try:
+        outputs = dict(pool.map(align, batch))
+    finally:
+        pool.close()
+        pool.join()
+        with genome_loader(config):
+            if not last_genome_user(users):
+                job.fileStore.logToMaster("Leaving STAR genome {} loaded for other batches\n".format(
+                    config['star']['index']))
+            elif config['star'].get('keep_genome', 'false').lower() not in ('true', 'yes', '1'):
+                pipeline.run_and_log_command(genome_command(config, "Remove", "{}.remove.".format(batch_name)),
+                                             logfile)
+        users.close()
+
+    return outputs
@@ -0,0 +1,149 @@
+import os
+import shutil
+
+# Package methods
+import intervals
+from ddb_ngsflow import pipeline
+
+
+def assembly_checksums(gtfs):
+    return dict((os.path.abspath(gtf), intervals.file_checksum(gtf)) for gtf in gtfs)
+
+
+def read_manifest(merged_gtf):
+    """Return {absolute assembly GTF path: checksum} for the assemblies already merged into merged_gtf"""
+
+    manifest = "{}.manifest".format(merged_gtf)
+    if not os.path.exists(manifest):
+        return dict()
+    merged = dict()
+    with open(manifest, 'r') as handle:
+        for line in handle:
+            if line.strip():
+                path, _, checksum = line.rstrip('\n').partition('\t')
+                merged[path] = checksum
+    return merged
+
+
+def write_manifest(merged_gtf, assemblies):
+    """Record the (path, checksum) pairs of the assemblies merged into merged_gtf"""
+
+    with open("{}.manifest".format(merged_gtf), 'w') as handle:
+        for path, checksum in sorted(assemblies):
+            handle.write("{}\t{}\n".format(path, checksum))
+
+
+def run_merge(job, config, inputs, output, union):
+    """Run stringtie --merge. Sample assemblies are filtered with the configured defaults, while unions of
+    already merged GTFs keep every transcript (-F 0 -T 0 -f 0) so nothing is filtered twice"""
+
+    logfile = "{}.log".format(output)
+
+    command = ["{}".format(config['stringtie']['bin']),
+               "--merge",
+               "-p", "{}".format(config['stringtie']['num_cores']),
+               "-o", "{}".format(output)]
+    if config.get('transcript_reference'):
+        command.extend(["-G", "{}".format(config['transcript_reference'])])
+    if union:
+        command.extend(["-F", "0", "-T", "0", "-f", "0"])
+    command.extend(inputs)
+
+    job.fileStore.logToMaster("StringTie merge command: {}\n".format(" ".join(command)))
+    pipeline.run_and_log_command(" ".join(command), logfile)
+
+    return output
+
+
+def merge_batch(job, config, inputs, output, union):
+    return run_merge(job, config, inputs, output, union)
+
+
+def tree_merge(job, config, gtfs, output, fan_in, level=0, carry=(), leaves=()):
+    """Merge GTFs in parallel batches of at most fan_in, then merge the batch results level by level.
+
+    Sample assemblies are merged (and filtered) once at level 0, and later levels only take unions. carry
+    holds an existing merged reference that joins the last union. leaves holds the (path, checksum) pairs
+    recorded in the output's manifest.
+
+    -F and -T filter each input transcript on its own, but -f (minimum isoform fraction) compares a transcript
+    with the most abundant isoform of its locus among the inputs merged together. With more than fan_in
+    assemblies it is applied within each level 0 batch, so the result can differ slightly from one flat merge;
+    merged GTFs carry no abundances, so the fraction cannot be applied again at the final level."""
+
+    leaves = list(leaves) or sorted(assembly_checksums(gtfs).items())
+    if (level > 0 or not carry) and len(gtfs) + len(carry) <= fan_in:
+        run_merge(job, config, list(carry) + list(gtfs), output, union=level > 0 or bool(carry))
+        write_manifest(output, leaves)
+        return output
+
+    batch_outputs = list()
+    for number, start in enumerate(range(0, len(gtfs), fan_in)):
+        batch_output = "{}.level{}.batch{}.gtf".format(os.path.splitext(output)[0], level, number)
+        batch_job = job.addChildJobFn(merge_batch, config, gtfs[start:start + fan_in], batch_output, level > 0,
+                                      cores=int(config['stringtie']['num_cores']),
+                                      memory="{}G".format(config['stringtie']['max_mem']))
+        batch_outputs.append(batch_job.rv())
+
+    job.addFollowOnJobFn(tree_merge, config, batch_outputs, output, fan_in, level + 1, carry, leaves,
+                         cores=int(config['stringtie']['num_cores']),
+                         memory="{}G".format(config['stringtie']['max_mem']))
+
+    return output
+
+
+def merge_assemblies(job, config, gtfs, output):
+    """Merge sample assemblies into a cohort reference by tree reduction. If config['stringtie'] sets
+    existing_merge, only assemblies missing from that reference's manifest are merged into it. When an
+    assembly in the manifest has changed since, the reference is rebuilt from all assemblies instead, since
+    a union cannot drop the changed assembly's old transcripts
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param gtfs: The per-sample StringTie assembly GTF files.
+    :type gtfs: list.
+    :param output: The merged GTF file name.
+    :type output: str.
+    :returns:  str -- The merged GTF file name.
+    """
+
+    fan_in = int(config['stringtie'].get('merge_fan_in', 16))
+    existing = config['stringtie'].get('existing_merge')
+    carry = list()
+    checksums = assembly_checksums(gtfs)
+
+    merged = read_manifest(existing) if existing else dict()
+    changed = [path for path, checksum in checksums.items() if path in merged and merged[path] != checksum]
+    if changed:
+        # Assemblies merged earlier but not given this time are merged again if they are still on disk
+        previous = [path for path in merged if path not in checksums and os.path.exists(path)]
+        job.fileStore.logToMaster("{} assemblies changed since {} was merged, rebuilding it from {} "
+                                  "assemblies\n".format(len(changed), existing, len(gtfs) + len(previous)))
+        gtfs = list(gtfs) + previous
+        checksums.update(assembly_checksums(previous))
+        existing = None
+    leaves = sorted(checksums.items())
+
+    if existing:
+        new_gtfs = [gtf for gtf in gtfs if os.path.abspath(gtf) not in merged]
+        job.fileStore.logToMaster("Merging {} new of {} assemblies into {}\n".format(len(new_gtfs), len(gtfs),
+                                                                                   existing))
+        merged.update(checksums)
+        leaves = sorted(merged.items())
+        if not new_gtfs:
+            if os.path.abspath(existing) != os.path.abspath(output):
+                shutil.copyfile(existing, output)
+            write_manifest(output, leaves)
+            return output
+        gtfs = new_gtfs
+        if os.path.abspath(existing) == os.path.abspath(output):
+            # Updating in place, so keep the previous reference readable while the new one is written
+            previous = "{}.previous.gtf".format(os.path.splitext(output)[0])
+            shutil.copyfile(existing, previous)
+            existing = previous
+        carry = [existing]
+
+    job.addChildJobFn(tree_merge, config, gtfs, output, fan_in, 0, carry, leaves,
+                      cores=int(config['stringtie']['num_cores']),
+                      memory="{}G".format(config['stringtie']['max_mem']))
+
+    return output
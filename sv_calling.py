@@ -0,0 +1,278 @@
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+
+# Package methods
+import intervals
+from ddb_ngsflow import pipeline
+
+
+# Manta result VCF for each input mode
+MANTA_RESULTS = {'tumor': "tumorSV.vcf.gz", 'germline': "diploidSV.vcf.gz", 'rna': "rnaSV.vcf.gz"}
+
+# Manta writes small indels with sequence alleles and larger events with symbolic ALTs (<DEL>, <DUP:TANDEM>,
+# <INS>) or as BND breakend pairs linked by MATEID. Downstream in the somatic amplicon workflow:
+#   - vt_normalization leaves symbolic and breakend alleles as they are (vt only decomposes and left aligns
+#     sequence alleles), so {sample}.manta.normalized.vcf keeps every record;
+#   - merge_variant_calls combines them with the other callers' records by position and alleles, so an SV
+#     only merges with another caller's call that has the same symbolic or breakend ALT (in practice none);
+#   - process_sample parses {sample}.manta.normalized.vcf into the manta caller data of variants present in
+#     the annotated VCF; snpEff annotates symbolic and breakend records, and each BND mate is its own record.
+
+
+def manta_mode(config, rna=False):
+    if rna:
+        return 'rna'
+
+    return config['manta'].get('mode', 'tumor')
+
+
+def call_intervals(config, sample, samples):
+    """Return (intervals, is_targeted): the sample's panel regions plus manta padding, or whole reference
+    contigs from the FASTA index when the sample has no regions"""
+
+    if samples[sample].get('regions'):
+        index = intervals.IntervalIndex.from_bed(samples[sample]['regions'],
+                                                 int(config['manta'].get('padding', 500)))
+        return [(contig, start, end) for contig in index.contigs() for start, end in index.intervals(contig)], True
+
+    with open("{}.fai".format(config['reference']), 'r') as fai:
+        return [(fields[0], 0, int(fields[1])) for fields in (line.split('\t') for line in fai if line.strip())], \
+            False
+
+
+def chunk_intervals(call_regions, num_chunks):
+    """Balance intervals into at most num_chunks chunks by total span, largest interval first"""
+
+    num_chunks = max(1, min(num_chunks, len(call_regions)))
+    chunks = [list() for _ in range(num_chunks)]
+    loads = [0] * num_chunks
+    for contig, start, end in sorted(call_regions, key=lambda region: region[1] - region[2]):
+        lightest = loads.index(min(loads))
+        chunks[lightest].append((contig, start, end))
+        loads[lightest] += end - start
+
+    return [sorted(chunk) for chunk in chunks if chunk]
+
+
+def cache_key(config, input_bam, call_regions, mode):
+    """Key a Manta result by the BAM checksum, the call regions and every setting that changes the calls"""
+
+    digest = hashlib.sha1()
+    digest.update(intervals.file_checksum(input_bam).encode('ascii'))
+    for contig, start, end in sorted(call_regions):
+        digest.update("{}:{}-{};".format(contig, start, end).encode('ascii'))
+    digest.update("|".join([mode, config['reference'], config['manta']['bin']]).encode('ascii'))
+
+    return digest.hexdigest()
+
+
+def cached_result(config, key):
+    cache_dir = config['manta'].get('cache_dir', os.path.join("Intermediates", "manta_cache"))
+
+    return os.path.join(cache_dir, "{}.vcf".format(key))
+
+
+def store_result(vcf, cache_file):
+    """Copy a result VCF into the cache through a temporary file so concurrent jobs never see a partial file"""
+
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    handle, temp_file = tempfile.mkstemp(dir=cache_dir, prefix=os.path.basename(cache_file))
+    os.close(handle)
+    shutil.copyfile(vcf, temp_file)
+    os.rename(temp_file, cache_file)
+
+
+def manta_chunk(job, config, sample, input_bam, bed, run_dir, mode, targeted):
+    """Configure and run Manta over one chunk of call regions
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param input_bam: The input BAM file.
+    :type input_bam: str.
+    :param bed: The chunk's call regions BED file.
+    :type bed: str.
+    :param run_dir: The Manta run directory.
+    :type run_dir: str.
+    :param mode: tumor, germline or rna.
+    :type mode: str.
+    :param targeted: Whether the regions are a targeted panel (Manta --exome).
+    :type targeted: bool.
+    :returns:  str -- The chunk's result VCF.
+    """
+
+    logfile = "{}.log".format(run_dir)
+
+    # configureManta.py refuses an existing run directory, so a retried job starts from a clean one
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+
+    configure = ["{}".format(config['manta']['bin']),
+                 "--tumorBam" if mode == 'tumor' else "--bam", "{}".format(input_bam),
+                 "--referenceFasta", "{}".format(config['reference']),
+                 "--runDir", "{}".format(run_dir),
+                 "--callRegions", "{}.gz".format(bed)]
+    if targeted:
+        configure.append("--exome")
+    if mode == 'rna':
+        configure.append("--rna")
+
+    command = "bgzip -c {bed} > {bed}.gz && tabix -f -p bed {bed}.gz && {configure} && " \
+              "{run_dir}/runWorkflow.py -m local -j {cores} -g {mem}".format(bed=bed,
+                                                                            configure=" ".join(configure),
+                                                                            run_dir=run_dir,
+                                                                            cores=config['manta']['num_cores'],
+                                                                            mem=config['manta']['max_mem'])
+
+    job.fileStore.logToMaster("Manta Command: {}\n".format(command))
+    pipeline.run_and_log_command(command, logfile)
+
+    return os.path.join(run_dir, "results", "variants", MANTA_RESULTS[mode])
+
+
+def info_value(info, key):
+    for field in info.split(';'):
+        if field.startswith("{}=".format(key)):
+            return field[len(key) + 1:]
+
+    return None
+
+
+def chunk_events(chunk_vcf, number):
+    """Read a chunk VCF into (header lines, [(event key, [fields, ...]), ...]). Record IDs and MATEIDs get a
+    chunk prefix, since every Manta run numbers its IDs from scratch. Breakend mates form one event keyed by
+    both mates, other records are keyed by position, alleles and END"""
+
+    header = list()
+    records = list()
+    with gzip.open(chunk_vcf, 'rb') as vcf:
+        for line in vcf:
+            line = line.decode('ascii')
+            if line.startswith('#'):
+                header.append(line)
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if fields[2] != '.':
+                fields[2] = "c{}_{}".format(number, fields[2])
+            mate = info_value(fields[7], 'MATEID')
+            if mate is not None:
+                fields[7] = fields[7].replace("MATEID={}".format(mate), "MATEID=c{}_{}".format(number, mate))
+            records.append(fields)
+
+    by_id = dict((fields[2], fields) for fields in records if fields[2] != '.')
+    events = list()
+    seen = set()
+    for fields in records:
+        if fields[2] in seen:
+            continue
+        mate = by_id.get(info_value(fields[7], 'MATEID'))
+        members = [fields] if mate is None else [fields, mate]
+        seen.update(member[2] for member in members)
+        key = frozenset((member[0], int(member[1]), member[3], member[4], info_value(member[7], 'END'))
+                        for member in members)
+        events.append((key, members))
+
+    return header, events
+
+
+def merge_chunks(job, config, sample, chunk_vcfs, output_vcf, cache_file):
+    """Combine chunk VCFs into one VCF in reference contig order, keeping one copy of each SV (both mates of a
+    breakend pair) called by two chunks, and cache the result
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param chunk_vcfs: The chunk result VCFs.
+    :type chunk_vcfs: list.
+    :param output_vcf: The merged VCF file name.
+    :type output_vcf: str.
+    :param cache_file: The cache file for this BAM and settings.
+    :type cache_file: str.
+    :returns:  str -- The merged VCF file name.
+    """
+
+    header = list()
+    contigs = dict()
+    events = dict()
+    for number, chunk_vcf in enumerate(chunk_vcfs):
+        chunk_header, chunk_records = chunk_events(chunk_vcf, number)
+        if number == 0:
+            header = chunk_header
+            for line in header:
+                if line.startswith("##contig=<ID="):
+                    contigs[line[len("##contig=<ID="):].split(',')[0].rstrip('>\n')] = len(contigs)
+        # Events near chunk boundaries can be called in both chunks
+        for key, members in chunk_records:
+            events.setdefault(key, members)
+
+    records = [fields for members in events.values() for fields in members]
+    ids = [fields[2] for fields in records if fields[2] != '.']
+    if len(ids) != len(set(ids)):
+        raise ValueError("Merged Manta calls for {} have duplicate record IDs".format(sample))
+
+    with open(output_vcf, 'w') as output:
+        output.writelines(header)
+        for fields in sorted(records, key=lambda fields: (contigs.get(fields[0], len(contigs)), fields[0],
+                                                         int(fields[1]))):
+            output.write("{}\n".format("\t".join(fields)))
+
+    store_result(output_vcf, cache_file)
+    job.fileStore.logToMaster("Merged {} Manta calls from {} chunks for {}\n".format(len(records),
+                                                                                  len(chunk_vcfs), sample))
+
+    return output_vcf
+
+
+def manta_sv(job, config, sample, samples, input_bam, rna=False):
+    """Call structural variants with Manta over the sample's panel regions plus padding (or the whole genome),
+    split into parallel region chunks and cached by BAM checksum
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param input_bam: The input BAM file.
+    :type input_bam: str.
+    :param rna: Whether input_bam is an RNA-Seq alignment.
+    :type rna: bool.
+    :returns:  str -- The Manta VCF ({sample}.manta.vcf).
+    """
+
+    output_vcf = "{}.manta.vcf".format(sample)
+    mode = manta_mode(config, rna)
+    call_regions, targeted = call_intervals(config, sample, samples)
+    cache_file = cached_result(config, cache_key(config, input_bam, call_regions, mode))
+
+    if os.path.isfile(cache_file):
+        job.fileStore.logToMaster("Using cached Manta calls {} for {}\n".format(cache_file, sample))
+        shutil.copyfile(cache_file, output_vcf)
+        return output_vcf
+
+    num_chunks = int(config['manta'].get('region_chunks', 1 if targeted else 4))
+    chunk_vcfs = list()
+    for number, chunk in enumerate(chunk_intervals(call_regions, num_chunks)):
+        bed = "{}.manta.chunk{}.bed".format(sample, number)
+        with open(bed, 'w') as output:
+            for contig, start, end in chunk:
+                output.write("{}\t{}\t{}\n".format(contig, start, end))
+        chunk_job = job.addChildJobFn(manta_chunk, config, sample, input_bam, bed,
+                                      "{}.manta.chunk{}".format(sample, number), mode, targeted,
+                                      cores=int(config['manta']['num_cores']),
+                                      memory="{}G".format(config['manta']['max_mem']))
+        chunk_vcfs.append(chunk_job.rv())
+
+    job.addFollowOnJobFn(merge_chunks, config, sample, chunk_vcfs, output_vcf, cache_file,
+                         cores=1,
+                         memory="2G")
+
+    return output_vcf
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+# Standard packages
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+from collections import OrderedDict
+
+# Third-party packages
+import numpy as np
+
+# Package methods
+import intervals
+
+
+TRANSCRIPT_DTYPE = np.dtype([('contig', np.int32), ('start', np.int64), ('end', np.int64), ('max_end', np.int64),
+                             ('strand', 'S1'), ('gene', np.int32), ('source', np.int32),
+                             ('exon_offset', np.int64), ('exon_count', np.int32)])
+EXON_DTYPE = np.dtype([('start', np.int64), ('end', np.int64)])
+ID_KEYS = ('gene_id', 'transcript_id', 'exon_number')
+# Bumped whenever the store layout changes, so cached stores of an older layout are rebuilt
+STORE_VERSION = 2
+
+
+def parse_attributes(field):
+    attributes = OrderedDict()
+    for entry in field.strip().split(';'):
+        entry = entry.strip()
+        if not entry:
+            continue
+        key, _, value = entry.partition(' ')
+        attributes[key] = value.strip().strip('"')
+
+    return attributes
+
+
+def format_attributes(attributes):
+    return " ".join('{} "{}";'.format(key, value) for key, value in attributes.items())
+
+
+def read_gtf(gtf_file):
+    """Collect transcripts from the transcript and exon lines of a GTF or GFF2 file.
+
+    Returns {transcript id: {'contig', 'strand', 'source', 'gene_id', 'attributes', 'exons', 'exon_attributes'}}
+    where exons are 0-based, half-open (start, end) pairs, attributes are the transcript line's extra
+    attributes and exon_attributes holds each exon line's own. Transcripts without a transcript line take the
+    attributes all their exons share."""
+
+    transcripts = OrderedDict()
+    with open(gtf_file, 'r') as gtf:
+        for line in gtf:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] not in ('transcript', 'exon'):
+                continue
+            attributes = parse_attributes(fields[8])
+            transcript_id = attributes.get('transcript_id')
+            if transcript_id is None:
+                continue
+            model = transcripts.setdefault(transcript_id, {'contig': fields[0], 'strand': fields[6],
+                                                           'source': fields[1],
+                                                           'gene_id': attributes.get('gene_id', transcript_id),
+                                                           'attributes': None, 'exons': list(),
+                                                           'exon_attributes': list()})
+            extras = OrderedDict((key, value) for key, value in attributes.items() if key not in ID_KEYS)
+            if fields[2] == 'exon':
+                model['exons'].append((int(fields[3]) - 1, int(fields[4])))
+                model['exon_attributes'].append(extras)
+            else:
+                model['attributes'] = extras
+
+    for model in transcripts.values():
+        if model['attributes'] is None:
+            shared = OrderedDict(model['exon_attributes'][0]) if model['exon_attributes'] else OrderedDict()
+            for extras in model['exon_attributes'][1:]:
+                for key in list(shared):
+                    if extras.get(key) != shared[key]:
+                        del shared[key]
+            model['attributes'] = shared
+
+    return transcripts
+
+
+def write_store(transcripts, store_dir):
+    """Write transcript models as memory-mappable arrays plus a JSON table of names, sorted by position"""
+
+    contigs = sorted(set(model['contig'] for model in transcripts.values()))
+    contig_index = dict((contig, i) for i, contig in enumerate(contigs))
+    gene_ids = sorted(set(model['gene_id'] for model in transcripts.values()))
+    gene_index = dict((gene, i) for i, gene in enumerate(gene_ids))
+    sources = sorted(set(model['source'] for model in transcripts.values()))
+    source_index = dict((source, i) for i, source in enumerate(sources))
+
+    def extent(item):
+        exons = item[1]['exons']
+        return (contig_index[item[1]['contig']], min(exon[0] for exon in exons), max(exon[1] for exon in exons),
+                item[0])
+
+    ordered = sorted(((transcript_id, model) for transcript_id, model in transcripts.items() if model['exons']),
+                     key=extent)
+
+    table = np.zeros(len(ordered), dtype=TRANSCRIPT_DTYPE)
+    exons = np.zeros(sum(len(model['exons']) for _, model in ordered), dtype=EXON_DTYPE)
+    exon_attributes = list()
+    offset = 0
+    for row, (transcript_id, model) in enumerate(ordered):
+        order = sorted(range(len(model['exons'])), key=lambda i: model['exons'][i])
+        model_exons = [model['exons'][i] for i in order]
+        exon_attributes.append([model['exon_attributes'][i] for i in order])
+        table[row] = (contig_index[model['contig']], model_exons[0][0], max(exon[1] for exon in model_exons), 0,
+                      model['strand'].encode('ascii'), gene_index[model['gene_id']], source_index[model['source']],
+                      offset, len(model_exons))
+        exons[offset:offset + len(model_exons)] = model_exons
+        offset += len(model_exons)
+
+    contig_offsets = np.searchsorted(table['contig'], np.arange(len(contigs) + 1)).tolist()
+    for i in range(len(contigs)):
+        lo, hi = contig_offsets[i], contig_offsets[i + 1]
+        table['max_end'][lo:hi] = np.maximum.accumulate(table['end'][lo:hi])
+
+    np.save(os.path.join(store_dir, "transcripts.npy"), table)
+    np.save(os.path.join(store_dir, "exons.npy"), exons)
+    with open(os.path.join(store_dir, "names.json"), 'w') as names:
+        json.dump({'contigs': contigs, 'contig_offsets': contig_offsets, 'genes': gene_ids, 'sources': sources,
+                   'transcripts': [transcript_id for transcript_id, _ in ordered],
+                   'attributes': [model['attributes'] for _, model in ordered],
+                   'exon_attributes': exon_attributes}, names)
+
+
+class TranscriptModels(object):
+    """Read-only transcript model store. Arrays are memory mapped and names loaded from names.json"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.transcripts = np.load(os.path.join(store_dir, "transcripts.npy"), mmap_mode='r')
+        self.exon_table = np.load(os.path.join(store_dir, "exons.npy"), mmap_mode='r')
+        with open(os.path.join(store_dir, "names.json"), 'r') as names:
+            info = json.load(names, object_pairs_hook=OrderedDict)
+        self.contigs = info['contigs']
+        self.contig_offsets = info['contig_offsets']
+        self.contig_index = dict((contig, i) for i, contig in enumerate(self.contigs))
+        self.genes = info['genes']
+        self.sources = info['sources']
+        self.transcript_ids = info['transcripts']
+        self.attributes = info['attributes']
+        self.exon_attributes = info['exon_attributes']
+
+    def __len__(self):
+        return len(self.transcripts)
+
+    def overlapping(self, contig, start, end):
+        """Return indices of transcripts whose span overlaps the 0-based, half-open interval [start, end)"""
+
+        if contig not in self.contig_index:
+            return np.zeros(0, dtype=np.int64)
+        i = self.contig_index[contig]
+        lo, hi = self.contig_offsets[i], self.contig_offsets[i + 1]
+        last = lo + np.searchsorted(self.transcripts['start'][lo:hi], end, side='left')
+        first = lo + np.searchsorted(self.transcripts['max_end'][lo:hi], start, side='right')
+        candidates = np.arange(first, last)
+
+        return candidates[self.transcripts['end'][first:last] > start]
+
+    def exons(self, index):
+        row = self.transcripts[index]
+
+        return self.exon_table[row['exon_offset']:row['exon_offset'] + row['exon_count']]
+
+    def exonic_overlap(self, index, start, end):
+        """Bases of transcript index's exons inside [start, end)"""
+
+        exons = self.exons(index)
+
+        return int(np.clip(np.minimum(exons['end'], end) - np.maximum(exons['start'], start), 0, None).sum())
+
+    def length(self, index):
+        exons = self.exons(index)
+
+        return int((exons['end'] - exons['start']).sum())
+
+    def gene(self, index):
+        return self.genes[self.transcripts[index]['gene']]
+
+    def gene_name(self, index):
+        return self.attributes[index].get('gene_name', self.attributes[index].get('ref_gene_id', self.gene(index)))
+
+    def write_gtf(self, output_file, indices=None):
+        """Write transcripts (all, or the given indices) as transcript and exon GTF lines, each line with the
+        attributes it was read with. Exons are renumbered in position order"""
+
+        indices = range(len(self)) if indices is None else sorted(indices)
+        with open(output_file, 'w') as output:
+            for index in indices:
+                row = self.transcripts[index]
+                contig = self.contigs[row['contig']]
+                source = self.sources[row['source']]
+                strand = row['strand'].decode('ascii')
+                ids = OrderedDict([('gene_id', self.gene(index)), ('transcript_id', self.transcript_ids[index])])
+                transcript_attributes = OrderedDict(ids)
+                transcript_attributes.update(self.attributes[index])
+                output.write("{}\t{}\ttranscript\t{}\t{}\t.\t{}\t.\t{}\n".format(
+                    contig, source, row['start'] + 1, row['end'], strand, format_attributes(transcript_attributes)))
+                for number, (exon_start, exon_end) in enumerate(self.exons(index), 1):
+                    exon_attributes = OrderedDict(ids)
+                    exon_attributes['exon_number'] = number
+                    exon_attributes.update(self.exon_attributes[index][number - 1])
+                    output.write("{}\t{}\texon\t{}\t{}\t.\t{}\t.\t{}\n".format(
+                        contig, source, exon_start + 1, exon_end, strand, format_attributes(exon_attributes)))
+
+
+def load_models(gtf_file, cache_dir):
+    """Open the transcript model store for a GTF, building it in cache_dir on first use.
+
+    Stores are keyed by the GTF checksum and built in a temporary directory that is renamed into place, so
+    concurrent jobs can share a cache."""
+
+    key = "{}.{}".format(os.path.basename(gtf_file), intervals.file_checksum(gtf_file)[:16])
+    store_dir = os.path.join(cache_dir, "{}.v{}.tmodels".format(key, STORE_VERSION))
+
+    if not os.path.isdir(store_dir):
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        temp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=key)
+        write_store(read_gtf(gtf_file), temp_dir)
+        try:
+            os.rename(temp_dir, store_dir)
+        except OSError:
+            # Another job built the same store first
+            shutil.rmtree(temp_dir)
+
+    return TranscriptModels(store_dir)
+
+
+def select_transcripts(models, regions=None, min_length=0, min_exons=1):
+    """Return indices of transcripts with at least min_exons exons and min_length exonic bases, overlapping a
+    regions BED file if one is given"""
+
+    if regions:
+        candidates = set()
+        for contig, start, end, name in intervals.read_bed(regions):
+            candidates.update(models.overlapping(contig, start, end).tolist())
+        candidates = sorted(candidates)
+    else:
+        candidates = range(len(models))
+
+    return [index for index in candidates
+            if models.transcripts[index]['exon_count'] >= min_exons and models.length(index) >= min_length]
+
+
+def filter_merged_reference(job, config, merged_gtf, output_gtf):
+    """Filter a merged transcript reference by stringtie filter_regions, filter_min_length and
+    filter_min_exons before re-quantification
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param merged_gtf: The merged transcript reference GTF.
+    :type merged_gtf: str.
+    :param output_gtf: The filtered GTF file name.
+    :type output_gtf: str.
+    :returns:  str -- The filtered GTF file name.
+    """
+
+    cache_dir = config.get('transcript_model_cache', os.path.join(os.getcwd(), "Intermediates", "transcript_models"))
+    models = load_models(merged_gtf, cache_dir)
+    keep = select_transcripts(models, config['stringtie'].get('filter_regions'),
+                              int(config['stringtie'].get('filter_min_length', 0)),
+                              int(config['stringtie'].get('filter_min_exons', 1)))
+    models.write_gtf(output_gtf, keep)
+
+    job.fileStore.logToMaster("Kept {} of {} merged transcripts in {}\n".format(len(keep), len(models),
+                                                                              output_gtf))
+
+    return output_gtf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query, filter and report on GTF transcript models through a "
+                                                 "cached binary store")
+    parser.add_argument('-g', '--gtf', help="Input GTF file")
+    parser.add_argument('-c', '--cache_dir', default=os.path.join("Intermediates", "transcript_models"),
+                        help="Directory holding cached transcript model stores")
+    parser.add_argument('-r', '--regions', help="BED file of regions")
+    parser.add_argument('-o', '--output', help="Write the selected transcripts as GTF")
+    parser.add_argument('-l', '--min_length', type=int, default=0, help="Minimum exonic length")
+    parser.add_argument('-e', '--min_exons', type=int, default=1, help="Minimum number of exons")
+    args = parser.parse_args()
+
+    transcript_models = load_models(args.gtf, args.cache_dir)
+
+    if args.output:
+        selected = select_transcripts(transcript_models, args.regions, args.min_length, args.min_exons)
+        transcript_models.write_gtf(args.output, selected)
+        sys.stdout.write("Wrote {} of {} transcripts to {}\n".format(len(selected), len(transcript_models),
+                                                                    args.output))
+    elif args.regions:
+        # Per region report of overlapping genes and transcripts
+        sys.stdout.write("chrom\tstart\tend\tname\tgene\tgene_name\ttranscript\texonic_overlap\n")
+        for region_contig, region_start, region_end, region_name in intervals.read_bed(args.regions):
+            for transcript in transcript_models.overlapping(region_contig, region_start, region_end):
+                sys.stdout.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                    region_contig, region_start, region_end, region_name, transcript_models.gene(transcript),
+                    transcript_models.gene_name(transcript), transcript_models.transcript_ids[transcript],
+                    transcript_models.exonic_overlap(transcript, region_start, region_end)))
@@ -0,0 +1,323 @@
+import re
+
+import numpy as np
+
+
+# Hard filters applied by gatk.filter_variants. Thresholds are read from the same top-level configuration keys
+# and a 'filter_<Name>' entry in the gatk-filter section adds a filter or overrides a standard expression.
+HARD_FILTERS = (("HighMQ0", "MQ0 > {}", 'mq0_threshold'),
+                ("LowDepth", "DP < {}", 'coverage_threshold'),
+                ("LowQual", "QUAL < {}", 'var_qual_threshold'),
+                ("LowMappingQual", "MQ < {}", 'map_qual_threshold'))
+
+TOKEN_RE = re.compile(r"\s*(?:(\d+\.\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|\d+(?:[eE][-+]?\d+)?)|"
+                      r"(\"[^\"]*\"|'[^']*')|(\|\||&&|==|!=|<=|>=|[-+*/()<>!])|([A-Za-z_][A-Za-z0-9_.]*))")
+
+COMPARISONS = {'==': np.equal, '!=': np.not_equal, '<': np.less, '<=': np.less_equal,
+               '>': np.greater, '>=': np.greater_equal}
+ARITHMETIC = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide}
+
+
+class FilterExpressionError(Exception):
+    pass
+
+
+def tokenize(expression):
+    tokens = list()
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match or match.end() == position:
+            raise FilterExpressionError("Unable to parse filter expression {} at position {}".format(expression,
+                                                                                                    position))
+        number, string, operator, name = match.groups()
+        if number is not None:
+            tokens.append(('num', float(number)))
+        elif string is not None:
+            tokens.append(('str', string[1:-1]))
+        elif operator is not None:
+            tokens.append(('op', operator))
+        else:
+            tokens.append(('name', name))
+        position = match.end()
+
+    return tokens
+
+
+class VariantColumns(object):
+    """Columnar view of a VCF: QUAL plus every INFO key as NumPy arrays. As in GATK, bare names resolve to
+    site-level fields only and never to per-sample FORMAT values"""
+
+    def __init__(self, vcf_file):
+        qual = list()
+        info_rows = list()
+        with open(vcf_file, 'r') as vcf:
+            for line in vcf:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                qual.append(fields[5])
+                info = dict()
+                if fields[7] != '.':
+                    for entry in fields[7].split(';'):
+                        key, _, value = entry.partition('=')
+                        info[key] = value if value else True
+                info_rows.append(info)
+
+        self.num_records = len(qual)
+        self.raw = {'QUAL': qual}
+        keys = set()
+        for row in info_rows:
+            keys.update(row.keys())
+        for key in keys:
+            self.raw[key] = [row.get(key) for row in info_rows]
+        self.cache = dict()
+
+    def column(self, name):
+        """Return (numeric values, string values, missing mask) arrays for a field"""
+
+        if name not in self.cache:
+            raw = self.raw.get(name)
+            if raw is None:
+                missing = np.ones(self.num_records, dtype=bool)
+                self.cache[name] = (np.full(self.num_records, np.nan), np.array([None] * self.num_records,
+                                                                                  dtype=object), missing)
+            else:
+                numeric = np.full(self.num_records, np.nan)
+                strings = np.array([None] * self.num_records, dtype=object)
+                missing = np.zeros(self.num_records, dtype=bool)
+                is_flag = any(value is True for value in raw)
+                for i, value in enumerate(raw):
+                    if value is True:
+                        numeric[i] = 1.0
+                        strings[i] = "true"
+                        continue
+                    if value is None and is_flag:
+                        numeric[i] = 0.0
+                        strings[i] = "false"
+                        continue
+                    if value is None or value == '.':
+                        missing[i] = True
+                        continue
+                    value = value.split(',')[0]
+                    strings[i] = value
+                    try:
+                        numeric[i] = float(value)
+                    except ValueError:
+                        pass
+                self.cache[name] = (numeric, strings, missing)
+
+        return self.cache[name]
+
+
+class FilterExpression(object):
+    """A GATK VariantFiltration (JEXL subset) expression evaluated over whole VariantColumns at once.
+
+    Supports numeric and string literals, INFO/QUAL identifiers, arithmetic, comparisons, !, && and ||.
+    As in GATK, a record with a value missing for any referenced field does not fail the filter."""
+
+    def __init__(self, name, expression):
+        self.name = name
+        self.expression = expression
+        self.tokens = tokenize(expression)
+
+    def evaluate(self, columns):
+        self.position = 0
+        self.columns = columns
+        values, missing = self._or()
+        if self.position != len(self.tokens):
+            raise FilterExpressionError("Unexpected token {} in filter expression "
+                                        "{}".format(self.tokens[self.position][1], self.expression))
+
+        return values.astype(bool) & ~missing
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _or(self):
+        values, missing = self._and()
+        while self._peek() == ('op', '||'):
+            self._next()
+            other, other_missing = self._and()
+            values = values.astype(bool) | other.astype(bool)
+            missing = missing | other_missing
+        return values, missing
+
+    def _and(self):
+        values, missing = self._not()
+        while self._peek() == ('op', '&&'):
+            self._next()
+            other, other_missing = self._not()
+            values = values.astype(bool) & other.astype(bool)
+            missing = missing | other_missing
+        return values, missing
+
+    def _not(self):
+        if self._peek() == ('op', '!'):
+            self._next()
+            values, missing = self._not()
+            return ~values.astype(bool), missing
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._additive()
+        kind, operator = self._peek()
+        if kind == 'op' and operator in COMPARISONS:
+            self._next()
+            right = self._additive()
+            return self._compare(operator, left, right)
+        return left[0], left[2]
+
+    def _compare(self, operator, left, right):
+        left_values, left_strings, left_missing = left
+        right_values, right_strings, right_missing = right
+        missing = left_missing | right_missing
+        if left_strings is not None or right_strings is not None:
+            if operator not in ('==', '!='):
+                raise FilterExpressionError("Only == and != are supported for strings in "
+                                            "{}".format(self.expression))
+            left_side = left_strings if left_strings is not None else left_values
+            right_side = right_strings if right_strings is not None else right_values
+            result = np.array([a == b for a, b in zip(left_side, right_side)], dtype=bool)
+            if operator == '!=':
+                result = ~result
+            return result, missing
+        with np.errstate(invalid='ignore'):
+            return COMPARISONS[operator](left_values, right_values), missing
+
+    def _additive(self):
+        values, strings, missing = self._multiplicative()
+        while self._peek()[0] == 'op' and self._peek()[1] in ('+', '-'):
+            operator = self._next()[1]
+            other, _, other_missing = self._multiplicative()
+            values, strings, missing = ARITHMETIC[operator](values, other), None, missing | other_missing
+        return values, strings, missing
+
+    def _multiplicative(self):
+        values, strings, missing = self._unary()
+        while self._peek()[0] == 'op' and self._peek()[1] in ('*', '/'):
+            operator = self._next()[1]
+            other, _, other_missing = self._unary()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = ARITHMETIC[operator](values, other)
+            strings, missing = None, missing | other_missing | np.isnan(values)
+        return values, strings, missing
+
+    def _unary(self):
+        if self._peek() == ('op', '-'):
+            self._next()
+            values, _, missing = self._unary()
+            return -values, None, missing
+        return self._primary()
+
+    def _primary(self):
+        kind, value = self._next()
+        num_records = self.columns.num_records
+        if kind == 'num':
+            return np.full(num_records, value), None, np.zeros(num_records, dtype=bool)
+        if kind == 'str':
+            return (np.full(num_records, np.nan), np.array([value] * num_records, dtype=object),
+                    np.zeros(num_records, dtype=bool))
+        if kind == 'name':
+            if value in ('true', 'false'):
+                return (np.full(num_records, 1.0 if value == 'true' else 0.0), None,
+                        np.zeros(num_records, dtype=bool))
+            numeric, strings, missing = self.columns.column(value)
+            # Only treat a field as a string when it has non-numeric values
+            if np.isnan(numeric[~missing]).any():
+                return numeric, strings, missing
+            return numeric, None, missing
+        if (kind, value) == ('op', '('):
+            values, missing = self._or()
+            if self._next() != ('op', ')'):
+                raise FilterExpressionError("Unbalanced parentheses in filter expression "
+                                            "{}".format(self.expression))
+            return values.astype(float), None, missing
+        raise FilterExpressionError("Unexpected token {} in filter expression {}".format(value, self.expression))
+
+
+def configured_filters(config):
+    """Return the ordered list of FilterExpressions configured for the gatk-filter stage. Each standard filter
+    needs its threshold key in the configuration unless the gatk-filter section overrides its expression"""
+
+    filters = list()
+    section = config.get('gatk-filter', dict())
+    overrides = dict((key[len('filter_'):], value) for key, value in section.items() if key.startswith('filter_'))
+
+    for name, template, threshold_key in HARD_FILTERS:
+        if name in overrides:
+            expression = overrides.pop(name)
+        elif threshold_key in config:
+            expression = template.format(config[threshold_key])
+        else:
+            raise KeyError("Configuration is missing {} for the {} filter".format(threshold_key, name))
+        filters.append(FilterExpression(name, expression))
+    for name in sorted(overrides):
+        filters.append(FilterExpression(name, overrides[name]))
+
+    return filters
+
+
+def apply_filters(input_vcf, output_vcf, filters):
+    """Evaluate all filters over the input columns, then write FILTER flags in one streaming pass.
+    Returns the number of records failing at least one filter"""
+
+    columns = VariantColumns(input_vcf)
+    failures = [(expression.name, expression.evaluate(columns)) for expression in filters]
+
+    num_failed = 0
+    record = 0
+    with open(input_vcf, 'r') as vcf, open(output_vcf, 'w') as output:
+        for line in vcf:
+            if line.startswith('##'):
+                output.write(line)
+                continue
+            if line.startswith('#'):
+                for expression in filters:
+                    output.write('##FILTER=<ID={},Description="{}">\n'.format(
+                        expression.name, expression.expression.replace('"', '\\"')))
+                output.write(line)
+                continue
+
+            fields = line.rstrip('\n').split('\t')
+            failed = [name for name, mask in failures if mask[record]]
+            if failed:
+                existing = [value for value in fields[6].split(';') if value not in ('.', 'PASS')]
+                fields[6] = ";".join(existing + failed)
+                num_failed += 1
+            elif fields[6] == '.':
+                fields[6] = "PASS"
+            output.write("{}\n".format("\t".join(fields)))
+            record += 1
+
+    return num_failed
+
+
+def filter_variants(job, config, sample, input_vcf):
+    """Apply the configured hard filters in-process, replacing the GATK VariantFiltration JVM launch
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param input_vcf: The input VCF file name.
+    :type input_vcf: str.
+    :returns:  str -- The output VCF file name.
+    """
+
+    output_vcf = "{}.filtered.vcf".format(sample)
+    filters = configured_filters(config)
+
+    job.fileStore.logToMaster("Filtering {} with: {}\n".format(input_vcf, ", ".join(
+        "{}={}".format(expression.name, expression.expression) for expression in filters)))
+    num_failed = apply_filters(input_vcf, output_vcf, filters)
+    job.fileStore.logToMaster("{} variants failed filters for sample {}\n".format(num_failed, sample))
+
+    return output_vcf
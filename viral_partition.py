@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Standard packages
+import os
+import sys
+import math
+import argparse
+import tempfile
+import subprocess
+
+from collections import Counter
+
+# Third-party packages
+import pysam
+
+# Package methods
+import rna_alignment
+import shell_commands
+from ddb_ngsflow import pipeline
+
+
+# The partition stage sorts the host and viral streams concurrently
+SORT_PROCESSES = 2
+
+
+def viral_contigs(config):
+    """Viral contig names of the combined host+viral reference: config viral_contigs (comma separated), or
+    every sequence in the viral FASTA index (viral_reference.fai)"""
+
+    if config.get('viral_contigs'):
+        return [contig.strip() for contig in config['viral_contigs'].split(',') if contig.strip()]
+    with open("{}.fai".format(config['viral_reference']), 'r') as fai:
+        return [line.split('\t')[0] for line in fai if line.strip()]
+
+
+class ViralLoad(object):
+    """Per-sample read partition counts and aligned bases per viral contig"""
+
+    def __init__(self, contig_lengths):
+        self.contig_lengths = contig_lengths
+        self.counts = Counter()
+        self.contig_reads = Counter()
+        self.contig_bases = Counter()
+
+    def add(self, read, viral):
+        if read.is_secondary or read.is_supplementary:
+            return
+        self.counts['reads'] += 1
+        if read.is_unmapped:
+            self.counts['unmapped'] += 1
+        elif viral:
+            self.counts['viral'] += 1
+            self.contig_reads[read.reference_name] += 1
+            self.contig_bases[read.reference_name] += read.query_alignment_length
+        else:
+            self.counts['host'] += 1
+
+    def write(self, output_file, sample):
+        reads = self.counts['reads']
+        mapped = self.counts['host'] + self.counts['viral']
+        with open(output_file, 'w') as output:
+            output.write("Sample\t{}\n".format(sample))
+            output.write("Total reads\t{}\n".format(reads))
+            output.write("Host reads\t{}\n".format(self.counts['host']))
+            output.write("Viral reads\t{}\n".format(self.counts['viral']))
+            output.write("Unmapped reads\t{}\n".format(self.counts['unmapped']))
+            output.write("Viral fraction of mapped reads\t{:.6f}\n".format(
+                float(self.counts['viral']) / mapped if mapped else 0.0))
+            output.write("Viral reads per million mapped\t{:.2f}\n".format(
+                1e6 * self.counts['viral'] / mapped if mapped else 0.0))
+            output.write("\nContig\tLength\tReads\tMean Depth\n")
+            for contig in sorted(self.contig_lengths):
+                output.write("{}\t{}\t{}\t{:.2f}\n".format(contig, self.contig_lengths[contig],
+                                                         self.contig_reads[contig],
+                                                         float(self.contig_bases[contig]) /
+                                                         self.contig_lengths[contig]))
+
+
+def partition(reader, host_writer, viral_writer, viral, stats):
+    """Route every record to the viral or host writer by reference, unmapped reads to the host"""
+
+    for read in reader:
+        is_viral = not read.is_unmapped and read.reference_name in viral
+        (viral_writer if is_viral else host_writer).write(read)
+        stats.add(read, is_viral)
+
+
+def sorting_writer(output_bam, template, samtools, threads, sort_mem):
+    """Open a pysam writer whose records stream through a named pipe into samtools sort"""
+
+    fifo_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_bam)))
+    fifo = os.path.join(fifo_dir, "stream.bam")
+    os.mkfifo(fifo)
+    sort_process = subprocess.Popen([samtools, "sort", "-@", str(threads), "-m", sort_mem, "-T",
+                                     "{}.sort.temp".format(os.path.splitext(output_bam)[0]),
+                                     "-o", output_bam, fifo])
+    writer = pysam.AlignmentFile(fifo, 'wbu', template=template)
+
+    return writer, sort_process, fifo_dir
+
+
+def close_sorting_writer(writer, sort_process, fifo_dir):
+    writer.close()
+    if sort_process.wait() != 0:
+        raise RuntimeError("samtools sort failed with exit code {}".format(sort_process.returncode))
+    os.remove(os.path.join(fifo_dir, "stream.bam"))
+    os.rmdir(fifo_dir)
+
+
+def job_memory(config):
+    """Toil memory request for align_dual_reference: STAR's max_mem plus both partition sorts"""
+
+    return "{}G".format(int(config['star']['max_mem']) +
+                        int(math.ceil(SORT_PROCESSES * rna_alignment.sort_memory(config, 'star'))))
+
+
+def align_dual_reference(job, config, sample, samples, flags):
+    """Align once against a combined host+viral STAR index, partitioning the stream into sorted host and viral
+    BAMs with per-sample viral load statistics, replacing separate STAR and Bowtie alignments and their merge
+    :param config: The configuration dictionary.
+    :type config: dict.
+    :param sample: sample name.
+    :type sample: str.
+    :param samples: The samples configuration dictionary.
+    :type samples: dict.
+    :param flags: STAR option flags (keep_retained, cufflinks).
+    :type flags: list.
+    :returns:  str -- The host and viral BAM merged for Cufflinks ({sample}.merged.sorted.bam).
+    """
+
+    host_bam = "{}.host.sorted.bam".format(sample)
+    viral_bam = "{}.viral.sorted.bam".format(sample)
+    merged_bam = "{}.merged.sorted.bam".format(sample)
+    stats_file = "{}.viral_load.txt".format(sample)
+    logfile = "{}.dual_reference.log".format(sample)
+
+    star_cmd = ["{}".format(config['star']['bin']),
+                "--genomeDir", "{}".format(config['star']['combined_index']),
+                "--runThreadN", "{}".format(config['star']['num_cores']),
+                "--readFilesIn", "{}".format(samples[sample]['fastq1']),
+                "--outFileNamePrefix", "{}.dual.".format(sample),
+                "--outSAMtype", "BAM", "Unsorted",
+                # Unmapped reads stay in the stream so the partition counts them and the total is every read
+                "--outSAMunmapped", "Within",
+                "--outStd", "BAM_Unsorted",
+                "--outBAMcompression", "0"]
+    if "keep_retained" in flags:
+        star_cmd.extend(["--outReadsUnmapped", "Fastx"])
+    if "cufflinks" in flags:
+        star_cmd.extend(["--outSAMstrandField", "intronMotif"])
+
+    partition_cmd = ["{}".format(sys.executable),
+                     "{}.py".format(os.path.splitext(os.path.abspath(__file__))[0]),
+                     "-s", "{}".format(sample),
+                     "-v", "{}".format(",".join(viral_contigs(config))),
+                     "--host", "{}".format(host_bam),
+                     "--viral", "{}".format(viral_bam),
+                     "--stats", "{}".format(stats_file),
+                     "--samtools", "{}".format(config['samtools']['bin']),
+                     "-t", "{}".format(config['star']['num_cores']),
+                     "-m", "{}".format(config['star'].get('sort_mem_per_thread', '768M'))]
+
+    merge_cmd = ["{}".format(config['samtools']['bin']), "merge", "-f", "{}".format(merged_bam),
+                 "{}".format(host_bam), "{}".format(viral_bam)]
+
+    command = "{} && {} && {} index {} && {} index {} && {} index {}".format(
+        shell_commands.pipefail("{} | {}".format(" ".join(star_cmd), " ".join(partition_cmd))),
+        " ".join(merge_cmd),
+        config['samtools']['bin'], host_bam, config['samtools']['bin'], viral_bam,
+        config['samtools']['bin'], merged_bam)
+
+    job.fileStore.logToMaster("Dual reference alignment command: {}\n".format(command))
+    pipeline.run_and_log_command(command, logfile)
+
+    return merged_bam
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partition an aligner stream from a combined host+viral "
+                                                 "reference into sorted host and viral BAMs")
+    parser.add_argument('-i', '--input', default="-", help="Input SAM/BAM (default: stdin)")
+    parser.add_argument('-s', '--sample', help="Sample name for the statistics report")
+    parser.add_argument('-v', '--viral_contigs', help="Comma separated viral contig names")
+    parser.add_argument('--host', help="Output sorted host BAM")
+    parser.add_argument('--viral', help="Output sorted viral BAM")
+    parser.add_argument('--stats', help="Output viral load statistics")
+    parser.add_argument('--samtools', default="samtools", help="samtools executable")
+    parser.add_argument('-t', '--threads', type=int, default=1, help="Sort threads per output")
+    parser.add_argument('-m', '--sort_mem', default="768M", help="samtools sort memory per thread")
+    args = parser.parse_args()
+
+    viral_names = set(args.viral_contigs.split(','))
+    in_reads = pysam.AlignmentFile(args.input, 'r')
+    lengths = dict((name, length) for name, length in zip(in_reads.references, in_reads.lengths)
+                   if name in viral_names)
+    missing_contigs = viral_names - set(lengths)
+    if missing_contigs:
+        sys.stderr.write("WARNING: viral contigs not in the reference: {}\n".format(", ".join(missing_contigs)))
+
+    host = sorting_writer(args.host, in_reads, args.samtools, args.threads, args.sort_mem)
+    viral_out = sorting_writer(args.viral, in_reads, args.samtools, args.threads, args.sort_mem)
+    viral_load = ViralLoad(lengths)
+    partition(in_reads, host[0], viral_out[0], viral_names, viral_load)
+    close_sorting_writer(*host)
+    close_sorting_writer(*viral_out)
+    in_reads.close()
+
+    viral_load.write(args.stats, args.sample)
@@ -11,9 +11,15 @@ from toil.job import Job
 # Package methods
 from ddb import configuration
 from ddb_ngsflow import pipeline
-from ddb_ngsflow.rna import hisat
 from ddb_ngsflow.rna import stringtie
 
+# Local methods
+import expression_matrix
+import rna_alignment
+import samples_config
+import stringtie_merge
+import transcript_models
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -37,9 +43,9 @@ if __name__ == "__main__":
     # Per sample jobs
     for sample in samples:
         # Alignment and Refinement Stages
-        align_job = Job.wrapJobFn(hisat.hisat_paired, config, sample, samples, flags,
+        align_job = Job.wrapJobFn(rna_alignment.hisat_paired_sorted, config, sample, samples, flags,
                                   cores=int(config['hisat']['num_cores']),
-                                  memory="{}G".format(config['hisat']['max_mem']))
+                                  memory=rna_alignment.job_memory(config, 'hisat'))
 
         samples[sample]['bam'] = "{}.hisat.sorted.bam".format(sample)
 
@@ -53,20 +59,48 @@ if __name__ == "__main__":
         root_job.addChild(align_job)
         align_job.addChild(initial_st_job)
 
-    transcripts_list_string = " ".join(transcripts_list)
-    merge_job = Job.wrapJobFn(stringtie.stringtie_merge, config, samples, flags, transcripts_list_string,
-                              cores=int(config['stringtie']['num_cores']),
-                              memory="{}G".format(config['stringtie']['max_mem']))
+    # Assemblies are merged in parallel batches (or only new ones into stringtie existing_merge)
+    run_id = samples_config.run_name(config, samples)
+    config['merged_transcript_reference'] = "{}.stringtie.merged.gtf".format(run_id)
+    merge_job = Job.wrapJobFn(stringtie_merge.merge_assemblies, config, transcripts_list,
+                              config['merged_transcript_reference'],
+                              cores=1)
 
     root_job.addFollowOn(merge_job)
 
-    config['merged_transcript_reference'] = "{}.stringtie.merged.gtf".format(config['run_id'])
-
+    # Optionally restrict the merged reference to panel regions or minimum transcript sizes
+    quant_config = config
+    filter_job = None
+    if any(config['stringtie'].get(key) for key in ('filter_regions', 'filter_min_length', 'filter_min_exons')):
+        quant_config = dict(config)
+        quant_config['merged_transcript_reference'] = "{}.stringtie.merged.filtered.gtf".format(run_id)
+        filter_job = Job.wrapJobFn(transcript_models.filter_merged_reference, config,
+                                   config['merged_transcript_reference'],
+                                   quant_config['merged_transcript_reference'],
+                                   cores=1,
+                                   memory="4G")
+        merge_job.addFollowOn(filter_job)
+
+    # Re-quantification runs under one stage job so the run level matrices follow all of it
+    quant_stage_job = filter_job
+    if quant_stage_job is None:
+        quant_stage_job = Job.wrapJobFn(pipeline.spawn_batch_jobs, cores=1)
+        merge_job.addFollowOn(quant_stage_job)
+
+    quant_results = dict()
     for sample in samples:
-        stringtie_job = Job.wrapJobFn(stringtie.stringtie, config, sample, samples, flags,
+        stringtie_job = Job.wrapJobFn(stringtie.stringtie, quant_config, sample, samples, flags,
                                       cores=int(config['stringtie']['num_cores']),
                                       memory="{}G".format(config['stringtie']['max_mem']))
-        merge_job.addChild(stringtie_job)
+        quant_results[sample] = stringtie_job.rv()
+        quant_stage_job.addChild(stringtie_job)
+
+    # Run level sparse transcript and gene matrices
+    matrix_job = Job.wrapJobFn(expression_matrix.stringtie_expression_matrix, config, samples, quant_results,
+                               cores=1,
+                               memory="{}G".format(config['stringtie']['max_mem']))
+
+    quant_stage_job.addFollowOn(matrix_job)
 
     # Start workflow execution
     Job.Runner.startToil(root_job, args)
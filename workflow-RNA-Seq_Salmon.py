@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# Standard packages
+import sys
+import argparse
+
+# Third-party packages
+from toil.job import Job
+
+# Package methods
+from ddb import configuration
+from ddb_ngsflow import pipeline
+from ddb_ngsflow.rna import salmon
+
+# Local methods
+import expression_matrix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--samples_file', help="Input configuration file for samples")
+    parser.add_argument('-c', '--configuration', help="Configuration file for various settings")
+    parser.add_argument('-u', '--unpaired', action='store_true', help="Samples have single-end reads")
+    Job.Runner.addToilOptions(parser)
+    args = parser.parse_args()
+    args.logLevel = "INFO"
+
+    sys.stdout.write("Parsing configuration data\n")
+    config = configuration.configure_runtime(args.configuration)
+
+    sys.stdout.write("Parsing sample data\n")
+    samples = configuration.configure_samples(args.samples_file, config)
+
+    # Workflow Graph definition. The following workflow definition should create a valid Directed Acyclic Graph (DAG)
+    root_job = Job.wrapJobFn(pipeline.spawn_batch_jobs, cores=1)
+    quant_results = dict()
+
+    # Per sample jobs
+    for sample in samples:
+        quant_job = Job.wrapJobFn(salmon.salmonEM_unpaired if args.unpaired else salmon.salmonEM_paired,
+                                  config, sample, samples,
+                                  cores=int(config['salmon']['num_cores']),
+                                  memory="{}G".format(config['salmon']['max_mem']))
+        quant_results[sample] = quant_job.rv()
+
+        # Create workflow from created jobs
+        root_job.addChild(quant_job)
+
+    # Run level transcript and gene matrices
+    matrix_job = Job.wrapJobFn(expression_matrix.salmon_expression_matrix, config, samples, quant_results,
+                               cores=int(config['salmon']['num_cores']),
+                               memory="{}G".format(config['salmon']['max_mem']))
+
+    root_job.addFollowOn(matrix_job)
+
+    # Start workflow execution
+    Job.Runner.startToil(root_job, args)
@@ -11,11 +11,8 @@ from toil.job import Job
 # Package methods
 from ddb import configuration
 from ddb_ngsflow import gatk
-from ddb_ngsflow import annotation
 from ddb_ngsflow import pipeline
-from ddb_ngsflow.align import bwa
 from ddb_ngsflow.qc import qc
-from ddb_ngsflow.coverage import sambamba
 from ddb_ngsflow.variation import variation
 from ddb_ngsflow.variation import freebayes
 from ddb_ngsflow.variation import mutect
@@ -24,6 +21,14 @@ from ddb_ngsflow.variation import vardict
 from ddb_ngsflow.variation import scalpel
 from ddb_ngsflow.variation.sv import pindel
 
+# Local methods
+import bam_filter
+import variant_filter
+import batch_annotation
+import coverage_engine
+import coverage_summary
+import lane_alignment
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -62,30 +67,36 @@ if __name__ == "__main__":
 
     fastqc_job = Job.wrapJobFn(qc.run_fastqc, config, samples)
 
+    # snpEff runs once over all samples' filtered VCFs and vcfanno once per vcfanno_config
+    snpeff_inputs = dict()
+
+    coverage_files = dict()
+
     # Per sample jobs
     for sample in samples:
         # Alignment and Refinement Stages
-        align_job = Job.wrapJobFn(bwa.run_bwa_mem, config, sample, samples,
-                                  cores=int(config['bwa']['num_cores']),
-                                  memory="{}G".format(config['bwa']['max_mem']))
+        # Each lane is aligned in parallel with its own read group, then merged
+        align_job = Job.wrapJobFn(lane_alignment.spawn_lane_alignments, config, sample, samples,
+                                  cores=1)
 
-        filter_job = Job.wrapJobFn(bwa.run_bedtools_filter, config, sample,
+        lane_merge_job = Job.wrapJobFn(lane_alignment.merge_lane_bams, config, sample, samples,
+                                       align_job.rv(),
+                                       cores=int(config['bwa']['num_cores']),
+                                       memory="{}G".format(config['bwa']['max_mem']))
+
+        filter_job = Job.wrapJobFn(bam_filter.run_interval_filter, config, sample,
                                    samples,
-                                   align_job.rv(), cores=1,
+                                   lane_merge_job.rv(), cores=1,
                                    memory="{}G".format(config['bwa']['max_mem']))
 
-        add_job = Job.wrapJobFn(gatk.add_or_replace_readgroups, config, sample,
-                                filter_job.rv(), cores=1,
-                                memory="{}G".format(config['picard-add']['max_mem']))
-
         creator_job = Job.wrapJobFn(gatk.realign_target_creator, config,
                                     sample,
-                                    add_job.rv(),
+                                    filter_job.rv(),
                                     cores=int(config['gatk-realign']['num_cores']),
                                     memory="{}G".format(config['gatk-realign']['max_mem']))
 
         realign_job = Job.wrapJobFn(gatk.realign_indels, config, sample,
-                                    add_job.rv(), creator_job.rv(),
+                                    filter_job.rv(), creator_job.rv(),
                                     cores=1,
                                     memory="{}G".format(config['gatk-realign']['max_mem']))
 
@@ -96,12 +107,16 @@ if __name__ == "__main__":
 
         # Variant Calling
         spawn_variant_job = Job.wrapJobFn(pipeline.spawn_variant_jobs)
-        coverage_job = Job.wrapJobFn(sambamba.sambamba_region_coverage, config,
+        coverage_job = Job.wrapJobFn(coverage_engine.region_coverage, config,
                                      sample, samples,
                                      "{}.recalibrated.sorted.bam".format(sample),
                                      cores=int(config['gatk']['num_cores']),
                                      memory="{}G".format(config['gatk']['max_mem']))
 
+        coverage_load_job = Job.wrapJobFn(coverage_summary.load_sample_coverage, config, sample, samples,
+                                          cores=1, memory="2G")
+        coverage_files[sample] = coverage_load_job.rv()
+
         freebayes_job = Job.wrapJobFn(freebayes.freebayes_single, config,
                                       sample,
                                       "{}.recalibrated.sorted.bam".format(sample),
@@ -293,30 +308,24 @@ if __name__ == "__main__":
                                           cores=int(config['gatk-annotate']['num_cores']),
                                           memory="{}G".format(config['gatk-annotate']['max_mem']))
 
-        gatk_filter_job = Job.wrapJobFn(gatk.filter_variants, config, sample, gatk_annotate_job.rv(),
+        gatk_filter_job = Job.wrapJobFn(variant_filter.filter_variants, config, sample, gatk_annotate_job.rv(),
                                         cores=1,
                                         memory="{}G".format(config['gatk-filter']['max_mem']))
 
-        snpeff_job = Job.wrapJobFn(annotation.snpeff, config, sample, "{}.filtered.vcf".format(sample),
-                                   cores=int(config['snpeff']['num_cores']),
-                                   memory="{}G".format(config['snpeff']['max_mem']))
-
-        vcfanno_job = Job.wrapJobFn(annotation.vcfanno, config, sample, samples,
-                                    "{}.snpEff.{}.vcf".format(sample, config['snpeff']['reference']),
-                                    cores=int(config['vcfanno']['num_cores']),
-                                    memory="{}G".format(config['vcfanno']['max_mem']))
+        snpeff_inputs[sample] = "{}.filtered.vcf".format(sample)
 
         # Create workflow from created jobs
         root_job.addChild(align_job)
-        align_job.addChild(filter_job)
-        filter_job.addChild(add_job)
-        add_job.addChild(creator_job)
+        align_job.addFollowOn(lane_merge_job)
+        lane_merge_job.addChild(filter_job)
+        filter_job.addChild(creator_job)
         creator_job.addChild(realign_job)
         realign_job.addChild(recal_job)
 
         recal_job.addChild(spawn_variant_job)
 
         spawn_variant_job.addChild(coverage_job)
+        coverage_job.addChild(coverage_load_job)
         spawn_variant_job.addChild(freebayes_job)
         spawn_variant_job.addChild(mutect_job)
         spawn_variant_job.addChild(vardict_job)
@@ -363,8 +372,20 @@ if __name__ == "__main__":
 
         merge_job.addChild(gatk_annotate_job)
         gatk_annotate_job.addChild(gatk_filter_job)
-        gatk_filter_job.addChild(snpeff_job)
-        snpeff_job.addChild(vcfanno_job)
+
+    snpeff_job = Job.wrapJobFn(batch_annotation.snpeff_batch, config, samples, snpeff_inputs,
+                               cores=int(config['snpeff']['num_cores']),
+                               memory="{}G".format(config['snpeff']['max_mem']))
+
+    vcfanno_job = Job.wrapJobFn(batch_annotation.vcfanno_batch, config, samples, snpeff_job.rv(),
+                                cores=1)
+
+    root_job.addFollowOn(snpeff_job)
+    snpeff_job.addChild(vcfanno_job)
+
+    coverage_summary_job = Job.wrapJobFn(coverage_summary.summarize_run_coverage, config, coverage_files,
+                                         cores=1, memory="2G")
+    root_job.addFollowOn(coverage_summary_job)
 
     root_job.addFollowOn(fastqc_job)
     # Start workflow execution